@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Category, Tag, Post, Comment, Subscription, PostLike, ForbiddenWord
+from .models import User, Category, Tag, Post, Comment, Subscription, PostLike, ForbiddenWord, OutboundEmail, PostNotificationJob, DigestItem, TimelineEntry, StoredFile, QueryOffender
 
 admin.site.register(User)
 admin.site.register(Category)
@@ -9,3 +9,29 @@ admin.site.register(Comment)
 admin.site.register(Subscription)
 admin.site.register(PostLike)
 admin.site.register(ForbiddenWord)
+admin.site.register(OutboundEmail)
+admin.site.register(PostNotificationJob)
+admin.site.register(DigestItem)
+admin.site.register(TimelineEntry)
+admin.site.register(StoredFile)
+
+
+@admin.register(QueryOffender)
+class QueryOffenderAdmin(admin.ModelAdmin):
+    """Top SQL offenders recorded by blog.profiling, worst first."""
+    list_display = ('kind', 'view', 'statement', 'occurrences', 'max_ms', 'average_ms', 'max_repeats', 'last_seen')
+    list_filter = ('kind', 'view')
+    search_fields = ('sql', 'view')
+    ordering = ('-occurrences', '-max_ms')
+    readonly_fields = [field.name for field in QueryOffender._meta.fields]
+
+    @admin.display(description='SQL')
+    def statement(self, obj):
+        return obj.sql if len(obj.sql) <= 120 else obj.sql[:117] + '...'
+
+    @admin.display(description='avg ms', ordering='total_ms')
+    def average_ms(self, obj):
+        return round(obj.total_ms / obj.occurrences, 2) if obj.occurrences else 0
+
+    def has_add_permission(self, request):
+        return False
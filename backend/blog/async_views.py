@@ -0,0 +1,218 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import caching, outbox, views
+from .caching import cache_anonymous_response
+from .comments import attach_replies, get_max_depth
+from .models import Category, Comment, Post, Subscription
+from .pagination import CommentPagination, PostFeedPagination
+from .serializers import CategorySerializer, CommentSerializer, PostSerializer, post_list_context
+
+
+# =============================================================================
+# ASYNC READ VIEWS
+# =============================================================================
+
+# Native async versions of the hot GET endpoints, and of subscribing. Each
+# one is mounted on the same URL as its sync view in blog/urls.py, and every
+# other method (and search) is handed to that sync view, so the URLconf works
+# unchanged under both WSGI and ASGI. Page queries go through the async ORM; authentication
+# and serialization, which may still hit the database for fragment-cache
+# misses and the caller's reactions, run in a thread via sync_to_async.
+
+def serve_async(method, sync_view):
+    """Serve ``method`` with the decorated coroutine and any other method with ``sync_view``."""
+    fallback = sync_to_async(sync_view)
+
+    def decorator(async_view):
+        @wraps(async_view)
+        async def view(request, *args, **kwargs):
+            if request.method == method:
+                return await async_view(request, *args, **kwargs)
+            return await fallback(request, *args, **kwargs)
+        # The sync views are DRF views, which handle CSRF themselves
+        view.csrf_exempt = True
+        return view
+    return decorator
+
+
+def async_reads(sync_view):
+    return serve_async('GET', sync_view)
+
+
+def render(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), content_type='application/json', status=status)
+
+
+def not_found(model):
+    # The message DRF gives get_object_or_404's Http404 in the sync views
+    return render({'detail': f'No {model._meta.object_name} matches the given query.'}, status=404)
+
+
+def error_response(exc):
+    return render({'detail': exc.detail}, status=exc.status_code)
+
+
+def authenticate(request):
+    """Wrap ``request`` for DRF and authenticate it; returns (request, error response)."""
+    request = Request(
+        request,
+        parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    try:
+        request.user
+    except APIException as exc:
+        return request, error_response(exc)
+    return request, None
+
+
+async def apaginate(paginator, queryset, request):
+    """The requested page of ``queryset``; returns (page, error response) for bad cursors and pages."""
+    try:
+        return await paginator.apaginate_queryset(queryset, request), None
+    except APIException as exc:
+        return None, error_response(exc)
+
+
+aauthenticate = sync_to_async(authenticate)
+
+
+@sync_to_async
+def serialize_posts(request, posts, many=True):
+    context = post_list_context(request, posts)
+    if many:
+        return PostSerializer(posts, many=True, context=context).data
+    return PostSerializer(posts[0], context=context).data
+
+
+async def paginated_posts(request, queryset):
+    request, error = await aauthenticate(request)
+    if error:
+        return error
+    paginator = PostFeedPagination()
+    page, error = await apaginate(paginator, queryset, request)
+    if error:
+        return error
+    return render(paginator.get_paginated_data(await serialize_posts(request, page)))
+
+
+# -------------------- Posts --------------------
+@cache_anonymous_response(caching.FEED)
+async def post_feed(request):
+    return await paginated_posts(request, views.post_list_queryset())
+
+
+@async_reads(views.view_add_post)
+async def post_list(request):
+    if request.GET.get('search', '').strip():
+        return await sync_to_async(views.view_add_post)(request)
+    return await post_feed(request)
+
+
+@async_reads(views.post_by_id)
+@cache_anonymous_response(lambda request, id: caching.post_version(id))
+async def post_detail(request, id):
+    request, error = await aauthenticate(request)
+    if error:
+        return error
+    post = await views.post_list_queryset().filter(pk=id).afirst()
+    if post is None:
+        return not_found(Post)
+    return render(await serialize_posts(request, [post], many=False))
+
+
+# -------------------- Categories --------------------
+@async_reads(views.get_categories)
+@cache_anonymous_response(caching.CATEGORIES)
+async def category_list(request):
+    request, error = await aauthenticate(request)
+    if error:
+        return error
+    categories = [category async for category in Category.objects.order_by('-created_at')]
+    data = await sync_to_async(lambda: CategorySerializer(categories, many=True, context={'request': request}).data)()
+    return render(data)
+
+
+@async_reads(views.get_posts_by_category_id)
+@cache_anonymous_response(lambda request, id: caching.category_version(id))
+async def category_posts(request, id):
+    if not await Category.objects.filter(pk=id).aexists():
+        return not_found(Category)
+    return await paginated_posts(request, views.post_list_queryset().filter(category_id=id))
+
+
+# -------------------- Comments --------------------
+@sync_to_async
+def serialize_comments(request, comments, max_depth):
+    attach_replies(comments, max_depth)
+    return CommentSerializer(comments, many=True, context={'request': request}).data
+
+
+@async_reads(views.CommentListCreateView.as_view())
+@cache_anonymous_response(lambda request, post_id: caching.post_version(post_id))
+async def post_comments(request, post_id):
+    request, error = await aauthenticate(request)
+    if error:
+        return error
+    max_depth = 0
+    if request.query_params.get('top_level_only', '').lower() not in ('1', 'true', 'yes'):
+        max_depth = get_max_depth(request.query_params.get('max_depth'))
+    paginator = CommentPagination()
+    queryset = Comment.objects.filter(post_id=post_id, parent__isnull=True).select_related('user')
+    page, error = await apaginate(paginator, queryset, request)
+    if error:
+        return error
+    return render(paginator.get_paginated_data(await serialize_comments(request, page, max_depth)))
+
+
+# -------------------- Subscriptions --------------------
+@serve_async('POST', views.subscribe_to_category)
+async def subscribe(request):
+    """
+    subscribe_to_category for ASGI. The async ORM can't hold a transaction
+    across awaits, so the confirmation email is queued just after the
+    subscription is created rather than atomically with it.
+    """
+    drf_request, error = await aauthenticate(request)
+    if error:
+        return error
+    if not drf_request.user.is_authenticated:
+        # The sync view answers with DRF's 401 and its headers
+        return await sync_to_async(views.subscribe_to_category)(request)
+    try:
+        data = await sync_to_async(lambda: drf_request.data)()
+    except APIException as exc:
+        return error_response(exc)
+
+    category_id = data.get('category_id')
+    if not category_id:
+        return render({'error': 'Category ID is required'}, status=400)
+    digest = data.get('digest')
+    if digest is not None and digest not in dict(Subscription.DIGEST_CHOICES):
+        return render({'error': 'Invalid digest option'}, status=400)
+
+    category = await Category.objects.filter(pk=category_id).afirst()
+    if category is None:
+        return not_found(Category)
+    user = drf_request.user
+    subscription, created = await Subscription.objects.aget_or_create(
+        user=user, category=category, defaults={'digest': digest or Subscription.IMMEDIATE},
+    )
+    if created:
+        # Principals built from the token leave email deferred
+        await user.arefresh_from_db(fields=['email'])
+        if user.email:
+            await outbox.aenqueue_email(**views.subscription_email(user, category))
+        return render({'message': f'Subscribed to category: {category.name}'})
+    if digest and digest != subscription.digest:
+        subscription.digest = digest
+        await subscription.asave(update_fields=['digest'])
+        return render({'message': f'Updated subscription to category: {category.name}'})
+    return render({'message': f'Already subscribed to category: {category.name}'})
@@ -0,0 +1,109 @@
+import copy
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import router
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from . import caching
+from .models import User
+
+
+# =============================================================================
+# JWT PRINCIPALS
+# =============================================================================
+
+# Access tokens carry the user's username, is_admin and is_blocked plus the
+# user's version token at login. Saving a User bumps the version (see
+# blog.signals), so a token whose version is still current can be trusted
+# as-is and a stale one falls back to the database.
+VERSION_CLAIM = 'ver'
+CLAIM_FIELDS = ('username', 'is_admin', 'is_blocked')
+
+
+def current_version(user_id):
+    name = caching.user_version(user_id)
+    return caching.get_versions([name])[name]
+
+
+def add_claims(token, user):
+    for field in CLAIM_FIELDS:
+        token[field] = getattr(user, field)
+    token[VERSION_CLAIM] = current_version(user.pk)
+    return token
+
+
+def user_from_claims(user_id, token):
+    """
+    A User built from the token alone. Fields not in the token are deferred,
+    so reading one loads it and saving writes back only the loaded fields.
+    """
+    values = {'id': user_id, 'is_active': True}
+    values.update((field, token[field]) for field in CLAIM_FIELDS)
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+    return User.from_db(router.db_for_read(User), names, [values[name] for name in names])
+
+
+class PrincipalCache:
+    """Process-local LRU of authenticated users, keyed by id and version."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, version, user):
+        with self._lock:
+            self._entries[user_id] = (version, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principals = PrincipalCache(getattr(settings, 'AUTH_PRINCIPAL_CACHE_SIZE', 1024))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that only reads the User row when the token's version
+    claim is out of date. Blocking, promoting or otherwise saving a user
+    bumps their version, so the very next request sees the change.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = User._meta.pk.to_python(validated_token[api_settings.USER_ID_CLAIM])
+        except (KeyError, ValueError) as exc:
+            raise InvalidToken('Token contained no recognizable user identification') from exc
+
+        version = current_version(user_id)
+        user = principals.get(user_id, version)
+        if user is None:
+            if validated_token.get(VERSION_CLAIM) == version and all(
+                field in validated_token for field in CLAIM_FIELDS
+            ):
+                user = user_from_claims(user_id, validated_token)
+            else:
+                user = super().get_user(validated_token)
+            principals.put(user_id, version, user)
+
+        if user.is_blocked:
+            raise AuthenticationFailed('This user is blocked. Contact admin.', code='user_blocked')
+        # Each request gets its own copy, so deferred loads and attribute
+        # changes don't leak into the cached principal
+        return copy.copy(user)
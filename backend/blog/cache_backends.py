@@ -0,0 +1,22 @@
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+# =============================================================================
+# VERSION COUNTER CACHE
+# =============================================================================
+
+class VersionFileCache(FileBasedCache):
+    """
+    FileBasedCache that never evicts, for the version counters in blog.caching.
+
+    FileBasedCache culls by listing the whole cache directory on every set,
+    which costs ~16ms per bump at 10,000 files, and past MAX_ENTRIES it
+    deletes a random third of the files, resetting live version tokens along
+    with everything else. The keys stored here grow with the data, one or two
+    per post, user and category, rather than with traffic, so nothing needs
+    evicting: expired entries are still removed when read, and MAX_ENTRIES
+    is ignored.
+    """
+
+    def _cull(self):
+        pass
@@ -0,0 +1,240 @@
+import hashlib
+import threading
+import uuid
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from . import routers
+
+
+# =============================================================================
+# VERSION COUNTERS
+# =============================================================================
+
+# Cached responses are keyed by the versions of the resources they render.
+# Signal handlers bump a version whenever one of its rows changes, so entries
+# go stale exactly when their data does instead of after a TTL.
+FEED = 'feed'
+CATEGORIES = 'categories'
+
+
+def category_version(category_id):
+    return f'category:{category_id}'
+
+
+def post_version(post_id):
+    return f'post:{post_id}'
+
+
+def user_version(user_id):
+    return f'user:{user_id}'
+
+
+def _version_key(name):
+    return f'blog:version:{name}'
+
+
+def get_versions(names):
+    """Current token of every named version, creating missing ones."""
+    keys = {_version_key(name): name for name in names}
+    found = cache.get_many(list(keys))
+    versions = {}
+    for key, name in keys.items():
+        if key not in found:
+            cache.add(key, uuid.uuid4().hex, None)
+            found[key] = cache.get(key)
+        versions[name] = found[key]
+    return versions
+
+
+async def aget_versions(names):
+    """get_versions for async views."""
+    keys = {_version_key(name): name for name in names}
+    found = await cache.aget_many(list(keys))
+    versions = {}
+    for key, name in keys.items():
+        if key not in found:
+            await cache.aadd(key, uuid.uuid4().hex, None)
+            found[key] = await cache.aget(key)
+        versions[name] = found[key]
+    return versions
+
+
+def _fresh_key(name):
+    return f'blog:version-fresh:{name}'
+
+
+def bump(*names):
+    """Invalidate everything rendered from ``names`` once the transaction commits."""
+    names = {name for name in names if name}
+    if not names:
+        return
+
+    def publish():
+        cache.set_many({_version_key(name): uuid.uuid4().hex for name in names}, None)
+        if routers.replicas():
+            # The replicas may not have the change yet; see cache_anonymous_response
+            sticky = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+            cache.set_many({_fresh_key(name): 1 for name in names}, sticky)
+    transaction.on_commit(publish)
+
+
+def recently_bumped(names):
+    """Whether any of ``names`` was bumped within the last REPLICA_STICKY_SECONDS."""
+    return bool(routers.replicas() and cache.get_many([_fresh_key(name) for name in names]))
+
+
+async def arecently_bumped(names):
+    return bool(routers.replicas() and await cache.aget_many([_fresh_key(name) for name in names]))
+
+
+def bump_post(post_id, category_id=None):
+    bump(FEED, post_version(post_id), category_version(category_id) if category_id else None)
+
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+def local_cache():
+    """
+    The per-process cache for entries keyed by a version token or revision.
+    A stale process can't serve them past a bump, since the key changes, so
+    they stay out of the shared default cache and its round trips.
+    """
+    return caches['local']
+
+
+def _response_key(request, versions):
+    parts = [
+        request.get_host(),
+        request.path,
+        request.META.get('QUERY_STRING', ''),
+        request.META.get('HTTP_ACCEPT', ''),
+    ]
+    parts.extend(f'{name}={token}' for name, token in sorted(versions.items()))
+    return 'blog:response:' + hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def _not_modified(request, etag):
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in etags or '*' in etags
+
+
+def _cacheable(request):
+    return request.method == 'GET' and 'HTTP_AUTHORIZATION' not in request.META
+
+
+def _resource_names(resources, request, kwargs):
+    return [resource(request, **kwargs) if callable(resource) else resource for resource in resources]
+
+
+def _make_entry(response):
+    if response.status_code != 200 or response.streaming:
+        return None
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    return {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'etag': '"%s"' % hashlib.sha256(response.content).hexdigest()[:32],
+    }
+
+
+def _cached_response(request, entry):
+    if _not_modified(request, entry['etag']):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    response['ETag'] = entry['etag']
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ('Accept', 'Authorization'))
+    return response
+
+
+def cache_anonymous_response(*resources):
+    """
+    Cache successful GET responses for anonymous requests under the current
+    versions of ``resources``. Each resource is a version name, or a callable
+    taking the request and view kwargs and returning one.
+
+    Responses carry a strong ETag, and a matching If-None-Match on a cache
+    hit is answered with 304 without touching the database. A miss on a
+    resource bumped within REPLICA_STICKY_SECONDS is rendered from the
+    primary, so a lagging replica can't fill the new entry with old rows.
+    Works on both sync and async views.
+    """
+    def decorator(view):
+        timeout = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 3600)
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped(request, *args, **kwargs):
+                if not _cacheable(request):
+                    return await view(request, *args, **kwargs)
+                names = _resource_names(resources, request, kwargs)
+                key = _response_key(request, await aget_versions(names))
+                entry = await local_cache().aget(key)
+                if entry is None:
+                    if await arecently_bumped(names):
+                        routers.pin()
+                    response = await view(request, *args, **kwargs)
+                    entry = _make_entry(response)
+                    if entry is None:
+                        return response
+                    await local_cache().aset(key, entry, timeout)
+                return _cached_response(request, entry)
+            return wrapped
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not _cacheable(request):
+                return view(request, *args, **kwargs)
+            names = _resource_names(resources, request, kwargs)
+            key = _response_key(request, get_versions(names))
+            entry = local_cache().get(key)
+            if entry is None:
+                if recently_bumped(names):
+                    routers.pin()
+                response = view(request, *args, **kwargs)
+                entry = _make_entry(response)
+                if entry is None:
+                    return response
+                local_cache().set(key, entry, timeout)
+            return _cached_response(request, entry)
+        return wrapped
+    return decorator
+
+
+# =============================================================================
+# POST FRAGMENT CACHE
+# =============================================================================
+
+# PostSerializer caches the user-independent part of each post under its id
+# and revision; Post.revision is bumped whenever anything in it changes.
+_fragment_lock = threading.Lock()
+_fragment_stats = {'hits': 0, 'misses': 0}
+
+
+def fragment_key(post):
+    return f'blog:post-fragment:{post.pk}:{post.revision}'
+
+
+def record_fragment_lookups(hits=0, misses=0):
+    with _fragment_lock:
+        _fragment_stats['hits'] += hits
+        _fragment_stats['misses'] += misses
+
+
+def fragment_stats():
+    """Hit/miss counts of the post fragment cache in this process."""
+    with _fragment_lock:
+        return dict(_fragment_stats)
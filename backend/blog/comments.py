@@ -0,0 +1,46 @@
+from django.conf import settings
+
+from .models import Comment
+
+
+# =============================================================================
+# COMMENT THREADS
+# =============================================================================
+
+def get_max_depth(value=None, default=0):
+    """Parse a ``max_depth`` query param; COMMENT_MAX_DEPTH caps the result."""
+    limit = getattr(settings, 'COMMENT_MAX_DEPTH', None)
+    try:
+        depth = max(int(value), 0)
+    except (TypeError, ValueError):
+        depth = default
+    if depth is None:
+        return limit
+    return depth if limit is None else min(depth, limit)
+
+
+def attach_replies(comments, max_depth=0):
+    """
+    Load the replies below ``comments`` up to ``max_depth`` levels deep.
+
+    Each comment gets a ``loaded_replies`` list that CommentSerializer uses
+    instead of querying ``comment.replies``. Costs one query per level, no
+    matter how many comments are on each level. ``max_depth=None`` follows
+    the thread all the way down.
+    """
+    level = list(comments)
+    for comment in level:
+        comment.loaded_replies = []
+    depth = 0
+    while level and (max_depth is None or depth < max_depth):
+        by_id = {comment.id: comment for comment in level}
+        level = list(
+            Comment.objects.filter(parent_id__in=by_id)
+            .select_related('user')
+            .order_by('-created_at', '-id')
+        )
+        for reply in level:
+            reply.loaded_replies = []
+            by_id[reply.parent_id].loaded_replies.append(reply)
+        depth += 1
+    return comments
@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+
+from . import caching
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# POST IMAGE VARIANTS
+# =============================================================================
+
+# Every uploaded post image is re-encoded into a few fixed widths, each as
+# WebP and JPEG, with EXIF orientation applied and all metadata dropped. The
+# originals are kept untouched; Post.image_variants maps each variant to its
+# files and PostSerializer exposes them as ``srcset``. Rendering happens in a
+# small thread pool after the saving transaction commits (Pillow releases the
+# GIL while decoding, resizing and encoding), so uploads don't wait for it.
+#
+# Variant names derive from the source name, width and quality, so posts
+# sharing a stored image share its variants and a name never changes
+# content. They are deleted together with their source (see blog.media).
+VARIANT_DIR = 'posts/variants'
+
+# format -> (Pillow format, file extension, save options)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+}
+
+
+def variant_widths():
+    return getattr(settings, 'IMAGE_VARIANT_WIDTHS', {'thumb': 320, 'card': 768, 'full': 1600})
+
+
+def quality(fmt):
+    return getattr(settings, 'IMAGE_QUALITY', {}).get(fmt, 80)
+
+
+def variant_prefix(source_name):
+    """Start of the file name of every variant of ``source_name``."""
+    stem = posixpath.splitext(posixpath.basename(source_name))[0]
+    digest = hashlib.sha256(source_name.encode()).hexdigest()[:12]
+    return f'{stem}-{digest}-'
+
+
+def variant_name(source_name, variant, fmt):
+    """Storage name of one variant file of ``source_name``."""
+    width = variant_widths()[variant]
+    return f'{VARIANT_DIR}/{variant_prefix(source_name)}{variant}-{width}-q{quality(fmt)}.{FORMATS[fmt][1]}'
+
+
+def variant_files(variants):
+    return [info[fmt] for info in (variants or {}).values() for fmt in FORMATS if info.get(fmt)]
+
+
+def _open(source_name, max_width):
+    with Post._meta.get_field('image').storage.open(source_name, 'rb') as source:
+        image = Image.open(source)
+        # Let the JPEG decoder skip straight to a power-of-two reduction that
+        # still covers the largest width either way round (EXIF may rotate it)
+        image.draft('RGB', (max_width, max_width))
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _save(image, name, fmt):
+    pillow_format, _, options = FORMATS[fmt]
+    buffer = BytesIO()
+    # No exif/icc_profile passed, so nothing from the upload is carried over
+    image.save(buffer, pillow_format, quality=quality(fmt), **options)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def render_variants(source_name):
+    """
+    Write every variant of the stored image ``source_name`` and return the
+    ``{variant: {'width', 'height', 'webp', 'jpeg'}}`` map. Images are never
+    upscaled, so a small original yields variants of its own width.
+    """
+    widths = sorted(variant_widths().items(), key=lambda item: item[1], reverse=True)
+    image = _open(source_name, widths[0][1])
+    variants = {}
+    # Largest first, each one downscaled from the previous
+    for variant, width in widths:
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        variants[variant] = {'width': image.width, 'height': image.height}
+        for fmt in FORMATS:
+            variants[variant][fmt] = _save(image, variant_name(source_name, variant, fmt), fmt)
+    return variants
+
+
+def delete_files(names):
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except OSError:
+            logger.warning('Could not delete image variant %s', name, exc_info=True)
+
+
+def delete_variants(source_name):
+    """Delete every variant file ever rendered from ``source_name``."""
+    prefix = variant_prefix(source_name)
+    try:
+        _, files = default_storage.listdir(VARIANT_DIR)
+    except FileNotFoundError:
+        return
+    delete_files(f'{VARIANT_DIR}/{name}' for name in files if name.startswith(prefix))
+
+
+def shared_variants(source_name, post_id):
+    """Current variants already rendered for another post with the same image."""
+    expected = {variant_name(source_name, variant, fmt) for variant in variant_widths() for fmt in FORMATS}
+    others = Post.objects.filter(image=source_name).exclude(pk=post_id).exclude(image_variants={})
+    for variants in others.values_list('image_variants', flat=True):
+        if set(variant_files(variants)) == expected:
+            return variants
+    return None
+
+
+def process_post(post_id):
+    """
+    Render the variants of post ``post_id``'s current image and store them.
+    Returns the variants, or None if the post is gone or has no image.
+    """
+    row = Post.objects.filter(pk=post_id).values_list('image', 'category_id').first()
+    if row is None or not row[0]:
+        return None
+    source_name, category_id = row
+    variants = shared_variants(source_name, post_id) or render_variants(source_name)
+    # Only store them if the image wasn't replaced while we were rendering
+    if not Post.objects.filter(pk=post_id, image=source_name).update(image_variants=variants):
+        return None
+    caching.bump_post(post_id, category_id)
+    return variants
+
+
+# -------------------- Worker pool --------------------
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'IMAGE_WORKERS', 2), thread_name_prefix='post-images'
+            )
+        return _executor
+
+
+def _run(post_id):
+    close_old_connections()
+    try:
+        process_post(post_id)
+    except Exception:
+        # The post keeps being served with its original image
+        logger.exception('Could not render image variants of post %s', post_id)
+    finally:
+        close_old_connections()
+
+
+def schedule(post_id):
+    """Render the post's variants in the worker pool once the transaction commits."""
+    if getattr(settings, 'IMAGE_WORKERS', 2) <= 0:
+        transaction.on_commit(lambda: _run(post_id))
+    else:
+        transaction.on_commit(lambda: _get_executor().submit(_run, post_id))
+
@@ -0,0 +1,105 @@
+import hashlib
+import os
+
+from django.core.management.base import BaseCommand
+
+from blog import caching, images, media
+from blog.media import UPLOAD_DIR
+from blog.models import Post
+from blog.storage import content_name, is_content_addressed
+
+
+class Command(BaseCommand):
+    help = (
+        'Move post images to content-addressed names, merging duplicate files, '
+        'recount their references and delete the ones no post uses. Run it periodically: '
+        'unused files still within MEDIA_ORPHAN_GRACE_SECONDS are left for the next run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing.')
+        parser.add_argument(
+            '--keep-orphans', action='store_true',
+            help='Move files no post uses to content-addressed names instead of deleting them.',
+        )
+
+    def handle(self, *args, **options):
+        storage = media.storage()
+        dry_run = options['dry_run']
+        before = self._disk_usage(storage)
+
+        moved = orphans = 0
+        targets, kept = {}, set()
+        for name in media.stored_names():
+            if is_content_addressed(name):
+                continue
+            used = Post.objects.filter(image=name).exists()
+            if not used and not options['keep_orphans']:
+                if dry_run or media.collect(name):
+                    orphans += 1
+                else:
+                    kept.add(name)
+                continue
+            moved += 1
+            if dry_run:
+                targets[name] = self._content_name(storage, name)
+                continue
+            with storage.open(name, 'rb') as source:
+                targets[name] = storage.save(name, source)
+            self._repoint(name, targets[name])
+            storage.delete(name)
+            images.delete_variants(name)
+
+        if dry_run:
+            if not options['keep_orphans']:
+                # Other unused names were counted above
+                orphans += sum(1 for name in media.unused_names() if is_content_addressed(name))
+            self.stdout.write(
+                f'Would move {moved} file(s) into {len(set(targets.values()))} content-addressed name(s) '
+                f'and delete {orphans} unused file(s).'
+            )
+            return
+
+        if options['keep_orphans']:
+            media.rebuild_references()
+        else:
+            deleted, recent = media.collect_orphans()
+            orphans += deleted
+            kept.update(recent)
+        self._render(targets.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {moved} file(s) into {len(set(targets.values()))} content-addressed name(s) '
+            f'and deleted {orphans} unused file(s); {UPLOAD_DIR}/ went from {before} to '
+            f'{self._disk_usage(storage)} bytes.'
+        ))
+        if kept:
+            self.stdout.write(f'Kept {len(kept)} unused file(s) written too recently to delete; run again later.')
+
+    def _repoint(self, old, new):
+        posts = Post.objects.filter(image=old)
+        names = []
+        for post_id, category_id in posts.values_list('id', 'category_id'):
+            names += [caching.post_version(post_id), caching.category_version(category_id)]
+        posts.update(image=new, image_variants={})
+        caching.bump(caching.FEED, *names)
+
+    def _render(self, names):
+        # Once per stored file; the other posts using it reuse its variants
+        for post_id in Post.objects.filter(image__in=set(names)).order_by('pk').values_list('pk', flat=True):
+            try:
+                images.process_post(post_id)
+            except Exception:
+                images.logger.exception('Could not render image variants of post %s', post_id)
+
+    def _content_name(self, storage, name):
+        digest = hashlib.sha256()
+        with storage.open(name, 'rb') as source:
+            for chunk in source.chunks():
+                digest.update(chunk)
+        return content_name(UPLOAD_DIR, digest.hexdigest(), name)
+
+    def _disk_usage(self, storage):
+        total = 0
+        for root, _, files in os.walk(storage.path(UPLOAD_DIR)):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        return total
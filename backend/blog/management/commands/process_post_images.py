@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from blog import images
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Render the resized image variants of posts that are missing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Re-render posts that already have variants.')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'IMAGE_WORKERS', 2) or 1)
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(image='').order_by('pk')
+        if not options['all']:
+            posts = posts.filter(image_variants={})
+        post_ids = list(posts.values_list('pk', flat=True))
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            results = list(executor.map(self._process, post_ids))
+
+        failed = results.count(False)
+        self.stdout.write(self.style.SUCCESS(f'Rendered images of {len(post_ids) - failed} post(s).'))
+        if failed:
+            self.stderr.write(self.style.WARNING(f'{failed} post(s) failed, see the log.'))
+
+    def _process(self, post_id):
+        try:
+            images.process_post(post_id)
+            return True
+        except Exception:
+            images.logger.exception('Could not render image variants of post %s', post_id)
+            return False
+        finally:
+            close_old_connections()
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from blog import caching
+from blog.models import Comment
+
+
+class Command(BaseCommand):
+    help = 'Backfill Comment.reply_count from the direct replies of each comment.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without writing.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        counts = dict(
+            Comment.objects.filter(parent__isnull=False).order_by()
+            .values('parent_id').annotate(replies=Count('id')).values_list('parent_id', 'replies')
+        )
+
+        drifted = []
+        fixed = 0
+        rows = Comment.objects.order_by().values_list('id', 'reply_count', 'post_id')
+        for comment_id, reply_count, post_id in rows.iterator(chunk_size=batch_size):
+            expected = counts.get(comment_id, 0)
+            if reply_count == expected:
+                continue
+            drifted.append(Comment(id=comment_id, reply_count=expected, post_id=post_id))
+            if len(drifted) >= batch_size:
+                fixed += self._flush(drifted, options['dry_run'])
+        fixed += self._flush(drifted, options['dry_run'])
+
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {fixed} comment(s) with a drifted reply count.'))
+
+    def _flush(self, drifted, dry_run):
+        count = len(drifted)
+        if count and not dry_run:
+            Comment.objects.bulk_update(drifted, ['reply_count'])
+            # bulk_update sends no signals, so invalidate the cached comment lists here
+            caching.bump(*{caching.post_version(comment.post_id) for comment in drifted})
+        drifted.clear()
+        return count
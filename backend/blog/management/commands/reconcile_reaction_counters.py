@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from blog import caching
+from blog.models import Post, PostLike
+
+
+class Command(BaseCommand):
+    help = 'Rebuild Post.likes/Post.dislikes from PostLike rows to repair counter drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without writing.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        counts = {
+            row['post_id']: (row['like_count'], row['dislike_count'])
+            for row in PostLike.objects.order_by().values('post_id').annotate(
+                like_count=Count('id', filter=Q(is_like=True)),
+                dislike_count=Count('id', filter=Q(is_like=False)),
+            )
+        }
+
+        drifted = []
+        fixed = 0
+        rows = Post.objects.order_by().values_list('id', 'likes', 'dislikes', 'category_id')
+        for post_id, likes, dislikes, category_id in rows.iterator(chunk_size=batch_size):
+            expected = counts.get(post_id, (0, 0))
+            if (likes, dislikes) == expected:
+                continue
+            drifted.append(Post(id=post_id, likes=expected[0], dislikes=expected[1], category_id=category_id))
+            if len(drifted) >= batch_size:
+                fixed += self._flush(drifted, options['dry_run'])
+        fixed += self._flush(drifted, options['dry_run'])
+
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {fixed} post(s) with drifted reaction counters.'))
+
+    def _flush(self, drifted, dry_run):
+        count = len(drifted)
+        if count and not dry_run:
+            Post.objects.bulk_update(drifted, ['likes', 'dislikes'])
+            # bulk_update sends no signals, so invalidate the cached responses here
+            names = [caching.FEED]
+            for post in drifted:
+                names += [caching.post_version(post.pk), caching.category_version(post.category_id)]
+            caching.bump(*names)
+        drifted.clear()
+        return count
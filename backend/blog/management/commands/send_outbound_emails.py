@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from blog.outbox import build_digests, run_notification_jobs, send_batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Fan out new-post notifications, roll up due digests and deliver queued '
+        'OutboundEmail rows. Runs until interrupted unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit.')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument(
+            '--interval', type=float,
+            default=getattr(settings, 'EMAIL_OUTBOX_POLL_SECONDS', 5),
+            help='Seconds to sleep when the outbox is empty.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            notified = run_notification_jobs()
+            digests = build_digests()
+            if notified or digests:
+                self.stdout.write(f'Notified {notified} subscription(s), queued {digests} digest(s).')
+            total_sent = total_failed = 0
+            connection = get_connection()
+            try:
+                while True:
+                    sent, failed = send_batch(options['batch_size'], connection=connection)
+                    total_sent += sent
+                    total_failed += failed
+                    if not sent:
+                        break
+            finally:
+                connection.close()
+            if total_sent or total_failed:
+                self.stdout.write(f'Sent {total_sent} email(s), {total_failed} failed.')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.test import Client, override_settings
+
+from blog import reactions
+from blog.models import Category, Post, User
+from blog.serializers import CustomTokenObtainPairSerializer
+from blog.sqlite import is_locked_error
+
+PREFIX = 'sqlite-load-test'
+
+
+def _create_user(name):
+    return User.objects.create_user(username=name, email=f'{name}@example.invalid', password=name)
+
+
+def _worker(args):
+    index, user_id, post_id, writes, baseline = args
+    connection = connections[DEFAULT_DB_ALIAS]
+    if baseline:
+        # Django's stock SQLite setup: no pragmas, deferred transactions
+        connection.settings_dict['OPTIONS'] = {}
+    user = User.objects.get(pk=user_id)
+    token = CustomTokenObtainPairSerializer.get_token(user).access_token
+    client = Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def send(n):
+        # Mostly reactions and comments; signups are rarer, and slow because
+        # of password hashing
+        if n % 10 == 9:
+            return Client().post('/signup/', {
+                'username': f'{PREFIX}-{index}-{n}', 'email': f'{PREFIX}-{index}-{n}@example.invalid',
+                'password': 'load-test-pw', 'password_confirm': 'load-test-pw',
+            })
+        if n % 2:
+            return client.post(f'/posts/{post_id}/comments/', {'content': f'load test comment {n}'})
+        return client.post(f'/posts/{post_id}/react/', {'action': reactions.LIKE})
+
+    # Replicas would serve rows from the real database, not the copy
+    overrides = {'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'], 'DATABASE_REPLICAS': []}
+    if baseline:
+        overrides['SQLITE_WRITE_RETRIES'] = 1
+    latencies, errors = [], 0
+    with override_settings(**overrides):
+        for n in range(writes):
+            start = time.perf_counter()
+            try:
+                response = send(n)
+                if response.status_code >= 400:
+                    errors += 1
+            except OperationalError as exc:
+                if not is_locked_error(exc):
+                    raise
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+    connection.close()
+    return latencies, errors
+
+
+class Command(BaseCommand):
+    help = (
+        'Send concurrent reactions, comments and signups from several processes to a temporary '
+        'copy of the SQLite database and report the error rate and latency. The real database is '
+        'only read, to make the copy.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=100, help='Requests per process.')
+        parser.add_argument(
+            '--baseline', action='store_true',
+            help="Use Django's stock SQLite settings (rollback journal, deferred transactions, no retries) "
+                 'to compare against.',
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite.')
+        if connection.is_in_memory_db():
+            raise CommandError('The default database is in memory; worker processes cannot share it.')
+
+        original = connection.settings_dict['NAME']
+        directory = tempfile.mkdtemp(prefix=f'{PREFIX}-')
+        copy = os.path.join(directory, 'db.sqlite3')
+        source, target = sqlite3.connect(str(original)), sqlite3.connect(copy)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+        connections.close_all()
+        connection.settings_dict['NAME'] = copy
+        try:
+            jobs, results, elapsed = self.load(connection, options)
+        finally:
+            connections.close_all()
+            connection.settings_dict['NAME'] = original
+            shutil.rmtree(directory, ignore_errors=True)
+
+        latencies = sorted(latency for process_latencies, _ in results for latency in process_latencies)
+        errors = sum(process_errors for _, process_errors in results)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f'{len(jobs)} processes, {len(latencies)} requests in {elapsed:.1f}s: '
+            f'errors={errors} ({errors / len(latencies):.1%}), '
+            f'p50={statistics.median(latencies):.0f}ms, p99={p99:.0f}ms'
+        )
+
+    def load(self, connection, options):
+        author = _create_user(PREFIX)
+        category = Category.objects.create(name=PREFIX)
+        post = Post.objects.create(title='Load test', content='Load test', author=author, category=category)
+        users = [_create_user(f'{PREFIX}-{n}') for n in range(options['processes'])]
+        if options['baseline']:
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=DELETE')
+        # Every process must open its own connection
+        connections.close_all()
+
+        jobs = [(n, user.pk, post.pk, options['writes'], options['baseline']) for n, user in enumerate(users)]
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(len(jobs)) as pool:
+            results = pool.map(_worker, jobs)
+        return jobs, results, time.perf_counter() - start
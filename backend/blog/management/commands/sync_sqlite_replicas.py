@@ -0,0 +1,46 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from blog.routers import replicas
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the primary SQLite database into every SQLite alias in DATABASE_REPLICAS. '
+        'Stands in for real replication when trying out read replicas locally.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Keep syncing every INTERVAL seconds instead of once, to simulate replication lag.',
+        )
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS].settings_dict
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('The primary database is not SQLite.')
+        aliases = [alias for alias in replicas() if connections[alias].settings_dict['ENGINE'] == primary['ENGINE']]
+        if not aliases:
+            raise CommandError('DATABASE_REPLICAS has no SQLite aliases.')
+
+        while True:
+            for alias in aliases:
+                self.sync(str(primary['NAME']), str(connections[alias].settings_dict['NAME']))
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Synced {", ".join(aliases)}.')
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
+
+    def sync(self, source_path, target_path):
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
@@ -0,0 +1,131 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import images
+from .models import Post, StoredFile
+from .storage import is_content_addressed
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# STORED FILE REFERENCES
+# =============================================================================
+
+# Post images live in blog.storage.ContentAddressedStorage, where identical
+# uploads share one file. StoredFile counts the posts using each file; the
+# signals in blog.signals acquire a reference when a post gets an image and
+# release it when the post is re-imaged or deleted, and the last release
+# deletes the file together with its variants.
+
+UPLOAD_DIR = Post._meta.get_field('image').upload_to.rstrip('/')
+
+
+def storage():
+    return Post._meta.get_field('image').storage
+
+
+def grace_period():
+    """How recently a file may have been written and still be collected."""
+    return timedelta(seconds=getattr(settings, 'MEDIA_ORPHAN_GRACE_SECONDS', 300))
+
+
+def acquire(name):
+    if StoredFile.objects.filter(name=name).update(references=F('references') + 1):
+        return
+    StoredFile.objects.get_or_create(name=name, defaults={'size': _size(name)})
+    StoredFile.objects.filter(name=name).update(references=F('references') + 1)
+
+
+def release(name):
+    """Drop one reference to ``name`` and collect it once the transaction commits."""
+    StoredFile.objects.filter(name=name, references__gt=0).update(references=F('references') - 1)
+    transaction.on_commit(lambda: collect(name))
+
+
+def collect(name):
+    """
+    Delete ``name`` and its variants if no post uses it any more. Files
+    written within the grace period are kept: an upload of the same content
+    may be about to reference them. Returns whether the file was deleted.
+    """
+    try:
+        if storage().get_modified_time(name) > timezone.now() - grace_period():
+            return False
+    except FileNotFoundError:
+        pass
+    with transaction.atomic():
+        deleted, _ = StoredFile.objects.filter(name=name, references=0).delete()
+        # Files stored before reference counting have no row
+        if not deleted and (
+            StoredFile.objects.filter(name=name).exists() or Post.objects.filter(image=name).exists()
+        ):
+            return False
+    storage().delete(name)
+    images.delete_variants(name)
+    return True
+
+
+def rebuild_references():
+    """Recount StoredFile.references from Post; returns the names nothing uses."""
+    counts = dict(
+        Post.objects.exclude(image='').order_by().values('image').annotate(count=Count('id'))
+        .values_list('image', 'count')
+    )
+    for name, count in counts.items():
+        StoredFile.objects.get_or_create(name=name, defaults={'size': _size(name)})
+    for stored in StoredFile.objects.all():
+        references = counts.get(stored.name, 0)
+        if stored.references != references:
+            StoredFile.objects.filter(pk=stored.pk).update(references=references)
+    return list(StoredFile.objects.filter(references=0).values_list('name', flat=True))
+
+
+def stored_names():
+    """Every original image in the upload directory, variants and temp files aside."""
+    try:
+        _, files = storage().listdir(UPLOAD_DIR)
+    except FileNotFoundError:
+        return []
+    return [f'{UPLOAD_DIR}/{name}' for name in sorted(files) if not name.startswith('.')]
+
+
+def unused_names():
+    """
+    Content-addressed files and StoredFile rows no post uses: files release()
+    couldn't collect yet because they were inside the grace period, and
+    uploads whose post was never saved, which have no row at all.
+    """
+    used = set(Post.objects.exclude(image='').values_list('image', flat=True))
+    names = set(StoredFile.objects.values_list('name', flat=True))
+    names.update(name for name in stored_names() if is_content_addressed(name))
+    return sorted(names - used)
+
+
+def collect_orphans():
+    """
+    Recount references and collect every unused file. collect() never
+    retries the files it keeps for the grace period, so this has to run
+    periodically (dedupe_media does). Returns the number of files deleted
+    and the names of the unused files kept for a later run.
+    """
+    rebuild_references()
+    deleted, kept = 0, []
+    for name in unused_names():
+        if collect(name):
+            deleted += 1
+        else:
+            kept.append(name)
+    return deleted, kept
+
+
+def _size(name):
+    try:
+        return storage().size(name)
+    except OSError:
+        return 0
@@ -0,0 +1,322 @@
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import caching
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# REQUEST METRICS
+# =============================================================================
+
+# MetricsMiddleware records, per view (the resolved URL name), method and
+# status class: request count, a latency histogram, a histogram of SQL
+# queries per request, SQL time and response bytes. Every thread aggregates
+# into its own series, so recording a request takes no lock; /metrics merges
+# them. With METRICS_DIR set, each process also writes its totals there
+# every METRICS_FLUSH_SECONDS and /metrics sums the files of all processes,
+# which is what makes it work under a multi-process gunicorn. Empty the
+# directory when deploying, like prometheus_client's multiprocess mode.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# SQL activity of the request being handled
+_request = ContextVar('blog_request_metrics', default=None)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'sql_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.sql_seconds += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Installed on the connection itself rather than around each request,
+    # so queries run in sync_to_async threads by async views are counted
+    # too: the request's RequestStats travels with the context
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+for _connection in connections.all(initialized_only=True):
+    instrument_connection(None, _connection)
+
+
+# -------------------- Aggregation --------------------
+# A series is a flat list of floats:
+#   [count, duration sum, queries, SQL seconds, bytes,
+#    one count per latency bucket, one count per query bucket]
+_SUMS = 5
+_SERIES_SIZE = _SUMS + len(LATENCY_BUCKETS) + len(QUERY_BUCKETS)
+
+_local = threading.local()
+_registry = []
+_registry_lock = threading.Lock()
+_process = {'pid': None, 'id': None}
+_last_flush = 0.0
+
+
+def _thread_series():
+    series = getattr(_local, 'series', None)
+    if series is None:
+        series = _local.series = {}
+        with _registry_lock:
+            _registry.append(series)
+    return series
+
+
+def record(labels, seconds, stats, size):
+    series = _thread_series()
+    values = series.get(labels)
+    if values is None:
+        values = series[labels] = [0.0] * _SERIES_SIZE
+    values[0] += 1
+    values[1] += seconds
+    values[2] += stats.queries
+    values[3] += stats.sql_seconds
+    values[4] += size
+    # Buckets are stored non-cumulative and summed up when rendering;
+    # values above the last bound only count towards +Inf
+    bucket = bisect_left(LATENCY_BUCKETS, seconds)
+    if bucket < len(LATENCY_BUCKETS):
+        values[_SUMS + bucket] += 1
+    bucket = bisect_left(QUERY_BUCKETS, stats.queries)
+    if bucket < len(QUERY_BUCKETS):
+        values[_SUMS + len(LATENCY_BUCKETS) + bucket] += 1
+
+
+def _merge(into, labels, values):
+    total = into.get(labels)
+    if total is None:
+        into[labels] = list(values)
+    else:
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def process_snapshot():
+    """This process's totals, merged across its threads."""
+    merged = {}
+    with _registry_lock:
+        registry = list(_registry)
+    for series in registry:
+        for labels, values in list(series.items()):
+            _merge(merged, labels, values)
+    fragments = caching.fragment_stats()
+    return {
+        'series': [[list(labels), values] for labels, values in merged.items()],
+        'fragment_hits': fragments['hits'],
+        'fragment_misses': fragments['misses'],
+    }
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+
+def _process_file():
+    # Worked out after forking: with --preload, gunicorn workers import this
+    # module in the master process
+    if _process['pid'] != os.getpid():
+        _process.update(pid=os.getpid(), id=f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+    return os.path.join(metrics_dir(), f'{_process["id"]}.json')
+
+
+def flush(force=False):
+    """Write this process's totals to METRICS_DIR, at most every METRICS_FLUSH_SECONDS."""
+    global _last_flush
+    directory = metrics_dir()
+    now = time.monotonic()
+    if not directory or (not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_SECONDS', 5)):
+        return
+    _last_flush = now
+    path = _process_file()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(process_snapshot(), file)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        logger.warning('Could not write request metrics to %s', path, exc_info=True)
+
+
+def collect():
+    """Totals of every process writing to METRICS_DIR, or of this one alone."""
+    directory = metrics_dir()
+    if not directory:
+        snapshots = [process_snapshot()]
+    else:
+        flush(force=True)
+        snapshots = []
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(directory, name)) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+    merged, totals = {}, {'fragment_hits': 0, 'fragment_misses': 0}
+    for snapshot in snapshots:
+        for labels, values in snapshot['series']:
+            _merge(merged, tuple(labels), values)
+        for key in totals:
+            totals[key] += snapshot.get(key, 0)
+    return merged, totals
+
+
+# -------------------- Prometheus exposition --------------------
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels, **extra):
+    view, method, status = labels
+    pairs = {'view': view, 'method': method, 'status': status, **extra}
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs.items()) + '}'
+
+
+def _histogram(lines, name, help_text, merged, offset, buckets, sum_index):
+    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for labels, values in sorted(merged.items()):
+        cumulative = 0
+        for i, bound in enumerate(buckets):
+            cumulative += values[offset + i]
+            lines.append(f'{name}_bucket{_label_text(labels, le=bound)} {_number(cumulative)}')
+        lines.append(f'{name}_bucket{_label_text(labels, le="+Inf")} {_number(values[0])}')
+        lines.append(f'{name}_sum{_label_text(labels)} {_number(values[sum_index])}')
+        lines.append(f'{name}_count{_label_text(labels)} {_number(values[0])}')
+
+
+def render_prometheus():
+    merged, totals = collect()
+    lines = []
+    _histogram(
+        lines, 'blog_http_request_duration_seconds', 'Time spent handling requests.',
+        merged, _SUMS, LATENCY_BUCKETS, 1,
+    )
+    _histogram(
+        lines, 'blog_http_request_sql_queries', 'SQL queries run per request.',
+        merged, _SUMS + len(LATENCY_BUCKETS), QUERY_BUCKETS, 2,
+    )
+    for name, help_text, index in (
+        ('blog_http_sql_seconds_total', 'Time spent in SQL queries.', 3),
+        ('blog_http_response_bytes_total', 'Response body bytes sent.', 4),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        lines += [f'{name}{_label_text(labels)} {_number(values[index])}' for labels, values in sorted(merged.items())]
+    for kind in ('hits', 'misses'):
+        name = f'blog_post_fragment_cache_{kind}_total'
+        lines += [f'# TYPE {name} counter', f'{name} {totals[f"fragment_{kind}"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def _allowed(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        return hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+
+
+def metrics_view(request):
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# -------------------- Middleware --------------------
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is not None:
+        return match.view_name
+    if request.path.startswith(settings.MEDIA_URL):
+        return 'media'
+    return 'unresolved'
+
+
+def response_size(response):
+    if not response.streaming:
+        return len(response.content)
+    return int(response.get('Content-Length') or 0)
+
+
+class MetricsMiddleware:
+    """
+    Time each request and count its SQL queries (see the top of this
+    module). With METRICS_SERVER_TIMING on, responses carry the totals in a
+    Server-Timing header for the browser's network panel.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, stats)
+
+    def finish(self, request, response, seconds, stats):
+        labels = (view_label(request), request.method, f'{response.status_code // 100}xx')
+        record(labels, seconds, stats, response_size(response))
+        if getattr(settings, 'METRICS_SERVER_TIMING', False):
+            response['Server-Timing'] = (
+                f'app;dur={seconds * 1000:.1f}, '
+                f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.queries} queries"'
+            )
+        flush()
+        return response
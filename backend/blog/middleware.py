@@ -0,0 +1,68 @@
+import hashlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+
+from . import routers
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Sets up per-request database routing (see blog/routers.py).
+
+    A client that wrote something stays on the primary for
+    REPLICA_STICKY_SECONDS afterwards, so a freshly posted comment or
+    reaction is visible on the next read even if the replicas lag. Clients
+    are told apart by their Authorization header, or their address when
+    they have none. Views marked with ``use_primary`` or named in
+    DATABASE_PRIMARY_URL_NAMES always read from the primary.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not routers.replicas():
+            return self.get_response(request)
+
+        key = self.sticky_key(request)
+        token = routers.begin(pinned=cache.get(key) is not None)
+        try:
+            response = self.get_response(request)
+            if routers.current().wrote:
+                cache.set(key, 1, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        finally:
+            routers.end(token)
+        return response
+
+    async def __acall__(self, request):
+        if not routers.replicas():
+            return await self.get_response(request)
+
+        key = self.sticky_key(request)
+        token = routers.begin(pinned=await cache.aget(key) is not None)
+        try:
+            response = await self.get_response(request)
+            if routers.current().wrote:
+                await cache.aset(key, 1, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        finally:
+            routers.end(token)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = getattr(request.resolver_match, 'url_name', None)
+        if getattr(view_func, 'use_primary_db', False) or url_name in getattr(settings, 'DATABASE_PRIMARY_URL_NAMES', ()):
+            routers.pin()
+
+    def sticky_key(self, request):
+        client = request.META.get('HTTP_AUTHORIZATION') or request.META.get('REMOTE_ADDR', '')
+        return 'blog:db-sticky:' + hashlib.sha256(client.encode()).hexdigest()
@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 
+from . import caching
+from .moderation import censor
+from .storage import post_image_storage
+
 
 # =============================================================================
 # USER MODELS
@@ -48,11 +52,15 @@ class Tag(models.Model):
 class Post(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
-    image = models.ImageField(upload_to='posts/', blank=True)
+    image = models.ImageField(upload_to='posts/', storage=post_image_storage, blank=True)
+    # Resized copies of ``image``, filled in by blog.images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     likes = models.IntegerField(default=0)
     dislikes = models.IntegerField(default=0)
     publish_date = models.DateTimeField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
+    # Bumped whenever the cached representation of the post goes stale
+    revision = models.PositiveIntegerField(default=0, editable=False)
     
     # Relationships
     author = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -67,15 +75,63 @@ class Post(models.Model):
         if self.dislikes > 10:
             self.delete()
             return
+        # Bump in the database: the in-memory revision may predate a
+        # bump_revisions() made since this instance was loaded
+        adding = self._state.adding
+        self.revision = 1 if adding else models.F('revision') + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'revision'}
         super().save(*args, **kwargs)
+        if not adding:
+            self.refresh_from_db(fields=['revision'])
+
+    @classmethod
+    def bump_revisions(cls, **filters):
+        """Invalidate the cached representation of every post matching ``filters``."""
+        cls.objects.filter(**filters).update(revision=models.F('revision') + 1)
+
+    def adjust_reactions(self, likes=0, dislikes=0):
+        """
+        Atomically shift the reaction counters and apply the auto-delete rule.
+        Returns the new (likes, dislikes), or None if nothing was updated.
+        """
+        if not likes and not dislikes:
+            return None
+        connection = connections[router.db_for_write(Post, instance=self)]
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {qn(self._meta.db_table)} '
+                f'SET {qn("likes")} = {qn("likes")} + %s, {qn("dislikes")} = {qn("dislikes")} + %s '
+                f'WHERE {qn("id")} = %s RETURNING {qn("likes")}, {qn("dislikes")}, {qn("category_id")}, {qn("image")}',
+                [likes, dislikes, self.pk],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        # The image too: reaction paths pass a bare Post(pk=...), and the
+        # auto-delete below must release the right file
+        self.likes, self.dislikes, self.category_id, self.image = row
+        caching.bump_post(self.pk, self.category_id)
+        # Auto-delete if dislikes > 10
+        if self.dislikes > 10:
+            self.delete()
+        return self.likes, self.dislikes
     
     class Meta:
         ordering = ['-publish_date']
+        indexes = [
+            # Keyset pagination of the global and per-category feeds
+            models.Index(fields=['publish_date', 'id'], name='post_feed_idx'),
+            models.Index(fields=['category', 'publish_date', 'id'], name='post_category_feed_idx'),
+        ]
 
 
 class Comment(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    reply_count = models.PositiveIntegerField(default=0)
     
     # Relationships
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -87,14 +143,15 @@ class Comment(models.Model):
     
     def save(self, *args, **kwargs):
         # Filter forbidden words
-        forbidden_words = ForbiddenWord.objects.values_list('word', flat=True)
-        for word in forbidden_words:
-            if word.lower() in self.content.lower():
-                self.content = self.content.replace(word, '*' * len(word))
+        self.content = censor(self.content)
         super().save(*args, **kwargs)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of top-level comments and of a comment's replies
+            models.Index(fields=['post', 'parent', '-created_at'], name='comment_thread_idx'),
+        ]
 
 
 # =============================================================================
@@ -102,8 +159,18 @@ class Comment(models.Model):
 # =============================================================================
 
 class Subscription(models.Model):
+    IMMEDIATE = 'immediate'
+    HOURLY = 'hourly'
+    DAILY = 'daily'
+    DIGEST_CHOICES = [
+        (IMMEDIATE, 'One email per post'),
+        (HOURLY, 'Hourly digest'),
+        (DAILY, 'Daily digest'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=10, choices=DIGEST_CHOICES, default=IMMEDIATE)
     
     def __str__(self):
         return f'{self.user.username} -> {self.category.name}'
@@ -116,29 +183,160 @@ class PostLike(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     is_like = models.BooleanField()  # True = like, False = dislike
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Reaction as stored in the database, used to compute counter deltas
+        self._stored_is_like = self.__dict__.get('is_like') if self.pk else None
     
     def __str__(self):
         action = "liked" if self.is_like else "disliked"
         return f'{self.user.username} {action} {self.post.title}'
     
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Update post counters
-        self.post.likes = PostLike.objects.filter(post=self.post, is_like=True).count()
-        self.post.dislikes = PostLike.objects.filter(post=self.post, is_like=False).count()
-        self.post.save()
+        with transaction.atomic(using=router.db_for_write(PostLike, instance=self)):
+            super().save(*args, **kwargs)
+            # Update post counters
+            likes, dislikes = self.reaction_delta(self._stored_is_like, self.is_like)
+            self.post.adjust_reactions(likes=likes, dislikes=dislikes)
+        self._stored_is_like = self.is_like
 
     def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        # Update post counters after deletion
-        self.post.likes = PostLike.objects.filter(post=self.post, is_like=True).count()
-        self.post.dislikes = PostLike.objects.filter(post=self.post, is_like=False).count()
-        self.post.save()
+        with transaction.atomic(using=router.db_for_write(PostLike, instance=self)):
+            result = super().delete(*args, **kwargs)
+            # Update post counters after deletion
+            if result[0]:
+                likes, dislikes = self.reaction_delta(self._stored_is_like, None)
+                self.post.adjust_reactions(likes=likes, dislikes=dislikes)
+        self._stored_is_like = None
+        return result
+
+    @staticmethod
+    def reaction_delta(old, new):
+        """Return the (likes, dislikes) change when a reaction goes from old to new."""
+        old = None if old is None else bool(old)
+        new = None if new is None else bool(new)
+        likes = (new is True) - (old is True)
+        dislikes = (new is False) - (old is False)
+        return likes, dislikes
     
     class Meta:
         unique_together = ('user', 'post')
 
 
+class TimelineEntry(models.Model):
+    """
+    One post in one user's feed, written when the post is published into a
+    category they subscribe to (see blog/timeline.py). ``category`` and
+    ``publish_date`` are copied from the post so the feed and unsubscribe
+    trims never have to join it.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    publish_date = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.user_id} <- post {self.post_id}'
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-publish_date', '-post'], name='timeline_feed_idx'),
+            models.Index(fields=['user', 'category'], name='timeline_category_idx'),
+        ]
+
+
+# =============================================================================
+# NOTIFICATION MODELS
+# =============================================================================
+
+class OutboundEmail(models.Model):
+    """
+    Transactional outbox: emails are written in the same transaction as the
+    change that triggers them and delivered later by the send_outbound_emails
+    worker (see blog/outbox.py).
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.subject} -> {self.recipient} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+
+class PostNotificationJob(models.Model):
+    """
+    Pending fan-out of a new post to its category's subscribers. ``cursor``
+    is the last Subscription id handled, so an interrupted job resumes
+    where it stopped.
+    """
+    post = models.OneToOneField(Post, on_delete=models.CASCADE)
+    cursor = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Notify subscribers of post {self.post_id}'
+
+
+class DigestItem(models.Model):
+    """A post waiting to go out in a subscriber's hourly or daily digest."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    frequency = models.CharField(max_length=10, choices=Subscription.DIGEST_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.user_id} <- post {self.post_id} ({self.frequency})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['frequency', 'user', 'created_at'], name='digest_due_idx'),
+        ]
+
+
+# =============================================================================
+# MEDIA MODELS
+# =============================================================================
+
+class StoredFile(models.Model):
+    """
+    A content-addressed post image and the number of posts using it. The
+    file is deleted once nothing references it any more (see blog.media).
+    """
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} ({self.references} reference(s))'
+
+
 # =============================================================================
 # ADMIN MODELS
 # =============================================================================
@@ -148,3 +346,39 @@ class ForbiddenWord(models.Model):
     
     def __str__(self):
         return self.word
+
+
+class QueryOffender(models.Model):
+    """
+    A statement flagged by blog.profiling for one view, either for being
+    slow or for running more than SQL_DUPLICATE_QUERY_THRESHOLD times in
+    a single request. Listed by number of offending requests in the admin.
+    """
+    SLOW = 'slow'
+    DUPLICATE = 'duplicate'
+    KIND_CHOICES = [
+        (SLOW, 'Slow query'),
+        (DUPLICATE, 'Duplicated query'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    view = models.CharField(max_length=200)
+    fingerprint = models.CharField(max_length=40)
+    sql = models.TextField()
+    occurrences = models.PositiveIntegerField(default=0)
+    total_ms = models.FloatField(default=0)
+    max_ms = models.FloatField(default=0)
+    max_repeats = models.PositiveIntegerField(default=0)
+    plan = models.TextField(blank=True)
+    stack = models.TextField(blank=True)
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} in {self.view}'
+
+    class Meta:
+        ordering = ['-occurrences']
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'view', 'fingerprint'], name='query_offender_unique'),
+        ]
@@ -0,0 +1,87 @@
+import re
+import threading
+import time
+
+from django.core.cache import cache
+
+
+# =============================================================================
+# FORBIDDEN WORD FILTER
+# =============================================================================
+
+# The compiled matcher is kept per process and rebuilt only when the version
+# stamp in the cache changes. The stamp lives in the shared default cache
+# (see CACHES in settings), so a bump in one worker reaches every worker.
+FORBIDDEN_WORDS_VERSION_KEY = 'blog:forbidden_words:version'
+
+_lock = threading.Lock()
+_matcher = (None, None)  # (version, compiled pattern or None)
+
+
+def _trie_pattern(node):
+    """Turn a character trie into a regex that never backtracks across words."""
+    terminal = '' in node
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not terminal:
+        return branches[0]
+    pattern = '(?:' + '|'.join(branches) + ')'
+    if terminal:
+        pattern += '?'
+    return pattern
+
+
+def build_pattern(words):
+    trie = {}
+    for word in words:
+        word = word.lower()
+        if not word:
+            continue
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    if not trie:
+        return None
+    return re.compile(_trie_pattern(trie), re.IGNORECASE)
+
+
+def get_version():
+    version = cache.get(FORBIDDEN_WORDS_VERSION_KEY)
+    if version is None:
+        cache.add(FORBIDDEN_WORDS_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(FORBIDDEN_WORDS_VERSION_KEY)
+    return version
+
+
+def bump_version():
+    cache.set(FORBIDDEN_WORDS_VERSION_KEY, time.time_ns(), None)
+
+
+def get_matcher():
+    global _matcher
+    version = get_version()
+    if _matcher[0] == version and version is not None:
+        return _matcher[1]
+    with _lock:
+        if _matcher[0] == version and version is not None:
+            return _matcher[1]
+        from .models import ForbiddenWord
+        pattern = build_pattern(ForbiddenWord.objects.values_list('word', flat=True))
+        _matcher = (version, pattern)
+        return pattern
+
+
+def censor(text):
+    """Mask every forbidden word in ``text``, whatever its case."""
+    if not text:
+        return text
+    pattern = get_matcher()
+    if pattern is None:
+        return text
+    return pattern.sub(lambda match: '*' * len(match.group()), text)
@@ -0,0 +1,276 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, router, transaction
+from django.db.models import F, Min
+from django.utils import timezone
+
+from .models import DigestItem, OutboundEmail, PostNotificationJob, Subscription
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# EMAIL OUTBOX
+# =============================================================================
+
+def enqueue_email(recipient, subject, body, from_email=None):
+    """
+    Queue an email for the outbox worker. Call it inside the transaction
+    that makes the change the email is about, so both commit or neither does.
+    """
+    return OutboundEmail.objects.create(
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+    )
+
+
+async def aenqueue_email(recipient, subject, body, from_email=None):
+    """enqueue_email for async code; queuing is a single insert, never an SMTP call."""
+    return await OutboundEmail.objects.acreate(
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+    )
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'EMAIL_OUTBOX_RETRY_BASE_SECONDS', 60)
+    cap = getattr(settings, 'EMAIL_OUTBOX_RETRY_MAX_SECONDS', 60 * 60)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), cap))
+
+
+def claim_due_emails(batch_size):
+    """
+    Take up to ``batch_size`` due emails for this worker in one UPDATE, so
+    concurrent workers never send the same row. Claimed rows are marked
+    SENDING with next_attempt_at pushed out by EMAIL_OUTBOX_CLAIM_SECONDS;
+    if the worker dies mid-batch they fall due again once that lease ends.
+    """
+    now = timezone.now()
+    lease = now + timedelta(seconds=getattr(settings, 'EMAIL_OUTBOX_CLAIM_SECONDS', 5 * 60))
+    alias = router.db_for_write(OutboundEmail)
+    connection = connections[alias]
+    qn = connection.ops.quote_name
+    table, pk = qn(OutboundEmail._meta.db_table), qn('id')
+    status, next_attempt_at = qn('status'), qn('next_attempt_at')
+    # Re-checked outside the subquery, for databases that run it before
+    # taking the row locks
+    due = f'{status} IN (%s, %s) AND {next_attempt_at} <= %s'
+    due_params = [OutboundEmail.PENDING, OutboundEmail.SENDING, connection.ops.adapt_datetimefield_value(now)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {table} SET {status} = %s, {next_attempt_at} = %s '
+            f'WHERE {pk} IN (SELECT {pk} FROM {table} WHERE {due} ORDER BY {next_attempt_at}, {pk} LIMIT %s) '
+            f'AND {due} RETURNING {pk}',
+            [OutboundEmail.SENDING, connection.ops.adapt_datetimefield_value(lease),
+             *due_params, batch_size, *due_params],
+        )
+        claimed = [row[0] for row in cursor.fetchall()]
+    if not claimed:
+        return []
+    return list(OutboundEmail.objects.using(alias).filter(pk__in=claimed).order_by('id'))
+
+
+def send_batch(batch_size=None, connection=None):
+    """
+    Deliver one batch of due emails over a single SMTP connection.
+    Returns (sent, failed) counts for the batch.
+
+    A ``connection`` passed in is opened if needed and left open, so a
+    caller draining many batches can reuse one SMTP session for all of them.
+    """
+    batch_size = batch_size or getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50)
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+    emails = claim_due_emails(batch_size)
+    if not emails:
+        return 0, 0
+
+    owns_connection = connection is None
+    connection = connection or get_connection()
+    sent_ids = []
+    failed = 0
+    try:
+        connection.open()
+    except Exception as exc:
+        # Nothing can go out; push the whole batch back
+        for email in emails:
+            _record_failure(email, exc, max_attempts)
+        return 0, len(emails)
+
+    try:
+        for email in emails:
+            message = EmailMessage(
+                subject=email.subject,
+                body=email.body,
+                from_email=email.from_email or None,
+                to=[email.recipient],
+                connection=connection,
+            )
+            try:
+                message.send()
+            except Exception as exc:
+                _record_failure(email, exc, max_attempts)
+                failed += 1
+                continue
+            sent_ids.append(email.pk)
+    finally:
+        if owns_connection:
+            connection.close()
+        OutboundEmail.objects.filter(pk__in=sent_ids).update(
+            status=OutboundEmail.SENT,
+            attempts=F('attempts') + 1,
+            sent_at=timezone.now(),
+            last_error='',
+        )
+    return len(sent_ids), failed
+
+
+def _record_failure(email, exc, max_attempts):
+    email.attempts += 1
+    email.last_error = f'{type(exc).__name__}: {exc}'
+    if email.attempts >= max_attempts:
+        email.status = OutboundEmail.FAILED
+    else:
+        email.status = OutboundEmail.PENDING
+        email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+    logger.warning('Failed to send outbound email %s (attempt %s): %s', email.pk, email.attempts, email.last_error)
+
+
+# =============================================================================
+# NEW-POST NOTIFICATIONS
+# =============================================================================
+
+NOTIFICATION_FROM_EMAIL = 'no-reply@blogapp.com'
+
+# A digest goes out once the oldest post waiting in it is this old
+DIGEST_PERIODS = {
+    Subscription.HOURLY: timedelta(hours=1),
+    Subscription.DAILY: timedelta(days=1),
+}
+
+
+def _chunk_size():
+    return getattr(settings, 'NOTIFICATION_CHUNK_SIZE', 1000)
+
+
+def run_notification_jobs(chunk_size=None):
+    """Fan out every unfinished PostNotificationJob. Returns the number of subscriptions handled."""
+    handled = 0
+    jobs = PostNotificationJob.objects.filter(completed_at__isnull=True).select_related('post__category')
+    for job in jobs.order_by('id'):
+        handled += fan_out(job, chunk_size)
+    return handled
+
+
+def fan_out(job, chunk_size=None):
+    """
+    Walk the subscribers of the job's category in id order, ``chunk_size`` at
+    a time, turning each chunk into outbox emails (immediate subscribers) and
+    digest items (everyone else). Each chunk commits together with the
+    job's cursor, so only one chunk is ever held in memory and a crash
+    resumes after the last committed chunk.
+
+    The cursor only moves if it still holds the value this worker read, so
+    when several workers pick up the same job, a chunk is queued by whichever
+    commits first and the others stop.
+    """
+    chunk_size = chunk_size or _chunk_size()
+    post = job.post
+    subject = f'New post in {post.category.name}: {post.title}'
+    body = f'A new post was published in {post.category.name}: {post.title}'
+    subscriptions = (
+        Subscription.objects.filter(category_id=post.category_id)
+        .exclude(user_id=post.author_id)
+        .order_by('id')
+        .values_list('id', 'user_id', 'user__email', 'digest')
+    )
+    handled = 0
+    while True:
+        chunk = list(subscriptions.filter(id__gt=job.cursor)[:chunk_size])
+        emails = []
+        items = []
+        for _, user_id, email, digest in chunk:
+            if digest == Subscription.IMMEDIATE:
+                if email:
+                    emails.append(OutboundEmail(
+                        recipient=email, subject=subject, body=body, from_email=NOTIFICATION_FROM_EMAIL,
+                    ))
+            else:
+                items.append(DigestItem(user_id=user_id, post_id=post.pk, frequency=digest))
+        cursor = chunk[-1][0] if chunk else job.cursor
+        completed_at = timezone.now() if len(chunk) < chunk_size else None
+        with transaction.atomic():
+            claimed = PostNotificationJob.objects.filter(
+                pk=job.pk, cursor=job.cursor, completed_at__isnull=True,
+            ).update(cursor=cursor, completed_at=completed_at)
+            if claimed:
+                OutboundEmail.objects.bulk_create(emails)
+                DigestItem.objects.bulk_create(items)
+        if not claimed:
+            # Another worker got there first and carries on with the job
+            job.refresh_from_db(fields=['cursor', 'completed_at'])
+            return handled
+        job.cursor, job.completed_at = cursor, completed_at
+        handled += len(chunk)
+        if job.completed_at:
+            return handled
+
+
+def build_digests(chunk_size=None):
+    """Roll due digest items up into one outbox email per user. Returns the number of emails queued."""
+    chunk_size = chunk_size or _chunk_size()
+    queued = 0
+    now = timezone.now()
+    for frequency, period in DIGEST_PERIODS.items():
+        items = DigestItem.objects.filter(frequency=frequency)
+        due_users = (
+            items.values('user_id')
+            .annotate(oldest=Min('created_at'))
+            .filter(oldest__lte=now - period)
+            .order_by('user_id')
+            .values_list('user_id', flat=True)
+        )
+        last_user_id = 0
+        while True:
+            user_ids = list(due_users.filter(user_id__gt=last_user_id)[:chunk_size])
+            if not user_ids:
+                break
+            last_user_id = user_ids[-1]
+            queued += _queue_digests(items.filter(user_id__in=user_ids), frequency)
+    return queued
+
+
+def _queue_digests(items, frequency):
+    with transaction.atomic():
+        # Read under lock, so two workers never put the same item in a
+        # digest (on SQLite the IMMEDIATE transaction already holds the
+        # write lock); a worker that waited finds the items gone
+        rows = items.select_for_update(of=('self',)).order_by('user_id', 'created_at').values_list(
+            'id', 'user__email', 'post__title', 'post__category__name'
+        )
+        last_item_id = 0
+        posts_by_email = {}
+        for item_id, email, title, category in rows:
+            last_item_id = max(last_item_id, item_id)
+            if email:
+                posts_by_email.setdefault(email, []).append(f'- {title} ({category})')
+        emails = [
+            OutboundEmail(
+                recipient=email,
+                subject=f'Your {frequency} digest: {len(lines)} new post(s)',
+                body='New posts in the categories you follow:\n\n' + '\n'.join(lines),
+                from_email=NOTIFICATION_FROM_EMAIL,
+            )
+            for email, lines in posts_by_email.items()
+        ]
+        OutboundEmail.objects.bulk_create(emails)
+        # Items queued while the digest was being built stay for the next one
+        items.filter(id__lte=last_item_id).delete()
+    return len(emails)
@@ -0,0 +1,234 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on a composite key such as (created_at, id).
+
+    The cursor holds the key of the last row of the previous page, so every
+    page is a single indexed range scan with no COUNT(*) and no OFFSET.
+    All ordering fields must sort in the same direction, and the last one
+    must be unique.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                size = int(request.query_params[self.page_size_query_param])
+                if size > 0:
+                    return min(size, self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.finish_page(list(self.page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset for async views, fetching the page with the async ORM."""
+        return self.finish_page([obj async for obj in self.page_queryset(queryset, request, view)])
+
+    def page_queryset(self, queryset, request, view=None):
+        """The unevaluated queryset of the requested page plus one lookahead row."""
+        self.request = request
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            queryset = queryset.filter(self.position_filter(self.decode_cursor(queryset.model, encoded)))
+        return queryset[:self.page_size + 1]
+
+    def finish_page(self, results):
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.last_key = self.key_for(results[-1]) if results else None
+        return results
+
+    def position_filter(self, values):
+        # (a, b) < (x, y)  ==  a < x OR (a = x AND b < y), without row-value syntax
+        lookup = 'lt' if self.ordering[0].startswith('-') else 'gt'
+        condition = Q()
+        for index, field in enumerate(self.fields):
+            branch = Q(**{f'{field}__{lookup}': values[index]})
+            for previous, value in zip(self.fields[:index], values):
+                branch &= Q(**{previous: value})
+            condition |= branch
+        return condition
+
+    def key_for(self, obj):
+        return [getattr(obj, field) for field in self.fields]
+
+    def encode_cursor(self, values):
+        payload = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value for value in values])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, model, encoded):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if len(values) != len(self.fields):
+                raise ValueError
+            return [model._meta.get_field(field).to_python(value) for field, value in zip(self.fields, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last_key))
+
+    def get_previous_link(self):
+        # Cursors only move forward
+        return None
+
+    def get_paginated_data(self, data):
+        return OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class CommentPagination(KeysetPagination):
+    ordering = ('-created_at', '-id')
+    page_size = 20
+
+
+class PostFeedPagination(KeysetPagination):
+    """
+    Keyset pagination for post feeds on (publish_date, id).
+
+    ``?ordering`` is restricted to the orderings below; anything else falls
+    back to newest first. ``?page=N`` still works for the first
+    POST_FEED_MAX_PAGE_NUMBER pages so existing clients keep working, and
+    the ``next`` link of the last numbered page switches to a cursor.
+    """
+    orderings = {
+        '-publish_date': ('-publish_date', '-id'),
+        'publish_date': ('publish_date', 'id'),
+    }
+    default_ordering = '-publish_date'
+    ordering_query_param = 'ordering'
+    page_query_param = 'page'
+    page_size = 5
+
+    def get_ordering(self, request, queryset, view):
+        key = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        return self.orderings.get(key, self.orderings[self.default_ordering])
+
+    def get_max_page_number(self):
+        return getattr(settings, 'POST_FEED_MAX_PAGE_NUMBER', 10)
+
+    def page_queryset(self, queryset, request, view=None):
+        self.page_number = None
+        page = request.query_params.get(self.page_query_param)
+        if page is None or self.cursor_query_param in request.query_params:
+            return super().page_queryset(queryset, request, view)
+
+        try:
+            page_number = int(page)
+        except ValueError:
+            raise NotFound('Invalid page.')
+        if page_number < 1 or page_number > self.get_max_page_number():
+            raise NotFound(f'Page numbers stop at {self.get_max_page_number()}; follow the cursor links instead.')
+
+        self.request = request
+        self.page_number = page_number
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.page_size = self.get_page_size(request)
+        offset = (page_number - 1) * self.page_size
+        return queryset.order_by(*self.ordering)[offset:offset + self.page_size + 1]
+
+    def get_next_link(self):
+        if self.page_number is None or not self.has_next:
+            return super().get_next_link()
+        url = self.request.build_absolute_uri()
+        if self.page_number < self.get_max_page_number():
+            return replace_query_param(url, self.page_query_param, self.page_number + 1)
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last_key))
+
+    def get_previous_link(self):
+        if not self.page_number or self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Cursor pages of search hits on (rank, id).
+
+    Hits come from the search backend rather than a queryset, so the cursor
+    is passed to the backend as ``after`` and only one page plus a lookahead
+    hit is fetched per request.
+    """
+    fields = ('rank', 'id')
+    page_size = 5
+
+    def paginate_hits(self, backend, query, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        encoded = request.query_params.get(self.cursor_query_param)
+        after = self.decode_cursor(None, encoded) if encoded else None
+        return self.finish_page(backend.search(query, limit=self.page_size + 1, after=after))
+
+    def key_for(self, hit):
+        return [hit[field] for field in self.fields]
+
+    def decode_cursor(self, model, encoded):
+        try:
+            rank, hit_id = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if rank is not None and not isinstance(rank, (int, float)) or not isinstance(hit_id, int):
+                raise ValueError
+            return rank, hit_id
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+
+class UserFeedPagination(KeysetPagination):
+    """Newest-first cursor pages of the posts in a user's subscribed categories."""
+    ordering = ('-publish_date', '-id')
+    page_size = 10
+
+
+class TimelinePagination(UserFeedPagination):
+    # Same cursor as UserFeedPagination, so a user switching between push and
+    # pull mode keeps their place
+    ordering = ('-publish_date', '-post_id')
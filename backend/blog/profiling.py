@@ -0,0 +1,234 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import re
+import time
+import traceback
+from contextvars import ContextVar
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import metrics
+from .metrics import view_label
+
+logger = logging.getLogger('blog.sql')
+
+
+# =============================================================================
+# SQL PROFILING
+# =============================================================================
+
+# Opt-in with SQL_PROFILING. While a request is handled every statement is
+# timed and counted by its normalized text. Statements slower than
+# SQL_SLOW_QUERY_MS are logged with their query plan and a trimmed stack;
+# statements run more than SQL_DUPLICATE_QUERY_THRESHOLD times in a single
+# request (an N+1) are logged once per request. Both go to the 'blog.sql'
+# logger, which settings.LOGGING sends to a rotating JSON-lines file, and
+# are totalled per view in QueryOffender for the admin.
+
+_profile = ContextVar('blog_sql_profile', default=None)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\bIN \((?:(?:%s|\?), )*(?:%s|\?)\)')
+_READ_RE = re.compile(r'\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+
+
+def normalize(sql):
+    """``sql`` with literals and IN lists collapsed, so repeats of one query compare equal."""
+    sql = _WHITESPACE_RE.sub(' ', sql).strip()
+    sql = _NUMBER_RE.sub('?', _STRING_RE.sub('?', sql))
+    return _IN_LIST_RE.sub('IN (...)', sql)
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+# Frames left out of stacks: the SQL instrumentation and middleware calls
+_SKIPPED_FILES = {__file__, metrics.__file__}
+_SKIPPED_FUNCTIONS = {'__call__', '__acall__'}
+
+
+def trimmed_stack():
+    """The project's own frames of the current stack, innermost last."""
+    root = str(settings.BASE_DIR)
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(root) and 'site-packages' not in frame.filename
+        and frame.filename not in _SKIPPED_FILES and frame.name not in _SKIPPED_FUNCTIONS
+    ]
+    depth = getattr(settings, 'SQL_PROFILE_STACK_DEPTH', 8)
+    return [f'{os.path.relpath(frame.filename, root)}:{frame.lineno} in {frame.name}' for frame in frames[-depth:]]
+
+
+def explain(connection, sql, params):
+    if not _READ_RE.match(sql):
+        return []
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+    except DatabaseError as exc:
+        return [f'unavailable: {exc}']
+
+
+class QueryProfile:
+    def __init__(self):
+        # normalized sql -> [count, seconds, stack when it crossed the threshold]
+        self.statements = {}
+        self.slow = []
+        self.explaining = False
+
+
+def profile_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None or profile.explaining:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        normalized = normalize(sql)
+        entry = profile.statements.setdefault(normalized, [0, 0.0, None])
+        entry[0] += 1
+        entry[1] += seconds
+        if entry[0] == getattr(settings, 'SQL_DUPLICATE_QUERY_THRESHOLD', 5) + 1:
+            entry[2] = trimmed_stack()
+        if seconds * 1000 >= getattr(settings, 'SQL_SLOW_QUERY_MS', 100):
+            profile.explaining = True
+            try:
+                plan = [] if many else explain(context['connection'], sql, params)
+            finally:
+                profile.explaining = False
+            profile.slow.append({
+                'sql': normalized, 'duration_ms': round(seconds * 1000, 2),
+                'plan': plan, 'stack': trimmed_stack(),
+            })
+
+
+def instrument_connection(sender, connection, **kwargs):
+    if profile_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(profile_query)
+
+
+# -------------------- Reporting --------------------
+def report(profile, request, view):
+    """Log the request's offending statements and add them to QueryOffender."""
+    base = {'view': view, 'method': request.method, 'path': request.path}
+    threshold = getattr(settings, 'SQL_DUPLICATE_QUERY_THRESHOLD', 5)
+    offenders = []
+    for slow in profile.slow:
+        logger.warning('slow_query', extra={'data': {**base, **slow}})
+        offenders.append(('slow', slow['sql'], slow['duration_ms'], 0, slow['plan'], slow['stack']))
+    for normalized, (count, seconds, stack) in profile.statements.items():
+        if count > threshold:
+            data = {**base, 'sql': normalized, 'count': count, 'total_ms': round(seconds * 1000, 2), 'stack': stack}
+            logger.warning('duplicate_query', extra={'data': data})
+            offenders.append(('duplicate', normalized, data['total_ms'], count, [], stack))
+    for offender in offenders:
+        record_offender(view, *offender)
+
+
+def record_offender(view, kind, sql, duration_ms, repeats, plan, stack):
+    from .models import QueryOffender
+
+    key = {'kind': kind, 'view': view[:200], 'fingerprint': fingerprint(sql)}
+    details = {'last_seen': timezone.now(), 'stack': '\n'.join(stack or [])}
+    if plan:
+        details['plan'] = '\n'.join(plan)
+    updated = QueryOffender.objects.filter(**key).update(
+        occurrences=F('occurrences') + 1,
+        total_ms=F('total_ms') + duration_ms,
+        max_ms=Greatest('max_ms', duration_ms),
+        max_repeats=Greatest('max_repeats', repeats),
+        **details,
+    )
+    if not updated:
+        QueryOffender.objects.get_or_create(**key, defaults={
+            'sql': sql, 'occurrences': 1, 'total_ms': duration_ms, 'max_ms': duration_ms,
+            'max_repeats': repeats, **details,
+        })
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event and the record's ``data``."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, tz=dt_timezone.utc).isoformat(),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'data', {}))
+        return json.dumps(entry, default=str)
+
+
+class ProfileLogHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that creates the log directory on first write."""
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+# -------------------- Middleware --------------------
+class SQLProfilingMiddleware:
+    """Profile each request's SQL when SQL_PROFILING is on (see above)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        connection_created.connect(instrument_connection)
+        for connection in connections.all(initialized_only=True):
+            instrument_connection(None, connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        profile = QueryProfile()
+        token = _profile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+        if profile.slow or profile.statements:
+            self.report(profile, request)
+        return response
+
+    async def __acall__(self, request):
+        profile = QueryProfile()
+        token = _profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _profile.reset(token)
+        if profile.slow or profile.statements:
+            await sync_to_async(self.report)(profile, request)
+        return response
+
+    def report(self, profile, request):
+        try:
+            report(profile, request, view_label(request))
+        except DatabaseError:
+            logger.exception('Could not record SQL offenders')
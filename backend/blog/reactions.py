@@ -0,0 +1,209 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connections, router, transaction
+
+from .models import Post, PostLike
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# POST REACTIONS
+# =============================================================================
+
+LIKE = 'like'
+DISLIKE = 'dislike'
+ACTIONS = (LIKE, DISLIKE)
+
+
+def _insert_if_absent(connection, user_id, post_id, is_like):
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {qn(PostLike._meta.db_table)} ({qn("user_id")}, {qn("post_id")}, {qn("is_like")}) '
+            f'VALUES (%s, %s, %s) ON CONFLICT ({qn("user_id")}, {qn("post_id")}) DO NOTHING',
+            [user_id, post_id, is_like],
+        )
+        return cursor.rowcount == 1
+
+
+def react(user, post_id, action):
+    """
+    Apply a like/dislike click and return the post's counters plus the
+    caller's reaction state.
+
+    Clicking the reaction the user already has removes it (toggle off);
+    clicking the other one switches it. Every branch is a single
+    conditional write, so concurrent first clicks cannot collide on the
+    (user, post) unique constraint. Raises Post.DoesNotExist for unknown posts.
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Unknown reaction: {action}')
+    is_like = action == LIKE
+    using = router.db_for_write(PostLike)
+    connection = connections[using]
+    reactions = PostLike.objects.using(using).filter(user=user, post_id=post_id)
+
+    with transaction.atomic(using=using):
+        if _insert_if_absent(connection, user.pk, post_id, is_like):
+            old, new = None, is_like
+        elif reactions.filter(is_like=is_like).delete()[0]:
+            old, new = is_like, None
+        elif reactions.filter(is_like=not is_like).update(is_like=is_like):
+            old, new = not is_like, is_like
+        else:
+            # A concurrent request already stored this exact reaction
+            old = new = is_like
+
+        post = Post(pk=post_id)
+        likes, dislikes = PostLike.reaction_delta(old, new)
+        counters = None
+        if write_behind_enabled():
+            if likes or dislikes:
+                transaction.on_commit(lambda: get_buffer().add(post_id, likes, dislikes), using=using)
+        else:
+            counters = post.adjust_reactions(likes=likes, dislikes=dislikes)
+        if counters is None:
+            counters = Post.objects.using(using).filter(pk=post_id).values_list('likes', 'dislikes').first()
+        if counters is None:
+            raise Post.DoesNotExist(f'Post {post_id} does not exist.')
+
+    pending_likes, pending_dislikes = pending_delta(post_id)
+    return {
+        'post_id': post_id,
+        'likes': counters[0] + pending_likes,
+        'dislikes': counters[1] + pending_dislikes,
+        'liked_by_me': new is True,
+        'disliked_by_me': new is False,
+        'deleted': post.pk is None,
+    }
+
+
+# =============================================================================
+# WRITE-BEHIND COUNTER BUFFER
+# =============================================================================
+
+class ReactionBuffer:
+    """
+    Per-process accumulator of Post.likes/Post.dislikes deltas.
+
+    Reaction rows are written immediately; only the counter updates are
+    deferred and applied in one transaction every ``interval`` seconds or
+    after ``max_events`` reactions, whichever comes first.
+    """
+
+    def __init__(self, interval, max_events):
+        self.interval = interval
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._deltas = {}
+        self._flushing = {}
+        self._events = 0
+        self._thread = None
+
+    def add(self, post_id, likes, dislikes):
+        with self._lock:
+            pending = self._deltas.setdefault(post_id, [0, 0])
+            pending[0] += likes
+            pending[1] += dislikes
+            self._events += 1
+            full = self._events >= self.max_events
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='reaction-buffer', daemon=True)
+                self._thread.start()
+        if full:
+            self.flush_quietly()
+
+    def pending(self, post_id):
+        """Unflushed (likes, dislikes) delta for a post, including an in-flight flush."""
+        with self._lock:
+            likes = dislikes = 0
+            for deltas in (self._deltas, self._flushing):
+                if post_id in deltas:
+                    likes += deltas[post_id][0]
+                    dislikes += deltas[post_id][1]
+            return likes, dislikes
+
+    def flush(self):
+        """Apply every pending delta in one transaction. Returns the number of posts updated."""
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._deltas = self._deltas, {}
+                self._events = 0
+                batch = self._flushing
+            if not batch:
+                return 0
+            try:
+                with transaction.atomic(using=router.db_for_write(Post)):
+                    for post_id, (likes, dislikes) in batch.items():
+                        Post(pk=post_id).adjust_reactions(likes=likes, dislikes=dislikes)
+            except Exception:
+                # Keep the deltas so the next flush retries them
+                with self._lock:
+                    for post_id, (likes, dislikes) in batch.items():
+                        pending = self._deltas.setdefault(post_id, [0, 0])
+                        pending[0] += likes
+                        pending[1] += dislikes
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._flushing = {}
+            return len(batch)
+
+    def flush_quietly(self):
+        """
+        flush() for callers that must not fail: add() runs in on_commit
+        callbacks, after the reaction itself has committed. Errors are
+        logged and the deltas stay buffered for the next flush.
+        """
+        try:
+            return self.flush()
+        except Exception:
+            logger.exception('Failed to flush buffered reaction counters')
+            return 0
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            # This thread outlives any request, so drop connections the
+            # database has closed or that are past CONN_MAX_AGE, as the
+            # request cycle does
+            close_old_connections()
+            try:
+                self.flush_quietly()
+            finally:
+                close_old_connections()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def write_behind_enabled():
+    return getattr(settings, 'REACTION_WRITE_BEHIND', False)
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = ReactionBuffer(
+                    interval=getattr(settings, 'REACTION_FLUSH_INTERVAL_MS', 500) / 1000,
+                    max_events=getattr(settings, 'REACTION_FLUSH_MAX_EVENTS', 200),
+                )
+                # Quietly: an exception here would only be printed at exit
+                atexit.register(_buffer.flush_quietly)
+    return _buffer
+
+
+def pending_delta(post_id):
+    """Counter deltas for a post that have not reached the database yet."""
+    if _buffer is None:
+        return 0, 0
+    return _buffer.pending(post_id)
@@ -0,0 +1,82 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# =============================================================================
+# PRIMARY / REPLICA ROUTING
+# =============================================================================
+
+# Routing state of the request being handled, set up by
+# blog.middleware.ReplicaRoutingMiddleware. Outside a request (management
+# commands, the outbox worker) there is none and everything uses the primary.
+_state = ContextVar('blog_db_routing', default=None)
+
+
+class RoutingState:
+    def __init__(self, pinned=False):
+        # Reads go to the primary for the rest of the request
+        self.pinned = pinned
+        # Something was written during the request
+        self.wrote = False
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def begin(pinned=False):
+    return _state.set(RoutingState(pinned))
+
+
+def end(token):
+    _state.reset(token)
+
+
+def current():
+    return _state.get()
+
+
+def pin():
+    """Send every further read of the current request to the primary."""
+    state = _state.get()
+    if state is not None:
+        state.pinned = True
+
+
+def use_primary(view):
+    """Mark a view whose reads must always come from the primary."""
+    view.use_primary_db = True
+    return view
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes go to ``default``; reads go to a random alias in DATABASE_REPLICAS
+    unless the request has already written, is inside a transaction, or is
+    pinned to the primary by the middleware.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        aliases = replicas()
+        if state is None or state.pinned or not aliases:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replicas()
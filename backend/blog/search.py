@@ -0,0 +1,213 @@
+import html
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Q, Subquery
+from django.utils.module_loading import import_string
+
+from .models import Post
+
+
+# =============================================================================
+# POST SEARCH
+# =============================================================================
+
+# Markers placed around matches by the database, swapped for <mark> tags
+# after the surrounding text has been HTML-escaped
+_OPEN, _CLOSE = '\ue000', '\ue001'
+
+
+def _chunks(items, size):
+    """Lists of up to ``size`` items, taken from ``items`` as they are needed."""
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+def _highlight(text):
+    if text is None:
+        return None
+    return html.escape(text).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+class BaseSearchBackend:
+    """
+    Interface for post search backends. ``search`` returns hits ordered by
+    relevance, each a dict with ``id``, ``rank``, ``title`` and ``snippet``
+    (the last two are HTML with matches wrapped in <mark>, or None).
+    ``after`` is the ``(rank, id)`` of the last hit of the previous page;
+    only hits that sort after it are returned.
+    """
+    batch_size = 500
+
+    def index_posts(self, post_ids):
+        pass
+
+    def remove_posts(self, post_ids):
+        pass
+
+    def rebuild(self, batch_size=None):
+        return 0
+
+    def search(self, query, limit=None, after=None):
+        raise NotImplementedError
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """Unranked LIKE matching, for databases without a full-text index."""
+
+    def search(self, query, limit=None, after=None):
+        query = query.strip()
+        if not query:
+            return []
+        posts = Post.objects.filter(
+            Q(title__icontains=query) |
+            Q(content__icontains=query) |
+            Q(tags__name__icontains=query) |
+            Q(category__name__icontains=query)
+        )
+        if after is not None:
+            # Newest first, so continue from the previous page's last post
+            _, after_id = after
+            publish_date = Post.objects.filter(pk=after_id).values('publish_date')
+            posts = posts.filter(
+                Q(publish_date__lt=Subquery(publish_date)) |
+                Q(publish_date=Subquery(publish_date), id__lt=after_id)
+            )
+        ids = (
+            posts.order_by('-publish_date', '-id')
+            .values_list('id', flat=True)
+            .distinct()
+        )
+        if limit:
+            ids = ids[:limit]
+        return [{'id': post_id, 'rank': None, 'title': None, 'snippet': None} for post_id in ids]
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 index over post title, content, tag names and category name.
+
+    The index is a separate virtual table keyed by post id, kept in sync by
+    the signal handlers in blog.signals and ranked with bm25.
+    """
+    table = 'blog_post_fts'
+    # bm25 column weights: title, content, tags, category
+    weights = (10.0, 1.0, 5.0, 3.0)
+    snippet_tokens = 16
+
+    def __init__(self):
+        self._ready = set()
+
+    def _connection(self, write=False):
+        alias = router.db_for_write(Post) if write else router.db_for_read(Post)
+        connection = connections[alias]
+        key = (alias, str(connection.settings_dict['NAME']))
+        if key not in self._ready:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5('
+                    'title, content, tags, category, tokenize="unicode61 remove_diacritics 2")'
+                )
+            # The CREATE is rolled back with the transaction it ran in, so
+            # only trust it once that commits
+            transaction.on_commit(lambda: self._ready.add(key), using=alias)
+        return connection
+
+    def index_posts(self, post_ids):
+        connection = self._connection(write=True)
+        through = Post.tags.through
+        for chunk in _chunks(post_ids, self.batch_size):
+            tags = {}
+            for post_id, name in through.objects.filter(post_id__in=chunk).values_list('post_id', 'tag__name'):
+                tags.setdefault(post_id, []).append(name)
+            rows = [
+                (post_id, title, content, ' '.join(tags.get(post_id, [])), category)
+                for post_id, title, content, category in Post.objects.filter(pk__in=chunk).values_list(
+                    'id', 'title', 'content', 'category__name'
+                )
+            ]
+            with connection.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})', chunk)
+                if rows:
+                    cursor.executemany(
+                        f'INSERT INTO {self.table} (rowid, title, content, tags, category) VALUES (%s, %s, %s, %s, %s)',
+                        rows,
+                    )
+
+    def remove_posts(self, post_ids):
+        connection = self._connection(write=True)
+        for chunk in _chunks(post_ids, self.batch_size):
+            with connection.cursor() as cursor:
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})', chunk)
+
+    def rebuild(self, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        connection = self._connection(write=True)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+        indexed = 0
+        ids = Post.objects.order_by().values_list('id', flat=True).iterator(chunk_size=batch_size)
+        for chunk in _chunks(ids, batch_size):
+            self.index_posts(chunk)
+            indexed += len(chunk)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return indexed
+
+    def match_expression(self, query):
+        # Quote every term so user input can't inject FTS5 syntax; the last
+        # term is a prefix match for search-as-you-type
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return None
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search(self, query, limit=None, after=None):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        connection = self._connection()
+        weights = ', '.join(str(weight) for weight in self.weights)
+        sql = (
+            f"SELECT rowid, bm25({self.table}, {weights}) AS rank, "
+            f"highlight({self.table}, 0, %s, %s), "
+            f"snippet({self.table}, 1, %s, %s, '…', {self.snippet_tokens}) "
+            f"FROM {self.table} WHERE {self.table} MATCH %s"
+        )
+        params = [_OPEN, _CLOSE, _OPEN, _CLOSE, expression]
+        if after is not None:
+            # bm25 is lower for better matches. A bare "rank" here would be
+            # FTS5's own unweighted rank column, not the alias above
+            rank, post_id = after
+            score = f'bm25({self.table}, {weights})'
+            sql += f' AND ({score} > %s OR ({score} = %s AND rowid > %s))'
+            params += [rank, rank, post_id]
+        sql += ' ORDER BY rank, rowid'
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return [
+            {'id': post_id, 'rank': rank, 'title': _highlight(title), 'snippet': _highlight(snippet)}
+            for post_id, rank, title, snippet in rows
+        ]
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', 'blog.search.DatabaseSearchBackend')
+        _backend = import_string(path)()
+    return _backend
@@ -1,6 +1,17 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
-from .models import Comment, Category , Post, Tag, Subscription
+from .models import Comment, Category , Post, PostLike, Tag, Subscription
+from . import caching, images
+from .authentication import add_claims
+from .reactions import pending_delta
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 User = get_user_model()
@@ -20,6 +31,9 @@ class UserSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({
                 'password_confirm': "Passwords do not match"
             })
+        # Hash here rather than in create(), so the slow hashing isn't done
+        # while the signup transaction holds the database write lock
+        data['password'] = make_password(data['password'])
         return data
 
     def create(self, validated_data):
@@ -28,7 +42,7 @@ class UserSerializer(serializers.ModelSerializer):
             email=validated_data['email'],
             username=validated_data['username']
         )
-        user.set_password(validated_data['password'])
+        user.password = validated_data['password']
         user.save()
         return user
 
@@ -38,12 +52,17 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
-        fields = ['id', 'user', 'content', 'created_at', 'replies', 'parent']
+        fields = ['id', 'user', 'content', 'created_at', 'reply_count', 'replies', 'parent']
+        read_only_fields = ['reply_count']
 
     def get_replies(self, obj):
-        if obj.replies.exists():
-            return CommentSerializer(obj.replies.all(), many=True).data
-        return []
+        # Threads loaded by blog.comments.attach_replies carry their replies.
+        # Otherwise embed none rather than query per comment; reply_count and
+        # comments/<id>/replies/ cover them
+        replies = getattr(obj, 'loaded_replies', None)
+        if replies is None:
+            return []
+        return CommentSerializer(replies, many=True, context=self.context).data
 
     def validate_content(self, value):
         value = value.strip()
@@ -51,6 +70,27 @@ class CommentSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Content cannot be blank.")
         return value
 
+def get_subscribed_category_ids(request):
+    """
+    IDs of the categories the requesting user subscribes to, loaded once per
+    request and shared by every serializer that exposes ``subscribed``.
+    Anonymous users never hit the database.
+    """
+    if request is None:
+        return frozenset()
+    user = getattr(request, 'user', None)
+    if not (user and user.is_authenticated):
+        return frozenset()
+    http_request = getattr(request, '_request', request)
+    subscribed_ids = getattr(http_request, '_subscribed_category_ids', None)
+    if subscribed_ids is None:
+        subscribed_ids = frozenset(
+            Subscription.objects.filter(user=user).values_list('category_id', flat=True)
+        )
+        http_request._subscribed_category_ids = subscribed_ids
+    return subscribed_ids
+
+
 class CategorySerializer(serializers.ModelSerializer):
     subscribed = serializers.SerializerMethodField()
 
@@ -59,28 +99,37 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'subscribed']
 
     def get_subscribed(self, obj):
-        request = self.context.get('request')
-        user = request.user if request else None
-        if user and user.is_authenticated:
-            return obj.subscription_set.filter(user=user).exists()
-        return False
+        return obj.id in get_subscribed_category_ids(self.context.get('request'))
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = '__all__'
 
+class PostListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        posts = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.load_fragments(posts)
+        return [self.child.to_representation(post) for post in posts]
+
+
 class PostSerializer(serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
     tags = TagSerializer(many=True, read_only=True)
     author = serializers.SerializerMethodField()
     liked_by_me = serializers.SerializerMethodField()
     disliked_by_me = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    # Fields rendered on every request on top of the cached fragment: the
+    # per-user ones, the live counters and the host-dependent image URLs
+    overlay_fields = ('image', 'srcset', 'likes', 'dislikes', 'liked_by_me', 'disliked_by_me')
 
     class Meta:
         model = Post
-        fields = '__all__'
-        read_only_fields = ['id', 'likes', 'dislikes', 'author']
+        exclude = ['image_variants']
+        read_only_fields = ['id', 'likes', 'dislikes', 'author', 'revision']
+        list_serializer_class = PostListSerializer
 
     def get_author(self, obj):
         return {
@@ -89,6 +138,10 @@ class PostSerializer(serializers.ModelSerializer):
         }
 
     def get_liked_by_me(self, obj):
+        # List views preload the user's reactions for the whole page
+        my_reactions = self.context.get('my_reactions')
+        if my_reactions is not None:
+            return my_reactions.get(obj.pk) is True
         request = self.context.get('request', None)
         if request and request.user and request.user.is_authenticated:
             from blog.models import PostLike
@@ -96,16 +149,103 @@ class PostSerializer(serializers.ModelSerializer):
         return False
 
     def get_disliked_by_me(self, obj):
+        my_reactions = self.context.get('my_reactions')
+        if my_reactions is not None:
+            return my_reactions.get(obj.pk) is False
         request = self.context.get('request', None)
         if request and request.user and request.user.is_authenticated:
             from blog.models import PostLike
             return PostLike.objects.filter(post=obj, user=request.user, is_like=False).exists()
         return False
 
+    def get_srcset(self, obj):
+        """
+        ``{variant: {'width', 'height', 'webp', 'jpeg'}}`` with the URLs of
+        the resized copies of the image, or None until they are rendered.
+        """
+        if not obj.image or not obj.image_variants:
+            return None
+        request = self.context.get('request', None)
+        srcset = {}
+        for variant, info in obj.image_variants.items():
+            srcset[variant] = {'width': info['width'], 'height': info['height']}
+            for fmt in images.FORMATS:
+                url = default_storage.url(info[fmt])
+                srcset[variant][fmt] = request.build_absolute_uri(url) if request is not None else url
+        return srcset
+
+    def load_fragments(self, posts):
+        """
+        Fetch the cached user-independent representation of ``posts`` in one
+        cache round trip, rendering and storing the misses. Tags are only
+        prefetched for the misses.
+        """
+        keyed = {caching.fragment_key(post): post for post in posts if post.pk is not None}
+        found = caching.local_cache().get_many(list(keyed))
+        missing = [post for key, post in keyed.items() if key not in found]
+        caching.record_fragment_lookups(hits=len(found), misses=len(missing))
+        if missing:
+            prefetch_related_objects(missing, 'tags')
+            rendered = {caching.fragment_key(post): self.render_fragment(post) for post in missing}
+            caching.local_cache().set_many(rendered, getattr(settings, 'POST_FRAGMENT_CACHE_TIMEOUT', 3600))
+            found.update(rendered)
+        if not hasattr(self, '_fragments'):
+            self._fragments = {}
+        self._fragments.update({post.pk: found[key] for key, post in keyed.items()})
+
+    def render_fragment(self, instance):
+        fragment = {}
+        for field in self._readable_fields:
+            if field.field_name in self.overlay_fields:
+                continue
+            attribute = field.get_attribute(instance)
+            fragment[field.field_name] = None if attribute is None else field.to_representation(attribute)
+        return fragment
+
     def to_representation(self, instance):
-        rep = super().to_representation(instance)
+        if instance.pk is None:
+            fragment = self.render_fragment(instance)
+        else:
+            if instance.pk not in getattr(self, '_fragments', {}):
+                self.load_fragments([instance])
+            fragment = self._fragments[instance.pk]
+
+        rep = OrderedDict()
+        for field in self._readable_fields:
+            if field.field_name not in self.overlay_fields:
+                rep[field.field_name] = fragment[field.field_name]
+                continue
+            attribute = field.get_attribute(instance)
+            rep[field.field_name] = None if attribute is None else field.to_representation(attribute)
+        if rep.get('category') is not None:
+            rep['category'] = dict(rep['category'])
+            rep['category']['subscribed'] = instance.category_id in get_subscribed_category_ids(self.context.get('request'))
+
+        # Merge reaction counters still sitting in the write-behind buffer
+        likes, dislikes = pending_delta(instance.pk)
+        if likes or dislikes:
+            rep['likes'] += likes
+            rep['dislikes'] += dislikes
+        # Search results carry their rank and highlighted matches
+        hit = getattr(instance, 'search_hit', None)
+        if hit is not None:
+            rep['search'] = {'rank': hit['rank'], 'title': hit['title'], 'snippet': hit['snippet']}
         return rep
 
+def post_list_context(request, posts):
+    """
+    Serializer context for a page of posts: the request plus the current
+    user's reactions to those posts, loaded in one query.
+    """
+    user = getattr(request, 'user', None)
+    my_reactions = {}
+    if user and user.is_authenticated and posts:
+        my_reactions = dict(
+            PostLike.objects.filter(user=user, post_id__in=[post.pk for post in posts])
+            .values_list('post_id', 'is_like')
+        )
+    return {'request': request, 'my_reactions': my_reactions}
+
 class SubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subscription
@@ -115,8 +255,16 @@ class SubscriptionSerializer(serializers.ModelSerializer):
 # Removed duplicate PostSerializer here to avoid override issues.
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_claims(super().get_token(user), user)
+
     def validate(self, attrs):
         data = super().validate(attrs)
+        # Checked on the user authenticate() already loaded, so logging in
+        # is a single lookup
+        if self.user.is_blocked:
+            raise AuthenticationFailed('This user is blocked. Contact admin.')
         data['username'] = self.user.username
         data['is_admin'] = getattr(self.user, 'is_admin', False)
         return data
@@ -0,0 +1,224 @@
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+
+# =============================================================================
+# MEDIA SERVING
+# =============================================================================
+
+# Uploaded files under MEDIA_URL are answered by serve_media, normally from
+# MediaMiddleware before the rest of the middleware stack runs. Responses
+# carry ETag and Last-Modified and honour conditional requests and single
+# byte ranges. Content-addressed names (blog.storage) and the variants
+# rendered from them never change content, so they are cacheable for a year.
+# Under ASGI the body is read in worker threads through an async iterator;
+# Django would otherwise load a sync iterator's whole file into memory
+# before sending the first byte.
+IMMUTABLE_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{64}(?:-[^/]*)?\.[0-9a-z]+$')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def is_immutable(name):
+    return IMMUTABLE_NAME_RE.search(name) is not None
+
+
+def cache_control(name):
+    if is_immutable(name):
+        max_age = getattr(settings, 'MEDIA_IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+        return f'public, max-age={max_age}, immutable'
+    return f'public, max-age={getattr(settings, "MEDIA_CACHE_MAX_AGE", 3600)}'
+
+
+def file_etag(stat_result):
+    # Derived from the inode's mtime and size, so no bytes are read
+    return quote_etag(f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}')
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` (inclusive) of a single ``bytes=`` range, None if the
+    header should be ignored, or False if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        # Multiple or malformed ranges: serving the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _if_range_matches(request, etag, mtime):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def _aread_range(path, start, length):
+    file = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = await read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def serve_media(request, path, asynchronous=False):
+    """
+    Serve ``path`` from MEDIA_ROOT with HTTP caching and Range support. With
+    ``asynchronous`` the body is an async iterator, for ASGI servers.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat_result = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError, ValueError):
+        raise Http404('Not found')
+    if not stat.S_ISREG(stat_result.st_mode) or os.path.basename(full_path).startswith('.'):
+        raise Http404('Not found')
+
+    etag = file_etag(stat_result)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat_result.st_mtime),
+        'Cache-Control': cache_control(path),
+        'Accept-Ranges': 'bytes',
+    }
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat_result.st_mtime))
+    if response is not None:
+        # 304 Not Modified or 412 Precondition Failed
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+
+    mode = getattr(settings, 'MEDIA_SENDFILE', None)
+    if mode:
+        # The front server reads the file (and handles Range) itself
+        response = HttpResponse(content_type=content_type, headers=headers)
+        if mode == 'x-accel-redirect':
+            prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = quote(prefix.rstrip('/') + '/' + path.lstrip('/'))
+        else:
+            response['X-Sendfile'] = full_path
+        return response
+
+    size = stat_result.st_size
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and _if_range_matches(request, etag, stat_result.st_mtime):
+        byte_range = parse_range(request.META['HTTP_RANGE'], size)
+    if byte_range is False:
+        response = HttpResponse(status=416, headers=headers)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        start, length, status = 0, size, 200
+    else:
+        start, length, status = byte_range[0], byte_range[1] - byte_range[0] + 1, 206
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type, status=status, headers=headers)
+    elif asynchronous:
+        response = StreamingHttpResponse(
+            _aread_range(full_path, start, length), content_type=content_type, status=status, headers=headers
+        )
+    elif status == 200:
+        # FileResponse hands the open file to the server's wsgi.file_wrapper
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type, headers=headers)
+    else:
+        response = StreamingHttpResponse(
+            _read_range(full_path, start, length), content_type=content_type, status=status, headers=headers
+        )
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{start + length - 1}/{size}'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+class MediaMiddleware:
+    """
+    Answer requests under MEDIA_URL with serve_media before the rest of the
+    stack runs: media needs no session, user, CSRF check or database.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.serve(request)
+        if response is None:
+            response = self.get_response(request)
+        return response
+
+    async def __acall__(self, request):
+        # Only a stat() runs on the event loop; the body is read in threads
+        response = self.serve(request, asynchronous=True)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+    def serve(self, request, asynchronous=False):
+        """The media response for ``request``, or None if it isn't for media."""
+        prefix = settings.MEDIA_URL
+        if getattr(settings, 'MEDIA_SERVE', True) and prefix.startswith('/') and request.path.startswith(prefix):
+            try:
+                return serve_media(request, request.path[len(prefix):], asynchronous)
+            except Http404:
+                return HttpResponse('Not found', status=404, content_type='text/plain')
+        return None
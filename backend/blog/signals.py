@@ -0,0 +1,253 @@
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Category, Comment, ForbiddenWord, Post, PostNotificationJob, Subscription, Tag, User
+from . import caching, images, media, moderation, search, timeline
+
+
+@receiver([post_save, post_delete], sender=ForbiddenWord)
+def forbidden_words_changed(sender, **kwargs):
+    moderation.bump_version()
+
+
+@receiver(post_save, sender=Comment)
+def reply_created(sender, instance, created, **kwargs):
+    if created and instance.parent_id:
+        Comment.objects.filter(pk=instance.parent_id).update(reply_count=F('reply_count') + 1)
+
+
+@receiver(post_delete, sender=Comment)
+def reply_deleted(sender, instance, **kwargs):
+    if instance.parent_id:
+        Comment.objects.filter(pk=instance.parent_id, reply_count__gt=0).update(reply_count=F('reply_count') - 1)
+
+
+# -------------------- Search index --------------------
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, **kwargs):
+    search.get_backend().index_posts([instance.pk])
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.get_backend().remove_posts([instance.pk])
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def index_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # tag.post_set.clear() doesn't say which posts lost the tag
+        instance._search_cleared_post_ids = list(instance.post_set.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        post_ids = [instance.pk]
+    elif action == 'post_clear':
+        post_ids = getattr(instance, '_search_cleared_post_ids', [])
+    else:
+        post_ids = pk_set or []
+    search.get_backend().index_posts(post_ids)
+
+
+@receiver(post_save, sender=Tag)
+def index_renamed_tag(sender, instance, created, **kwargs):
+    if not created:
+        search.get_backend().index_posts(instance.post_set.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tagged_posts(sender, instance, **kwargs):
+    instance._search_tagged_post_ids = list(instance.post_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def index_deleted_tag(sender, instance, **kwargs):
+    search.get_backend().index_posts(getattr(instance, '_search_tagged_post_ids', []))
+
+
+@receiver(post_save, sender=Category)
+def index_renamed_category(sender, instance, created, **kwargs):
+    if not created:
+        search.get_backend().index_posts(instance.post_set.values_list('id', flat=True))
+
+
+# -------------------- Response cache versions --------------------
+# Reaction counter changes are bumped by Post.adjust_reactions, which every
+# reaction path goes through.
+def _bump_posts(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    names = [caching.FEED]
+    for post_id, category_id in Post.objects.filter(pk__in=post_ids).values_list('id', 'category_id'):
+        names += [caching.post_version(post_id), caching.category_version(category_id)]
+    caching.bump(*names)
+
+
+@receiver(pre_save, sender=Post)
+def remember_post_category(sender, instance, **kwargs):
+    if instance.pk:
+        row = Post.objects.filter(pk=instance.pk).values_list('category_id', 'image', 'image_variants').first()
+        if row is not None:
+            instance._cached_category_id, instance._cached_image, instance._cached_image_variants = row
+
+
+@receiver(post_save, sender=Post)
+def post_changed(sender, instance, **kwargs):
+    caching.bump_post(instance.pk, instance.category_id)
+    previous = getattr(instance, '_cached_category_id', None)
+    if previous and previous != instance.category_id:
+        caching.bump(caching.category_version(previous))
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    caching.bump_post(instance.pk, instance.category_id)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        caching.bump_post(instance.pk, instance.category_id)
+    elif action == 'post_clear':
+        _bump_posts(getattr(instance, '_search_cleared_post_ids', []))
+    else:
+        _bump_posts(pk_set or [])
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def comment_changed(sender, instance, **kwargs):
+    caching.bump(caching.post_version(instance.post_id))
+
+
+@receiver(post_save, sender=Tag)
+def tag_changed(sender, instance, created, **kwargs):
+    if not created:
+        _bump_posts(instance.post_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    # Captured by remember_tagged_posts before the through rows went away
+    _bump_posts(getattr(instance, '_search_tagged_post_ids', []))
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance, created=False, **kwargs):
+    caching.bump(caching.CATEGORIES, caching.category_version(instance.pk))
+    if not created and kwargs['signal'] is post_save:
+        # Every post embeds its category
+        caching.bump(caching.FEED, *(
+            caching.post_version(post_id) for post_id in instance.post_set.values_list('id', flat=True)
+        ))
+
+
+# -------------------- Post fragment revisions --------------------
+@receiver(m2m_changed, sender=Post.tags.through)
+def post_tags_revised(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Post.bump_revisions(pk=instance.pk)
+        instance.refresh_from_db(fields=['revision'])
+    elif action == 'post_clear':
+        Post.bump_revisions(pk__in=getattr(instance, '_search_cleared_post_ids', []))
+    else:
+        Post.bump_revisions(pk__in=pk_set or [])
+
+
+@receiver(post_save, sender=Tag)
+def tag_revised(sender, instance, created, **kwargs):
+    if not created:
+        Post.bump_revisions(tags=instance)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_removed(sender, instance, **kwargs):
+    Post.bump_revisions(pk__in=getattr(instance, '_search_tagged_post_ids', []))
+
+
+@receiver(post_save, sender=Category)
+def category_revised(sender, instance, created, **kwargs):
+    if not created:
+        Post.bump_revisions(category=instance)
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Invalidates cached JWT principals (see blog.authentication)
+    caching.bump(caching.user_version(instance.pk))
+
+
+@receiver(post_save, sender=User)
+def author_revised(sender, instance, created, update_fields=None, **kwargs):
+    # Posts embed their author's username, and comment threads each
+    # commenter's, so their fragments and cached responses go stale with it
+    if not created and (update_fields is None or 'username' in update_fields):
+        Post.bump_revisions(author=instance)
+        authored = Post.objects.filter(author=instance).values_list('id', flat=True)
+        commented = Comment.objects.filter(user=instance).values_list('post_id', flat=True)
+        _bump_posts({*authored, *commented})
+
+
+# -------------------- Subscriber notifications --------------------
+@receiver(post_save, sender=Post)
+def queue_post_notifications(sender, instance, created, **kwargs):
+    # The fan-out itself runs in the send_outbound_emails worker
+    if created:
+        PostNotificationJob.objects.create(post=instance)
+
+
+# -------------------- Subscription timelines --------------------
+@receiver(post_save, sender=Post)
+def push_to_timelines(sender, instance, created, **kwargs):
+    if created:
+        timeline.push_post(instance)
+    else:
+        timeline.update_post(instance, getattr(instance, '_cached_category_id', None))
+
+
+@receiver(post_save, sender=Subscription)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created:
+        timeline.subscribed(instance.user_id, instance.category_id)
+
+
+@receiver(post_delete, sender=Subscription)
+def trim_timeline(sender, instance, **kwargs):
+    timeline.unsubscribed(instance.user_id, instance.category_id)
+
+
+# -------------------- Image variants --------------------
+@receiver(post_save, sender=Post)
+def render_image_variants(sender, instance, created, **kwargs):
+    if not created:
+        if getattr(instance, '_cached_image', instance.image.name) == instance.image.name:
+            return
+        # The image was replaced: its variants are stale (the files go away
+        # with the old image, see below)
+        instance.image_variants = {}
+        Post.objects.filter(pk=instance.pk).update(image_variants={})
+    if instance.image:
+        images.schedule(instance.pk)
+
+
+# -------------------- Stored media references --------------------
+@receiver(post_save, sender=Post)
+def reference_image(sender, instance, created, **kwargs):
+    previous = '' if created else getattr(instance, '_cached_image', instance.image.name)
+    if previous == instance.image.name:
+        return
+    if instance.image:
+        media.acquire(instance.image.name)
+    if previous:
+        media.release(previous)
+
+
+@receiver(post_delete, sender=Post)
+def release_image(sender, instance, **kwargs):
+    if instance.image:
+        media.release(instance.image.name)
@@ -0,0 +1,45 @@
+import logging
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# SERIALIZED WRITES
+# =============================================================================
+
+def is_locked_error(exc):
+    message = str(exc).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def retry_if_locked(func):
+    """
+    Run ``func`` in its own transaction and retry it when SQLite reports the
+    database as locked.
+
+    With ``transaction_mode = IMMEDIATE`` the transaction takes the write
+    lock as it begins and waits up to busy_timeout for it, so writers queue
+    up behind each other. This only fails when the wait times out; the
+    decorator then backs off and tries again, up to SQLITE_WRITE_RETRIES
+    times. Calls made inside an enclosing transaction are not retried.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        attempts = getattr(settings, 'SQLITE_WRITE_RETRIES', 3)
+        backoff = getattr(settings, 'SQLITE_WRITE_RETRY_BACKOFF_MS', 50) / 1000
+        for attempt in range(1, attempts + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as exc:
+                if not is_locked_error(exc) or attempt == attempts or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+                    raise
+                logger.warning('Database locked in %s, retrying (attempt %s)', func.__qualname__, attempt)
+            time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    return wrapped
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+
+# =============================================================================
+# CONTENT-ADDRESSED STORAGE
+# =============================================================================
+
+# Post images are stored under the SHA-256 of their bytes instead of the
+# uploaded name, so uploading the same file twice stores it once and a name
+# never changes content (which makes it safe to cache forever). Files shared
+# by several posts are reference-counted in StoredFile, see blog.media.
+CONTENT_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{64}\.[0-9a-z]+$')
+
+# Different spellings of the same extension map to one name
+EXTENSIONS = {'.jpeg': '.jpg', '.jpe': '.jpg', '.tif': '.tiff'}
+
+
+def is_content_addressed(name):
+    return bool(name) and CONTENT_NAME_RE.search(name) is not None
+
+
+def content_name(directory, digest, original_name):
+    ext = posixpath.splitext(original_name)[1].lower()
+    return posixpath.join(directory, digest + EXTENSIONS.get(ext, ext))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that saves each file as ``<upload dir>/<sha256>.<ext>``.
+
+    The upload is hashed while it is streamed to a temporary file next to
+    its destination, then hard-linked into place; if a file with that hash
+    already exists the copy is simply dropped. Concurrent uploads of the same
+    content therefore end up with the same single file.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The name is replaced by the content hash in _save
+        return name
+
+    def _save(self, name, content):
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(directory, self.directory_permissions_mode)
+
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+
+            name = content_name(posixpath.dirname(name), digest.hexdigest(), name)
+            try:
+                os.link(temp_path, self.path(name))
+            except FileExistsError:
+                # Already stored: mark it as just used, so an orphan
+                # collection racing with this upload leaves it alone
+                os.utime(self.path(name))
+        finally:
+            os.unlink(temp_path)
+        return name
+
+
+_post_image_storage = None
+
+
+def post_image_storage():
+    """Storage of Post.image (a callable, so migrations don't capture its settings)."""
+    global _post_image_storage
+    if _post_image_storage is None:
+        _post_image_storage = ContentAddressedStorage()
+    return _post_image_storage
@@ -1,3 +1,1880 @@
-from django.test import TestCase
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import cache_backends, caching, images, metrics, moderation, outbox, profiling, reactions, search, views
+from .management.commands import sync_sqlite_replicas
+from .pagination import PostFeedPagination
+from .serializers import CommentSerializer, CustomTokenObtainPairSerializer, get_subscribed_category_ids
+from .models import (
+    Category, Comment, DigestItem, ForbiddenWord, OutboundEmail, Post, PostLike, PostNotificationJob,
+    QueryOffender, StoredFile, Subscription, Tag, TimelineEntry, User,
+)
+
+# Tests get their own file cache, so they never see (or clear) the
+# development server's version counters
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'blog.cache_backends.VersionFileCache',
+        'LOCATION': tempfile.mkdtemp(prefix='blog-test-cache-'),
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'blog-test-local',
+    },
+}
+
+
+class BlogTestMixin:
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        caches['local'].clear()
+        # The FTS table may have been created in an earlier test's rolled
+        # back transaction after captureOnCommitCallbacks marked it ready
+        getattr(search.get_backend(), '_ready', set()).clear()
+
+    @staticmethod
+    def make_user(username='alice', **fields):
+        return User.objects.create_user(username=username, email=f'{username}@example.com', password='pw', **fields)
+
+    @staticmethod
+    def make_post(author, category, **fields):
+        fields.setdefault('title', 'A post')
+        fields.setdefault('content', 'Some content')
+        return Post.objects.create(author=author, category=category, **fields)
+
+    @staticmethod
+    def auth(user):
+        """Request headers carrying an access token for ``user``, as issued at login."""
+        token = CustomTokenObtainPairSerializer.get_token(user).access_token
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+
+test_settings = override_settings(
+    CACHES=TEST_CACHES,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+
+
+@test_settings
+class BlogTestCase(BlogTestMixin, TestCase):
+    pass
+
+
+@test_settings
+class BlogTransactionTestCase(BlogTestMixin, TransactionTestCase):
+    """For tests that run code in other threads, which only see committed rows."""
+
+
+def run_in_threads(func, jobs, workers=16):
+    """``func(job)`` for every job on a thread pool; returns results and exceptions in job order."""
+    def call(job):
+        try:
+            return func(job)
+        except Exception as exc:
+            return exc
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, jobs))
+
+
+# =============================================================================
+# FORBIDDEN WORD FILTER
+# =============================================================================
+
+class ForbiddenWordFilterTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.post = self.make_post(self.user, Category.objects.create(name='News'))
+
+    def comment(self, content):
+        return Comment.objects.create(user=self.user, post=self.post, content=content)
+
+    def test_masks_words_whatever_their_case(self):
+        ForbiddenWord.objects.create(word='darn')
+        self.assertEqual(self.comment('Darn it, DARN it, darn!').content, '**** it, **** it, ****!')
+
+    def test_overlapping_words_mask_the_longest_match(self):
+        ForbiddenWord.objects.create(word='heck')
+        ForbiddenWord.objects.create(word='heckin')
+        self.assertEqual(self.comment('heckin heck').content, '****** ****')
+
+    def test_word_changes_apply_to_the_next_comment(self):
+        self.assertEqual(self.comment('gosh').content, 'gosh')
+        word = ForbiddenWord.objects.create(word='gosh')
+        self.assertEqual(self.comment('gosh').content, '****')
+        word.delete()
+        self.assertEqual(self.comment('gosh').content, 'gosh')
+
+    def test_bump_from_another_worker_rebuilds_the_matcher(self):
+        self.assertEqual(self.comment('drat').content, 'drat')
+        # Another worker adds a word: the row changes without this process's
+        # signals running, and the stamp is bumped through its own connection
+        # to the shared cache
+        ForbiddenWord.objects.bulk_create([ForbiddenWord(word='drat')])
+        other_worker = caches.create_connection('default')
+        other_worker.set(moderation.FORBIDDEN_WORDS_VERSION_KEY, 'bumped-elsewhere', None)
+        self.assertEqual(self.comment('drat').content, '****')
+
+    def test_saving_a_comment_does_not_load_the_words_again(self):
+        ForbiddenWord.objects.create(word='darn')
+        self.comment('warm up')
+        with self.assertNumQueries(1):
+            self.comment('darn')
+
+
+# =============================================================================
+# REACTION COUNTERS
+# =============================================================================
+
+class ReactionCounterTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user()
+        self.post = self.make_post(self.author, Category.objects.create(name='News'))
+        self.fans = [self.make_user(f'fan{i}') for i in range(12)]
+
+    def counters(self):
+        return Post.objects.values_list('likes', 'dislikes').get(pk=self.post.pk)
+
+    def test_saving_and_deleting_reactions_adjusts_the_counters(self):
+        like = PostLike.objects.create(user=self.fans[0], post=self.post, is_like=True)
+        PostLike.objects.create(user=self.fans[1], post=self.post, is_like=False)
+        self.assertEqual(self.counters(), (1, 1))
+        like.is_like = False
+        like.save()
+        self.assertEqual(self.counters(), (0, 2))
+        like.delete()
+        self.assertEqual(self.counters(), (0, 1))
+
+    def test_eleventh_dislike_deletes_the_post(self):
+        for fan in self.fans[:10]:
+            PostLike.objects.create(user=fan, post=self.post, is_like=False)
+        self.assertEqual(self.counters(), (0, 10))
+        PostLike.objects.create(user=self.fans[10], post=self.post, is_like=False)
+        self.assertFalse(Post.objects.filter(pk=self.post.pk).exists())
+
+    def test_reconcile_command_repairs_drift_and_refreshes_cached_responses(self):
+        PostLike.objects.create(user=self.fans[0], post=self.post, is_like=True)
+        Post.objects.filter(pk=self.post.pk).update(likes=7, dislikes=3)  # drift, no signals
+        url = f'/api/posts/{self.post.pk}/'
+        self.assertEqual(self.client.get(url).json()['likes'], 7)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_reaction_counters', stdout=out)
+        self.assertIn('Fixed 1 post(s)', out.getvalue())
+        self.assertEqual(self.counters(), (1, 0))
+        body = self.client.get(url).json()
+        self.assertEqual((body['likes'], body['dislikes']), (1, 0))
+
+    def test_reconcile_dry_run_changes_nothing(self):
+        Post.objects.filter(pk=self.post.pk).update(likes=4)
+        out = StringIO()
+        call_command('reconcile_reaction_counters', dry_run=True, stdout=out)
+        self.assertIn('Found 1 post(s)', out.getvalue())
+        self.assertEqual(self.counters(), (4, 0))
+
+
+@override_settings(REACTION_WRITE_BEHIND=True)
+class ReactionWriteBehindTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user()
+        self.post = self.make_post(self.author, Category.objects.create(name='News'))
+        self.fan = self.make_user('fan')
+        # A private buffer that flushes on every event and never on a timer
+        self.buffer = reactions.ReactionBuffer(interval=3600, max_events=1)
+        patcher = mock.patch.object(reactions, '_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def react(self, action):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/posts/{self.post.pk}/react/', {'action': action}, **self.auth(self.fan))
+
+    def test_buffered_deltas_are_flushed_to_the_post(self):
+        response = self.react(reactions.LIKE)
+        self.assertEqual(response.status_code, 200)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes, self.post.dislikes), (1, 0))
+        self.assertEqual(self.buffer.pending(self.post.pk), (0, 0))
+
+    def test_failed_flush_keeps_the_reaction_and_retries_later(self):
+        with mock.patch.object(Post, 'adjust_reactions', side_effect=DatabaseError('disk I/O error')):
+            with self.assertLogs('blog.reactions', 'ERROR'):
+                response = self.react(reactions.LIKE)
+        # The reaction committed before the flush, so the click still succeeds
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(PostLike.objects.filter(user=self.fan, post=self.post, is_like=True).exists())
+        self.assertEqual(self.buffer.pending(self.post.pk), (1, 0))
+        # Readers see the unflushed delta merged in
+        self.assertEqual(self.client.get(f'/api/posts/{self.post.pk}/', **self.auth(self.fan)).json()['likes'], 1)
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes, 1)
+        self.assertEqual(self.buffer.pending(self.post.pk), (0, 0))
+
+    def test_timer_thread_recycles_connections_around_each_flush(self):
+        calls = []
+        self.enterContext(mock.patch.object(reactions, 'close_old_connections', lambda: calls.append('close')))
+        self.enterContext(mock.patch.object(self.buffer, 'flush_quietly', lambda: calls.append('flush')))
+        # Two rounds, then stop the loop
+        with mock.patch.object(reactions.time, 'sleep', side_effect=[None, None, SystemExit]):
+            with self.assertRaises(SystemExit):
+                self.buffer._run()
+        self.assertEqual(calls, ['close', 'flush', 'close'] * 2)
+
+    def test_exit_flush_is_registered_quietly(self):
+        with mock.patch.object(reactions, '_buffer', None):
+            with mock.patch.object(reactions.atexit, 'register') as register:
+                buffer = reactions.get_buffer()
+        register.assert_called_once_with(buffer.flush_quietly)
+
+
+class ConcurrentReactionTests(BlogTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user()
+        self.post = self.make_post(self.author, Category.objects.create(name='News'))
+
+    def test_parallel_clicks_lose_no_updates(self):
+        fans = [self.make_user(f'fan{i}') for i in range(100)]
+        # Every fan clicks three times at once, so each click races the
+        # fan's other clicks as well as everyone else's. Only a few fans
+        # dislike, to stay under the auto-delete threshold.
+        clicks = (reactions.LIKE, reactions.LIKE, reactions.LIKE)
+        dislikes = (reactions.DISLIKE, reactions.LIKE, reactions.DISLIKE)
+        jobs = [(fan, action) for i, fan in enumerate(fans) for action in (dislikes if i < 8 else clicks)]
+        results = run_in_threads(lambda job: reactions.react(job[0], self.post.pk, job[1]), jobs)
+
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        self.post.refresh_from_db()
+        stored = PostLike.objects.filter(post=self.post)
+        self.assertEqual(self.post.likes, stored.filter(is_like=True).count())
+        self.assertEqual(self.post.dislikes, stored.filter(is_like=False).count())
+        self.assertLessEqual(self.post.dislikes, 10)
+
+    def test_parallel_dislikes_delete_the_post_once(self):
+        fans = [self.make_user(f'fan{i}') for i in range(40)]
+        results = run_in_threads(lambda fan: reactions.react(fan, self.post.pk, reactions.DISLIKE), fans)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.assertTrue(all(isinstance(error, Post.DoesNotExist) for error in errors), errors)
+        states = [result for result in results if not isinstance(result, Exception)]
+        self.assertEqual(len(states), 11)
+        self.assertEqual(sum(state['deleted'] for state in states), 1)
+        self.assertFalse(Post.objects.filter(pk=self.post.pk).exists())
+        self.assertFalse(PostLike.objects.exists())
+
+
+# =============================================================================
+# JWT PRINCIPALS
+# =============================================================================
+
+# Blocks a user from a separate process, as another worker would
+BLOCK_USER_SCRIPT = """
+import sys
+import django
+from django.conf import settings
+
+django.setup()
+settings.DATABASES['default']['NAME'], settings.CACHES['default']['LOCATION'], user_id = sys.argv[1:]
+from blog.models import User
+
+user = User.objects.get(pk=user_id)
+user.is_blocked = True
+user.save()
+"""
+
+
+class RevocationTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = self.make_user('admin', is_admin=True)
+        self.user = self.make_user('mallory')
+
+    def get_subscriptions(self, headers):
+        return self.client.get('/user/subscriptions/', **headers).status_code
+
+    def test_blocking_rejects_tokens_already_issued(self):
+        headers = self.auth(self.user)
+        self.assertEqual(self.get_subscriptions(headers), 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/api/admin/users/{self.user.pk}/block_unblock/', {'action': 'block'}, **self.auth(self.admin)
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_subscriptions(headers), 401)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/api/admin/users/{self.user.pk}/block_unblock/', {'action': 'unblock'}, **self.auth(self.admin)
+            )
+        self.assertEqual(self.get_subscriptions(headers), 200)
+
+    def test_demotion_revokes_admin_rights(self):
+        other_admin = self.make_user('root', is_admin=True)
+        headers = self.auth(other_admin)
+        self.assertEqual(self.client.get('/api/admin/users/', **headers).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/api/admin/users/{other_admin.pk}/promote_demote/', {'action': 'demote'}, **self.auth(self.admin)
+            )
+        self.assertEqual(self.client.get('/api/admin/users/', **headers).status_code, 403)
+
+
+class CrossProcessRevocationTests(BlogTransactionTestCase):
+    def test_block_in_another_process_applies_here(self):
+        user = self.make_user('mallory')
+        headers = self.auth(user)
+        # Caches the principal in this process
+        self.assertEqual(self.client.get('/user/subscriptions/', **headers).status_code, 200)
+        self.assertEqual(self.client.get('/user/subscriptions/', **headers).status_code, 200)
+
+        subprocess.run(
+            [sys.executable, '-c', BLOCK_USER_SCRIPT, str(connection.settings_dict['NAME']),
+             str(TEST_CACHES['default']['LOCATION']), str(user.pk)],
+            cwd=settings.BASE_DIR, env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'blogproject.settings'},
+            check=True, capture_output=True,
+        )
+        self.assertEqual(self.client.get('/user/subscriptions/', **headers).status_code, 401)
+
+
+# =============================================================================
+# READ REPLICAS
+# =============================================================================
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(BlogTransactionTestCase):
+    """
+    Runs against a 'replica' alias that is a separate SQLite file, copied
+    from the primary only when the test calls replicate(), so every read
+    that reaches it sees the data as of the last copy.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        handle, cls.replica_path = tempfile.mkstemp(prefix='blog-test-replica-', suffix='.sqlite3')
+        os.close(handle)
+        connections.settings['replica'] = connections.configure_settings(
+            {'default': {}, 'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': cls.replica_path}}
+        )['replica']
+        # Only now, since the test runner can't set up an alias missing
+        # from DATABASES; this also flushes it after every test
+        cls.databases = {*cls.databases, 'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.remove(cls.replica_path)
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user('author')
+        self.fan = self.make_user('fan')
+        self.post = self.make_post(self.author, Category.objects.create(name='News'), title='Replicated')
+        self.replicate()
+        # Caught up, so the setup writes' sticky windows no longer matter
+        cache.clear()
+
+    def replicate(self):
+        """Bring the replica up to date, as replication catching up would."""
+        connections['replica'].close()
+        sync_sqlite_replicas.Command().sync(str(connection.settings_dict['NAME']), self.replica_path)
+
+    def likes(self, **headers):
+        return self.client.get(f'/api/posts/{self.post.pk}/', **headers).json()['likes']
+
+    def test_reads_go_to_the_replica(self):
+        Post.objects.filter(pk=self.post.pk).update(title='Primary only')
+        self.assertEqual(self.client.get(f'/api/posts/{self.post.pk}/').json()['title'], 'Replicated')
+        caches['local'].clear()
+        response = self.client.get(f'/api/posts/{self.post.pk}/', **self.auth(self.fan))
+        self.assertEqual(response.json()['title'], 'Replicated')
+
+    def test_writer_reads_its_own_writes(self):
+        fan = self.auth(self.fan)
+        response = self.client.post(f'/posts/{self.post.pk}/react/', {'action': reactions.LIKE}, **fan)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.likes(**fan), 1)
+        # Another client isn't pinned and sees the lagging replica
+        self.assertEqual(self.likes(**self.auth(self.author)), 0)
+        self.replicate()
+        self.assertEqual(self.likes(**self.auth(self.author)), 1)
+
+    def test_cache_fill_after_a_write_reads_the_primary(self):
+        self.assertEqual(self.likes(), 0)
+        self.client.post(f'/posts/{self.post.pk}/react/', {'action': reactions.LIKE}, **self.auth(self.fan))
+        # The post's version was just bumped, so the miss renders from the
+        # primary rather than caching the replica's stale row
+        self.assertEqual(self.likes(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.likes(), 1)
+
+
+# =============================================================================
+# POST LISTS
+# =============================================================================
+
+class PostListQueryTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = self.make_user('reader')
+        self.author = self.make_user('author')
+        self.category = Category.objects.create(name='News')
+        self.tags = [Tag.objects.create(name=f'tag{i}') for i in range(3)]
+
+    def add_posts(self, count):
+        posts = []
+        for i in range(count):
+            post = self.make_post(self.author, self.category, title=f'post {i}')
+            post.tags.set(self.tags)
+            posts.append(post)
+        for post in posts[::2]:
+            PostLike.objects.create(user=self.reader, post=post, is_like=True)
+        for post in posts[1::4]:
+            PostLike.objects.create(user=self.reader, post=post, is_like=False)
+        return posts
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **self.auth(self.reader))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def test_page_query_count_is_constant(self):
+        self.add_posts(10)
+        small, _ = self.count_queries('/api/posts/?page_size=100')
+        self.add_posts(90)
+        for url in ('/api/posts/?page_size=100', f'/categories/{self.category.pk}/posts/?page_size=100'):
+            with self.subTest(url=url):
+                large, results = self.count_queries(url)
+                self.assertEqual(len(results), 100)
+                # The page with author and category, the reader's reactions, the tags
+                # and the reader's subscriptions
+                self.assertEqual(large, 4)
+                self.assertEqual(large, small)
+
+    def test_page_carries_the_readers_reactions(self):
+        posts = self.add_posts(8)
+        _, results = self.count_queries('/api/posts/?page_size=100')
+        by_id = {result['id']: result for result in results}
+        liked = {post.pk for post in posts[::2]}
+        disliked = {post.pk for post in posts[1::4]}
+        for post in posts:
+            self.assertEqual(by_id[post.pk]['liked_by_me'], post.pk in liked)
+            self.assertEqual(by_id[post.pk]['disliked_by_me'], post.pk in disliked)
+            self.assertEqual(len(by_id[post.pk]['tags']), 3)
+
+
+class PostStreamTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        author = self.make_user()
+        self.news = Category.objects.create(name='News')
+        sport = Category.objects.create(name='Sport')
+        for i in range(7):
+            self.make_post(author, self.news if i % 2 else sport, title=f'post {i}')
+
+    def test_wsgi_streams_from_a_sync_iterator(self):
+        with mock.patch.object(views.PostListByCategory, 'stream_chunk_size', 2):
+            response = self.client.get('/posts/by-category/', {'stream': 'json'})
+        self.assertFalse(response.is_async)
+        posts = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([post['title'] for post in posts], [f'post {i}' for i in range(6, -1, -1)])
+
+    async def test_asgi_streams_from_an_async_iterator(self):
+        with mock.patch.object(views.PostListByCategory, 'stream_chunk_size', 2):
+            response = await self.async_client.get(
+                '/posts/by-category/', {'stream': 'ndjson', 'category_id': self.news.pk}
+            )
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+        # A chunk of two posts, one with the last post, then the trailing newline
+        self.assertEqual(len(chunks), 3)
+        lines = b''.join(chunks).decode().splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in lines], ['post 5', 'post 3', 'post 1'])
+
+
+class AsyncViewParityTests(BlogTestCase):
+    """Each async view answers exactly like the sync view it stands in for."""
+
+    def setUp(self):
+        super().setUp()
+        self.reader = self.make_user('reader')
+        author = self.make_user('author')
+        self.category = Category.objects.create(name='News')
+        tag = Tag.objects.create(name='python')
+        self.posts = [self.make_post(author, self.category, title=f'post {i}') for i in range(7)]
+        self.posts[0].tags.add(tag)
+        PostLike.objects.create(user=self.reader, post=self.posts[0], is_like=True)
+        Subscription.objects.create(user=self.reader, category=self.category)
+        parent = Comment.objects.create(user=self.reader, post=self.posts[0], content='top')
+        Comment.objects.create(user=author, post=self.posts[0], parent=parent, content='reply')
+        self.headers = {'Authorization': self.auth(self.reader)['HTTP_AUTHORIZATION']}
+
+    def sync_get(self, view, path, params, headers, **kwargs):
+        response = view(RequestFactory().get(path, params, headers=headers), **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    async def assert_same_response(self, view, path, params=None, **kwargs):
+        post = self.posts[0]
+        for headers in ({}, self.headers):
+            with self.subTest(path=path, params=params, authenticated=bool(headers)):
+                # Separate cache entries, so neither answer is the other's replay
+                await caches['local'].aclear()
+                expected = await sync_to_async(self.sync_get)(view, path, params, headers, **kwargs)
+                await caches['local'].aclear()
+                response = await self.async_client.get(path, params, headers=headers)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.json(), json.loads(expected.content))
+
+    async def test_post_list(self):
+        cursor = PostFeedPagination().encode_cursor([self.posts[4].publish_date, self.posts[4].pk])
+        for params in (None, {'page': 2}, {'cursor': cursor}, {'cursor': 'garbage'}, {'page': 99}):
+            await self.assert_same_response(views.view_add_post, '/api/posts/', params)
+
+    async def test_post_detail(self):
+        for post_id in (self.posts[0].pk, 0):
+            await self.assert_same_response(views.post_by_id, f'/api/posts/{post_id}/', id=post_id)
+
+    async def test_category_list(self):
+        await self.assert_same_response(views.get_categories, '/categories/')
+
+    async def test_category_posts(self):
+        for category_id in (self.category.pk, 0):
+            await self.assert_same_response(
+                views.get_posts_by_category_id, f'/categories/{category_id}/posts/', id=category_id
+            )
+
+    async def test_post_comments(self):
+        view = views.CommentListCreateView.as_view()
+        post_id = self.posts[0].pk
+        for params in (None, {'max_depth': 1}, {'top_level_only': 'true'}, {'cursor': 'garbage'}):
+            await self.assert_same_response(view, f'/posts/{post_id}/comments/', params, post_id=post_id)
+
+    async def test_subscribe_queues_the_confirmation(self):
+        other = await Category.objects.acreate(name='Sport')
+        url = '/user/subscribe/'
+        response = await self.async_client.post(url, {'category_id': other.pk}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'message': 'Subscribed to category: Sport'})
+        email = await OutboundEmail.objects.aget()
+        self.assertEqual((email.recipient, email.subject), ('reader@example.com', 'Subscription Confirmation'))
+
+        response = await self.async_client.post(
+            url, {'category_id': other.pk, 'digest': Subscription.DAILY}, headers=self.headers
+        )
+        self.assertEqual(response.json(), {'message': 'Updated subscription to category: Sport'})
+        self.assertEqual(await OutboundEmail.objects.acount(), 1)
+
+        cases = [
+            ({}, self.headers, 400),
+            ({'category_id': other.pk, 'digest': 'weekly'}, self.headers, 400),
+            ({'category_id': 0}, self.headers, 404),
+            ({'category_id': other.pk}, {}, 401),
+        ]
+        for data, headers, status in cases:
+            with self.subTest(data=data, authenticated=bool(headers)):
+                response = await self.async_client.post(url, data, headers=headers)
+                self.assertEqual(response.status_code, status)
+                expected = await sync_to_async(views.subscribe_to_category)(
+                    RequestFactory().post(url, data, headers=headers)
+                )
+                await sync_to_async(expected.render)()
+                self.assertEqual(response.json(), json.loads(expected.content))
+
+
+class PostFeedPaginationTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        author = self.make_user()
+        category = Category.objects.create(name='News')
+        self.posts = [self.make_post(author, category, title=f'post {i}') for i in range(12)]
+        self.newest_first = [post.pk for post in reversed(self.posts)]
+
+    def get(self, url, params=None, status=200):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status)
+        return response.json()
+
+    def ids(self, page):
+        return [result['id'] for result in page['results']]
+
+    def test_orderings_are_whitelisted(self):
+        page = self.get('/api/posts/', {'ordering': 'publish_date', 'page_size': 100})
+        self.assertEqual(self.ids(page), self.newest_first[::-1])
+        for ordering in ('-publish_date', 'title', 'author__password', '-id'):
+            with self.subTest(ordering=ordering):
+                page = self.get('/api/posts/', {'ordering': ordering, 'page_size': 100})
+                self.assertEqual(self.ids(page), self.newest_first)
+
+    @override_settings(POST_FEED_MAX_PAGE_NUMBER=2)
+    def test_page_numbers_stop_at_the_maximum(self):
+        self.assertEqual(self.ids(self.get('/api/posts/', {'page': 2})), self.newest_first[5:10])
+        for page in ('3', '0', 'two'):
+            with self.subTest(page=page):
+                self.get('/api/posts/', {'page': page}, status=404)
+
+    @override_settings(POST_FEED_MAX_PAGE_NUMBER=2)
+    def test_last_numbered_page_links_to_a_cursor(self):
+        page = self.get('/api/posts/', {'page': 1})
+        self.assertIsNone(page['previous'])
+        self.assertIn('page=2', page['next'])
+
+        page = self.get(page['next'])
+        self.assertIn('page=1', page['previous'])
+        self.assertIn('cursor=', page['next'])
+        self.assertNotIn('page=', page['next'])
+
+        page = self.get(page['next'])
+        self.assertEqual(self.ids(page), self.newest_first[10:])
+        self.assertIsNone(page['next'])
+
+    def test_cursor_pages_cover_the_feed_once(self):
+        seen, url = [], '/api/posts/?ordering=publish_date'
+        while url:
+            page = self.get(url)
+            seen += self.ids(page)
+            url = page['next']
+        self.assertEqual(seen, self.newest_first[::-1])
+
+    def test_invalid_cursors_are_not_found(self):
+        pagination = PostFeedPagination()
+        for cursor in ('garbage', pagination.encode_cursor(['not a date', 1]), pagination.encode_cursor([1])):
+            with self.subTest(cursor=cursor):
+                page = self.get('/api/posts/', {'cursor': cursor}, status=404)
+                self.assertEqual(page['detail'], 'Invalid cursor')
+
+
+# =============================================================================
+# CACHED RESPONSES
+# =============================================================================
+
+def no_queries(execute, sql, params, many, context):
+    raise AssertionError(f'Unexpected query: {sql}')
+
+
+class CachedResponseTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = self.make_user('reader')
+        self.category = Category.objects.create(name='News')
+        self.tag = Tag.objects.create(name='python')
+        self.post = self.make_post(self.make_user('author'), self.category, title='Before')
+        self.post.tags.add(self.tag)
+        self.detail = f'/api/posts/{self.post.pk}/'
+
+    def test_responses_carry_a_strong_etag(self):
+        response = self.client.get(self.detail)
+        self.assertRegex(response['ETag'], r'^"[0-9a-f]{32}"$')
+        self.assertEqual(response['ETag'], '"%s"' % hashlib.sha256(response.content).hexdigest()[:32])
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(self.client.get(self.detail)['ETag'], response['ETag'])
+
+    def test_matching_if_none_match_is_answered_without_queries(self):
+        etag = self.client.get(self.detail)['ETag']
+        with connection.execute_wrapper(no_queries):
+            response = self.client.get(self.detail, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(self.detail, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_authenticated_requests_bypass_the_cache(self):
+        self.client.get(self.detail)
+        response = self.client.get(self.detail, **self.auth(self.reader))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+    def edit_post(self):
+        self.post.title = 'After'
+        self.post.save()
+
+    def add_comment(self):
+        Comment.objects.create(user=self.reader, post=self.post, content='First!')
+
+    def add_like(self):
+        PostLike.objects.create(user=self.reader, post=self.post, is_like=True)
+
+    def rename_tag(self):
+        self.tag.name = 'django'
+        self.tag.save()
+
+    def rename_category(self):
+        self.category.name = 'World'
+        self.category.save()
+
+    def test_row_changes_invalidate_cached_responses(self):
+        feeds = ['/api/posts/', f'/categories/{self.category.pk}/posts/']
+        changes = [
+            (self.edit_post, [self.detail, *feeds], 'After'),
+            (self.add_comment, [f'/posts/{self.post.pk}/comments/'], 'First!'),
+            (self.add_like, [self.detail, *feeds], '"likes":1'),
+            (self.rename_tag, [self.detail, *feeds], 'django'),
+            (self.rename_category, [self.detail, '/categories/', *feeds], 'World'),
+        ]
+        for change, urls, expected in changes:
+            with self.subTest(change=change.__name__):
+                etags = {url: self.client.get(url)['ETag'] for url in urls}
+                with self.captureOnCommitCallbacks(execute=True):
+                    change()
+                for url, etag in etags.items():
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                    self.assertEqual(response.status_code, 200, url)
+                    self.assertNotEqual(response['ETag'], etag)
+                    self.assertIn(expected, response.content.decode(), url)
+
+
+class VersionCacheTests(BlogTestCase):
+    def test_versions_survive_past_max_entries(self):
+        with override_settings(CACHES={**TEST_CACHES, 'default': {
+            **TEST_CACHES['default'], 'OPTIONS': {'MAX_ENTRIES': 10},
+        }}):
+            names = [caching.post_version(post_id) for post_id in range(50)]
+            versions = caching.get_versions(names)
+            with self.captureOnCommitCallbacks(execute=True):
+                caching.bump(*[caching.category_version(category_id) for category_id in range(20)])
+            self.assertEqual(caching.get_versions(names), versions)
+
+            # No directory listing per write either
+            with mock.patch.object(cache_backends.VersionFileCache, '_list_cache_files') as listing:
+                with self.captureOnCommitCallbacks(execute=True):
+                    caching.bump(caching.FEED)
+            listing.assert_not_called()
+
+
+class AuthorRenameTests(BlogTestCase):
+    def test_renaming_a_user_invalidates_cached_posts_and_threads(self):
+        author = self.make_user('alice')
+        commenter = self.make_user('bob')
+        category = Category.objects.create(name='News')
+        post = self.make_post(author, category)
+        other = self.make_post(commenter, category, title='Other')
+        Comment.objects.create(user=commenter, post=post, content='hi')
+        urls = ['/api/posts/', f'/api/posts/{post.pk}/', f'/categories/{category.pk}/posts/']
+        for url in urls:
+            self.client.get(url)
+        self.client.get(f'/api/posts/{post.pk}/comments/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            author.username = 'alicia'
+            author.save()
+            commenter.username = 'robert'
+            commenter.save(update_fields=['username'])
+
+        feed = {item['id']: item for item in self.client.get('/api/posts/').json()['results']}
+        self.assertEqual(feed[post.pk]['author']['username'], 'alicia')
+        self.assertEqual(feed[other.pk]['author']['username'], 'robert')
+        self.assertEqual(self.client.get(f'/api/posts/{post.pk}/').json()['author']['username'], 'alicia')
+        by_category = self.client.get(f'/categories/{category.pk}/posts/').json()['results']
+        self.assertEqual({item['author']['username'] for item in by_category}, {'alicia', 'robert'})
+        comments = self.client.get(f'/api/posts/{post.pk}/comments/').json()['results']
+        self.assertEqual(comments[0]['user'], 'robert')
+
+
+class PostRevisionTests(BlogTestCase):
+    def test_saving_a_stale_instance_moves_past_bumped_revisions(self):
+        user = self.make_user()
+        category = Category.objects.create(name='News')
+        post = self.make_post(user, category, title='Before')
+        stale = Post.objects.get(pk=post.pk)
+
+        # Renaming the category bumps the post's revision behind `stale`'s back,
+        # and the next read caches a fragment under it
+        category.name = 'World'
+        category.save()
+        url = f'/api/posts/{post.pk}/'
+        self.assertEqual(self.client.get(url, **self.auth(user)).json()['title'], 'Before')
+
+        stale.title = 'After'
+        stale.save()
+        self.assertEqual(stale.revision, Post.objects.get(pk=post.pk).revision)
+        self.assertEqual(stale.revision, 3)
+        self.assertEqual(self.client.get(url, **self.auth(user)).json()['title'], 'After')
+
+    def test_update_fields_and_tag_changes_track_the_stored_revision(self):
+        post = self.make_post(self.make_user(), Category.objects.create(name='News'))
+        self.assertEqual(post.revision, 1)
+        Post.bump_revisions(pk=post.pk)
+        post.title = 'Renamed'
+        post.save(update_fields=['title'])
+        self.assertEqual(post.revision, 3)
+        post.tags.add(Tag.objects.create(name='python'))
+        self.assertEqual(post.revision, 4)
+        self.assertEqual(Post.objects.get(pk=post.pk).revision, 4)
+
+
+# =============================================================================
+# COMMENT THREADS
+# =============================================================================
+
+class CommentThreadTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.post = self.make_post(self.user, Category.objects.create(name='News'))
+
+    def build_thread(self, top_level, fan_out, depth):
+        """``top_level`` comments, each with ``fan_out`` replies per level down to ``depth``."""
+        level = [Comment.objects.create(user=self.user, post=self.post, content=f'c{i}') for i in range(top_level)]
+        for _ in range(depth):
+            level = [
+                Comment.objects.create(user=self.user, post=self.post, parent=parent, content='reply')
+                for parent in level for _ in range(fan_out)
+            ]
+
+    def comments(self, **params):
+        return self.client.get(f'/api/posts/{self.post.pk}/comments/', params)
+
+    def test_query_count_does_not_grow_with_the_thread(self):
+        # One query for the page of top-level comments, one per reply level
+        self.build_thread(top_level=2, fan_out=1, depth=3)
+        with self.assertNumQueries(4):
+            small = self.comments(max_depth=3, page_size=50).json()['results']
+        caches['local'].clear()
+        self.build_thread(top_level=20, fan_out=3, depth=3)
+        with self.assertNumQueries(4):
+            large = self.comments(max_depth=3, page_size=50).json()['results']
+        self.assertEqual(len(small), 2)
+        self.assertEqual(len(large), 22)
+
+    def test_replies_are_nested_once_and_not_repeated_at_the_top(self):
+        self.build_thread(top_level=1, fan_out=2, depth=2)
+        results = self.comments(max_depth=5).json()['results']
+        self.assertEqual(len(results), 1)
+        replies = results[0]['replies']
+        self.assertEqual([len(reply['replies']) for reply in replies], [2, 2])
+        self.assertEqual(results[0]['reply_count'], 2)
+
+    def test_top_level_only_and_max_depth(self):
+        self.build_thread(top_level=1, fan_out=1, depth=3)
+        with self.assertNumQueries(1):
+            top = self.comments(top_level_only='true').json()['results']
+        self.assertEqual(top[0]['replies'], [])
+        self.assertEqual(top[0]['reply_count'], 1)
+        caches['local'].clear()
+        one_level = self.comments(max_depth=1).json()['results']
+        self.assertEqual(one_level[0]['replies'][0]['replies'], [])
+        with override_settings(COMMENT_MAX_DEPTH=2):
+            caches['local'].clear()
+            capped = self.comments(max_depth=10).json()['results']
+        self.assertEqual(capped[0]['replies'][0]['replies'][0]['replies'], [])
+
+    def test_unloaded_replies_are_not_queried(self):
+        self.build_thread(top_level=3, fan_out=2, depth=2)
+        comments = list(Comment.objects.filter(parent__isnull=True).select_related('user'))
+        with self.assertNumQueries(0):
+            data = CommentSerializer(comments, many=True).data
+        self.assertEqual([comment['replies'] for comment in data], [[], [], []])
+        self.assertEqual([comment['reply_count'] for comment in data], [2, 2, 2])
+
+    def test_default_depth_limit_bounds_the_query_count(self):
+        self.build_thread(top_level=1, fan_out=1, depth=8)
+        # The top-level page plus COMMENT_MAX_DEPTH reply levels
+        with self.assertNumQueries(1 + settings.COMMENT_MAX_DEPTH):
+            results = self.comments(max_depth=100).json()['results']
+        depth, replies = 0, results[0]['replies']
+        while replies:
+            depth += 1
+            replies = replies[0]['replies']
+        self.assertEqual(depth, settings.COMMENT_MAX_DEPTH)
+
+    def test_rebuild_reply_counts_backfills_existing_rows(self):
+        self.build_thread(top_level=2, fan_out=2, depth=1)
+        # Rows written before reply_count existed, or behind the signals' back
+        Comment.objects.update(reply_count=0)
+        self.comments()
+        out = StringIO()
+        call_command('rebuild_reply_counts', '--dry-run', stdout=out)
+        self.assertIn('Found 2 comment(s)', out.getvalue())
+        self.assertFalse(Comment.objects.filter(reply_count__gt=0).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_reply_counts', stdout=StringIO())
+        counts = sorted(Comment.objects.filter(parent__isnull=True).values_list('reply_count', flat=True))
+        self.assertEqual(counts, [2, 2])
+        # The cached comment list was invalidated
+        results = self.comments().json()['results']
+        self.assertEqual([comment['reply_count'] for comment in results], [2, 2])
+
+
+# =============================================================================
+# EMAIL OUTBOX
+# =============================================================================
+
+LOCMEM_EMAIL = override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+
+
+def fail_for(*recipients):
+    """Patch the locmem backend to raise for messages to ``recipients``."""
+    send_messages = locmem.EmailBackend.send_messages
+
+    def flaky(backend, messages):
+        for message in messages:
+            if set(message.to) & set(recipients):
+                raise ConnectionResetError('SMTP connection dropped')
+        return send_messages(backend, messages)
+    return mock.patch.object(locmem.EmailBackend, 'send_messages', flaky)
+
+
+@LOCMEM_EMAIL
+class OutboxTests(BlogTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.category = Category.objects.create(name='News')
+
+    def drain(self):
+        out = StringIO()
+        call_command('send_outbound_emails', once=True, stdout=out)
+        return out.getvalue()
+
+    def test_subscribing_queues_the_confirmation_without_sending(self):
+        for _ in range(2):
+            response = self.client.post(
+                '/user/subscribe/', {'category_id': self.category.pk}, **self.auth(self.user)
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(mail.outbox, [])
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.recipient, email.status), ('alice@example.com', OutboundEmail.PENDING))
+
+        self.assertIn('Sent 1 email(s), 0 failed.', self.drain())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
+        self.assertEqual(mail.outbox[0].subject, 'Subscription Confirmation')
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.SENT, 1))
+        self.assertIsNotNone(email.sent_at)
+        self.drain()
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_OUTBOX_BATCH_SIZE=2)
+    def test_worker_drains_every_batch(self):
+        for i in range(5):
+            outbox.enqueue_email(f'user{i}@example.com', 'Hi', 'Body')
+        self.assertIn('Sent 5 email(s), 0 failed.', self.drain())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [f'user{i}@example.com' for i in range(5)])
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RETRY_BASE_SECONDS=60)
+    def test_failures_back_off_then_give_up(self):
+        good = outbox.enqueue_email('good@example.com', 'Hi', 'Body')
+        bad = outbox.enqueue_email('bad@example.com', 'Hi', 'Body')
+        with fail_for('bad@example.com'), self.assertLogs('blog.outbox', 'WARNING'):
+            self.assertIn('Sent 1 email(s), 1 failed.', self.drain())
+        bad.refresh_from_db()
+        self.assertEqual((bad.status, bad.attempts), (OutboundEmail.PENDING, 1))
+        self.assertIn('ConnectionResetError', bad.last_error)
+        self.assertGreater(bad.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Not due yet: the next run leaves it alone
+        with fail_for('bad@example.com'):
+            self.drain()
+        self.assertEqual(OutboundEmail.objects.get(pk=bad.pk).attempts, 1)
+
+        OutboundEmail.objects.filter(pk=bad.pk).update(next_attempt_at=timezone.now())
+        with fail_for('bad@example.com'), self.assertLogs('blog.outbox', 'WARNING'):
+            self.drain()
+        bad.refresh_from_db()
+        self.assertEqual((bad.status, bad.attempts), (OutboundEmail.FAILED, 2))
+        self.assertEqual([message.to for message in mail.outbox], [['good@example.com']])
+        self.assertEqual(OutboundEmail.objects.get(pk=good.pk).status, OutboundEmail.SENT)
+
+    def test_unreachable_server_pushes_the_batch_back(self):
+        email = outbox.enqueue_email('alice@example.com', 'Hi', 'Body')
+        refused = mock.patch.object(locmem.EmailBackend, 'open', side_effect=OSError('connection refused'))
+        with refused, self.assertLogs('blog.outbox', 'WARNING'):
+            self.assertEqual(outbox.send_batch(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.PENDING, 1))
+        self.assertEqual(mail.outbox, [])
+
+    def test_concurrent_workers_send_each_email_once(self):
+        OutboundEmail.objects.bulk_create([
+            OutboundEmail(recipient=f'user{i}@example.com', subject='Hi', body='Body') for i in range(300)
+        ])
+
+        def worker(_):
+            sent = 0
+            while True:
+                batch_sent, _failed = outbox.send_batch(batch_size=10)
+                if not batch_sent:
+                    return sent
+                sent += batch_sent
+
+        results = run_in_threads(worker, range(8), workers=8)
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        self.assertEqual(sum(results), 300)
+        recipients = [message.to[0] for message in mail.outbox]
+        self.assertEqual(len(recipients), 300)
+        self.assertEqual(len(set(recipients)), 300)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT, attempts=1).count(), 300)
+
+    def test_claims_expire_when_a_worker_dies(self):
+        email = outbox.enqueue_email('alice@example.com', 'Hi', 'Body')
+        self.assertEqual(outbox.claim_due_emails(10), [email])
+        # The claiming worker never reports back
+        self.assertEqual(outbox.claim_due_emails(10), [])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.SENDING)
+        OutboundEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(outbox.send_batch(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+
+
+@LOCMEM_EMAIL
+class NotificationTests(BlogTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user('author')
+        self.category = Category.objects.create(name='News')
+
+    def subscribe(self, count, digest=Subscription.IMMEDIATE, prefix='reader'):
+        readers = [self.make_user(f'{prefix}{i}') for i in range(count)]
+        for reader in readers:
+            Subscription.objects.create(user=reader, category=self.category, digest=digest)
+        return readers
+
+    def publish(self, title='Big news'):
+        return self.make_post(self.author, self.category, title=title)
+
+    def test_fan_out_queues_emails_and_digest_items(self):
+        immediate = self.subscribe(5)
+        hourly = self.subscribe(2, Subscription.HOURLY, prefix='hourly')
+        Subscription.objects.create(user=self.author, category=self.category)
+        no_email = self.make_user('ghost')
+        User.objects.filter(pk=no_email.pk).update(email='')
+        Subscription.objects.create(user=no_email, category=self.category)
+        post = self.publish()
+
+        self.assertEqual(outbox.run_notification_jobs(chunk_size=2), 8)
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list('recipient', flat=True)),
+            sorted(reader.email for reader in immediate),
+        )
+        self.assertEqual(OutboundEmail.objects.first().subject, 'New post in News: Big news')
+        self.assertEqual(
+            sorted(DigestItem.objects.values_list('user_id', 'post_id', 'frequency')),
+            [(reader.pk, post.pk, Subscription.HOURLY) for reader in hourly],
+        )
+        job = PostNotificationJob.objects.get()
+        self.assertIsNotNone(job.completed_at)
+        self.assertEqual(job.cursor, Subscription.objects.latest('id').pk)
+        self.assertEqual(outbox.run_notification_jobs(chunk_size=2), 0)
+
+    def test_stale_copy_of_a_job_queues_nothing(self):
+        self.subscribe(5)
+        self.publish()
+        job = PostNotificationJob.objects.select_related('post__category').get()
+        stale = PostNotificationJob.objects.select_related('post__category').get()
+
+        self.assertEqual(outbox.fan_out(job, chunk_size=2), 5)
+        self.assertEqual(outbox.fan_out(stale, chunk_size=2), 0)
+        self.assertEqual(OutboundEmail.objects.count(), 5)
+
+    def test_concurrent_workers_notify_each_subscriber_once(self):
+        readers = self.subscribe(60)
+        self.publish()
+
+        results = run_in_threads(lambda _: outbox.run_notification_jobs(chunk_size=5), range(4), workers=4)
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        self.assertEqual(sum(results), 60)
+        recipients = list(OutboundEmail.objects.values_list('recipient', flat=True))
+        self.assertEqual(sorted(recipients), sorted(reader.email for reader in readers))
+
+    def age_digest_items(self, **delta):
+        DigestItem.objects.update(created_at=timezone.now() - timedelta(**delta))
+
+    def test_due_digests_roll_up_into_one_email_per_user(self):
+        hourly = self.subscribe(2, Subscription.HOURLY, prefix='hourly')
+        daily = self.subscribe(1, Subscription.DAILY, prefix='daily')
+        for title in ('First', 'Second'):
+            self.publish(title)
+        outbox.run_notification_jobs()
+        self.age_digest_items(hours=2)
+
+        self.assertEqual(outbox.build_digests(chunk_size=1), 2)
+        emails = OutboundEmail.objects.order_by('recipient')
+        self.assertEqual([email.recipient for email in emails], [reader.email for reader in hourly])
+        self.assertEqual(emails[0].subject, 'Your hourly digest: 2 new post(s)')
+        self.assertIn('- First (News)\n- Second (News)', emails[0].body)
+        # Daily items wait for their day
+        self.assertEqual(list(DigestItem.objects.values_list('user_id', flat=True).distinct()), [daily[0].pk])
+        self.assertEqual(outbox.build_digests(), 0)
+
+        self.age_digest_items(days=2)
+        self.assertEqual(outbox.build_digests(), 1)
+        self.assertFalse(DigestItem.objects.exists())
+
+    def test_concurrent_digest_builders_send_each_digest_once(self):
+        readers = self.subscribe(20, Subscription.HOURLY)
+        self.publish()
+        outbox.run_notification_jobs()
+        self.age_digest_items(hours=2)
+
+        results = run_in_threads(lambda _: outbox.build_digests(chunk_size=3), range(4), workers=4)
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        self.assertEqual(sum(results), 20)
+        recipients = list(OutboundEmail.objects.values_list('recipient', flat=True))
+        self.assertEqual(sorted(recipients), sorted(reader.email for reader in readers))
+
+
+# =============================================================================
+# SUBSCRIPTION TIMELINES
+# =============================================================================
+
+class TimelineTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = self.make_user('reader')
+        self.author = self.make_user('author')
+        self.news, self.sport, self.music = (Category.objects.create(name=name) for name in ('News', 'Sport', 'Music'))
+
+    def publish(self, category, count=1):
+        return [self.make_post(self.author, category, title=f'{category.name} {i}') for i in range(count)]
+
+    def subscribe(self, category):
+        response = self.client.post('/user/subscribe/', {'category_id': category.pk}, **self.auth(self.reader))
+        self.assertEqual(response.status_code, 200)
+
+    def feed(self, page_size=4):
+        """Every post id of the reader's feed, following the cursor page by page."""
+        ids = []
+        url = f'/user/feed/?page_size={page_size}'
+        while url:
+            data = self.client.get(url, **self.auth(self.reader)).json()
+            ids += [post['id'] for post in data['results']]
+            url = data['next']
+        return ids
+
+    def newest_first(self, posts):
+        return [post.pk for post in sorted(posts, key=lambda post: (post.publish_date, post.pk), reverse=True)]
+
+    def test_subscribing_backfills_and_publishing_pushes(self):
+        old_news = self.publish(self.news, 3)
+        self.publish(self.music, 2)
+        with override_settings(FEED_BACKFILL_POSTS=2):
+            self.subscribe(self.news)
+        self.assertEqual(self.feed(), self.newest_first(old_news[1:]))
+
+        self.subscribe(self.sport)
+        fresh = self.publish(self.sport, 2) + self.publish(self.news, 1) + self.publish(self.music, 1)
+        self.assertEqual(self.feed(), self.newest_first(old_news[1:] + fresh[:3]))
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader, category=self.music).exists())
+
+    def test_keyset_pages_cover_the_feed_exactly_once(self):
+        self.subscribe(self.news)
+        self.subscribe(self.sport)
+        posts = self.publish(self.news, 7) + self.publish(self.sport, 6)
+        for page_size in (1, 4, 5, 100):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.feed(page_size), self.newest_first(posts))
+
+    def test_unsubscribing_trims_the_category(self):
+        self.subscribe(self.news)
+        self.subscribe(self.sport)
+        news = self.publish(self.news, 2)
+        self.publish(self.sport, 2)
+        response = self.client.post('/user/unsubscribe/', {'category_id': self.sport.pk}, **self.auth(self.reader))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.feed(), self.newest_first(news))
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 2)
+
+    def test_moving_a_post_moves_its_entries(self):
+        self.subscribe(self.news)
+        post, = self.publish(self.music)
+        post.category = self.news
+        post.save()
+        self.assertEqual(self.feed(), [post.pk])
+        post.category = self.sport
+        post.save()
+        self.assertEqual(self.feed(), [])
+
+    @override_settings(FEED_PUSH_MAX_SUBSCRIPTIONS=2)
+    def test_large_subscription_lists_pull_on_read(self):
+        self.subscribe(self.news)
+        self.subscribe(self.sport)
+        posts = self.publish(self.news, 3) + self.publish(self.sport, 3)
+        push = self.feed()
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 6)
+
+        # A third subscription crosses the limit: the timeline is dropped
+        self.subscribe(self.music)
+        posts += self.publish(self.music, 2)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+        self.assertEqual(self.feed(), self.newest_first(posts))
+        self.assertEqual([post_id for post_id in self.feed() if post_id in push], push)
+
+        # Dropping back under it rebuilds the timeline
+        self.client.post('/user/unsubscribe/', {'category_id': self.music.pk}, **self.auth(self.reader))
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 6)
+        self.assertEqual(self.feed(), push)
+
+    @override_settings(FEED_PUSH_MAX_SUBSCRIPTIONS=2)
+    def test_deleting_a_category_can_switch_back_to_push(self):
+        for category in (self.news, self.sport, self.music):
+            self.subscribe(category)
+        posts = self.publish(self.news, 2) + self.publish(self.sport, 2)
+        self.publish(self.music, 2)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+
+        # The cascade takes the subscription away without an unsubscribe
+        self.music.delete()
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 4)
+        self.assertEqual(self.feed(), self.newest_first(posts))
+
+    @override_settings(FEED_PUSH_MAX_SUBSCRIPTIONS=2)
+    def test_bulk_unsubscribe_can_switch_back_to_push(self):
+        for category in (self.news, self.sport, self.music):
+            self.subscribe(category)
+        posts = self.publish(self.news, 2)
+        self.publish(self.sport, 1)
+
+        # Straight from over the limit to under it
+        Subscription.objects.filter(user=self.reader).exclude(category=self.news).delete()
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 2)
+        self.assertEqual(self.feed(), self.newest_first(posts))
+
+
+class SubscribedCategoryTests(BlogTestCase):
+    """Every ``subscribed`` flag of a response comes from one subscription query."""
+
+    def setUp(self):
+        super().setUp()
+        self.reader = self.make_user('reader')
+        author = self.make_user('author')
+        self.categories = [Category.objects.create(name=f'category {i}') for i in range(6)]
+        for category in self.categories:
+            self.make_post(author, category)
+        self.subscribed = {category.pk for category in self.categories[::2]}
+        for category_id in self.subscribed:
+            Subscription.objects.create(user=self.reader, category_id=category_id)
+
+    def get(self, url, **headers):
+        """The response body and how many queries read blog_subscription."""
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            if Subscription._meta.db_table in sql:
+                queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_flags_match_the_readers_subscriptions(self):
+        cases = [
+            ('/categories/', lambda body: {item['id']: item['subscribed'] for item in body}),
+            ('/posts/categories/', lambda body: {item['id']: item['subscribed'] for item in body}),
+            ('/api/posts/?page_size=100', lambda body: {
+                item['category']['id']: item['category']['subscribed'] for item in body['results']
+            }),
+        ]
+        expected = {category.pk: category.pk in self.subscribed for category in self.categories}
+        for url, flags in cases:
+            with self.subTest(url=url):
+                body, queries = self.get(url, **self.auth(self.reader))
+                self.assertEqual(flags(body), expected)
+                self.assertEqual(queries, 1)
+
+                caches['local'].clear()
+                body, queries = self.get(url)
+                self.assertEqual(flags(body), dict.fromkeys(expected, False))
+                self.assertEqual(queries, 0)
+
+    def test_subscriptions_are_loaded_once_per_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.reader
+        with self.assertNumQueries(1):
+            first = get_subscribed_category_ids(request)
+            second = get_subscribed_category_ids(request)
+        self.assertEqual(first, self.subscribed)
+        self.assertIs(first, second)
+
+
+# =============================================================================
+# POST SEARCH
+# =============================================================================
+
+class PostSearchTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = self.make_user()
+        self.category = Category.objects.create(name='Travel')
+
+    def search_ids(self, query):
+        return [hit['id'] for hit in search.get_backend().search(query)]
+
+    def test_ranks_title_matches_above_content_matches(self):
+        in_content = self.make_post(self.author, self.category, title='Day one', content='We walked to the lighthouse')
+        in_title = self.make_post(self.author, self.category, title='The lighthouse', content='A long walk')
+        self.assertEqual(self.search_ids('lighthouse'), [in_title.pk, in_content.pk])
+
+    def test_matches_tags_and_category_and_prefixes(self):
+        post = self.make_post(self.author, self.category, title='Notes')
+        post.tags.add(Tag.objects.create(name='mountains'))
+        self.assertEqual(self.search_ids('mountains'), [post.pk])
+        self.assertEqual(self.search_ids('trav'), [post.pk])
+
+    def test_highlights_matches_and_escapes_text(self):
+        self.make_post(self.author, self.category, title='<b>Harbour</b> walk')
+        hit = search.get_backend().search('harbour')[0]
+        self.assertEqual(hit['title'], '&lt;b&gt;<mark>Harbour</mark>&lt;/b&gt; walk')
+
+    def test_index_follows_edits_renames_and_deletes(self):
+        post = self.make_post(self.author, self.category, title='Old title')
+        tag = Tag.objects.create(name='sunset')
+        post.tags.add(tag)
+
+        post.title = 'New title'
+        post.save()
+        self.assertEqual(self.search_ids('old'), [])
+        self.assertEqual(self.search_ids('new'), [post.pk])
+
+        tag.name = 'sunrise'
+        tag.save()
+        self.assertEqual(self.search_ids('sunset'), [])
+        self.assertEqual(self.search_ids('sunrise'), [post.pk])
+
+        self.category.name = 'Journeys'
+        self.category.save()
+        self.assertEqual(self.search_ids('journeys'), [post.pk])
+
+        post.delete()
+        self.assertEqual(self.search_ids('new'), [])
+
+    def test_rebuild_command_reindexes_every_post(self):
+        posts = [self.make_post(self.author, self.category, title=f'Fjord {i}') for i in range(3)]
+        Post.objects.filter(pk=posts[0].pk).update(title='Glacier')  # no signals
+        out = StringIO()
+        call_command('rebuild_search_index', batch_size=2, stdout=out)
+        self.assertIn('Indexed 3 post(s).', out.getvalue())
+        self.assertEqual(self.search_ids('glacier'), [posts[0].pk])
+
+    def test_rebuild_streams_ids_in_chunks(self):
+        consumed = []
+
+        def ids():
+            for post_id in range(5):
+                consumed.append(post_id)
+                yield post_id
+
+        chunks = search._chunks(ids(), 2)
+        self.assertEqual(next(chunks), [0, 1])
+        self.assertEqual(consumed, [0, 1])
+        self.assertEqual(list(chunks), [[2, 3], [4]])
+
+    def test_search_pages_follow_a_rank_cursor(self):
+        for i in range(7):
+            self.make_post(self.author, self.category, title=f'Canal {i}', content='canal ' * (i % 3))
+        ranked = self.search_ids('canal')
+        seen, url = [], '/api/posts/?search=canal'
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                page = self.client.get(url).json()
+                seen += [result['id'] for result in page['results']]
+                url = page['next']
+        self.assertEqual(seen, ranked)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+
+        response = self.client.get('/api/posts/', {'search': 'canal', 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_database_backend_continues_after_a_hit(self):
+        posts = [self.make_post(self.author, self.category, title=f'Canal {i}') for i in range(4)]
+        backend = search.DatabaseSearchBackend()
+        first = backend.search('canal', limit=2)
+        rest = backend.search('canal', after=(first[-1]['rank'], first[-1]['id']))
+        self.assertEqual([hit['id'] for hit in first + rest], [post.pk for post in reversed(posts)])
+
+    def test_feed_search_returns_ranked_results(self):
+        self.make_post(self.author, self.category, title='Something else')
+        post = self.make_post(self.author, self.category, title='Canal boats')
+        response = self.client.get('/api/posts/', {'search': 'canal'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], [post.pk])
+        self.assertEqual(results[0]['search']['title'], '<mark>Canal</mark> boats')
+
+
+# =============================================================================
+# SQLITE WRITES
+# =============================================================================
+
+class SQLiteWriteTests(BlogTransactionTestCase):
+    def test_concurrent_writers_get_no_locked_errors(self):
+        out = StringIO()
+        call_command('sqlite_load_test', processes=4, writes=20, stdout=out)
+        self.assertIn('4 processes, 80 requests', out.getvalue())
+        self.assertIn('errors=0 ', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='sqlite-load-test').exists())
+        self.assertFalse(Category.objects.exists())
+
+    def test_runs_on_a_copy_of_the_database(self):
+        # A real account the old cleanup by username prefix would have deleted
+        user = self.make_user('sqlite-load-test-admin')
+        call_command('sqlite_load_test', processes=2, writes=4, baseline=True, stdout=StringIO())
+        self.assertEqual(list(User.objects.all()), [user])
+        self.assertFalse(Post.objects.exists())
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+
+    def test_signup_stores_a_usable_password(self):
+        response = self.client.post('/signup/', {
+            'username': 'carol', 'email': 'carol@example.com', 'password': 's3cret', 'password_confirm': 's3cret',
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(User.objects.get(username='carol').check_password('s3cret'))
+
+
+# =============================================================================
+# POST IMAGES
+# =============================================================================
+
+def image_upload(name='photo.jpg', size=(200, 100), mode='RGB', exif=None):
+    buffer = BytesIO()
+    fmt = 'PNG' if name.endswith('.png') else 'JPEG'
+    Image.new(mode, size, 'red').save(buffer, fmt, **({'exif': exif.tobytes()} if exif else {}))
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class MediaTestMixin:
+    """
+    Stores uploads in a throwaway MEDIA_ROOT and renders image variants as
+    soon as the post is saved. Use with BlogTransactionTestCase: rendering
+    closes the connection when it is done, as the worker threads do.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp(prefix='blog-test-media-')
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(
+            MEDIA_ROOT=media_root, IMAGE_WORKERS=0, IMAGE_VARIANT_WIDTHS={'thumb': 40, 'card': 100},
+        ))
+        self.author = self.make_user()
+        self.category = Category.objects.create(name='Photos')
+
+    def make_image_post(self, upload=None, **fields):
+        post = self.make_post(self.author, self.category, image=upload or image_upload(), **fields)
+        post.refresh_from_db()
+        return post
+
+
+class ImageVariantTests(MediaTestMixin, BlogTransactionTestCase):
+    def open_variant(self, post, variant, fmt):
+        with default_storage.open(post.image_variants[variant][fmt]) as file:
+            image = Image.open(file)
+            image.load()
+        return image
+
+    def test_renders_every_width_as_webp_and_jpeg(self):
+        post = self.make_image_post(image_upload('logo.png', mode='RGBA'))
+        self.assertEqual(
+            {variant: (info['width'], info['height']) for variant, info in post.image_variants.items()},
+            {'thumb': (40, 20), 'card': (100, 50)},
+        )
+        card = self.open_variant(post, 'card', 'webp')
+        self.assertEqual((card.format, card.size), ('WEBP', (100, 50)))
+        thumb = self.open_variant(post, 'thumb', 'jpeg')
+        self.assertEqual((thumb.format, thumb.mode, thumb.size), ('JPEG', 'RGB', (40, 20)))
+
+    def test_never_upscales(self):
+        post = self.make_image_post(image_upload(size=(60, 30)))
+        self.assertEqual(post.image_variants['card']['width'], 60)
+        self.assertEqual(post.image_variants['thumb']['width'], 40)
+
+    def test_applies_exif_orientation_and_drops_metadata(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotate 90° clockwise
+        post = self.make_image_post(image_upload(exif=exif))
+        card = self.open_variant(post, 'card', 'jpeg')
+        self.assertEqual(card.size, (100, 200))
+        self.assertEqual(dict(card.getexif()), {})
+
+    def test_post_exposes_variants_as_srcset(self):
+        post = self.make_image_post()
+        srcset = self.client.get(f'/api/posts/{post.pk}/').json()['srcset']
+        self.assertEqual(srcset['card']['width'], 100)
+        self.assertEqual(srcset['card']['webp'], f'http://testserver/media/{post.image_variants["card"]["webp"]}')
+        self.assertNotIn('image_variants', self.client.get(f'/api/posts/{post.pk}/').json())
+
+    def test_seeded_photo_card_is_a_fraction_of_the_original(self):
+        # One of the phone photos in the repo's media_root, at the real widths
+        with open(settings.BASE_DIR / 'media_root/posts/WhatsApp_Image_2025-06-07_at_1.50.49_PM.jpeg', 'rb') as file:
+            upload = SimpleUploadedFile('photo.jpeg', file.read())
+        with self.settings(IMAGE_VARIANT_WIDTHS={'thumb': 320, 'card': 768, 'full': 1600}):
+            post = self.make_image_post(upload)
+        original = default_storage.size(post.image.name)
+        self.assertLess(default_storage.size(post.image_variants['card']['webp']), original * 0.1)
+        self.assertLess(default_storage.size(post.image_variants['card']['jpeg']), original * 0.2)
+
+    def test_backfill_command_renders_missing_variants(self):
+        post = self.make_image_post()
+        Post.objects.filter(pk=post.pk).update(image_variants={})
+        out = StringIO()
+        call_command('process_post_images', stdout=out)
+        self.assertIn('Rendered images of 1 post(s).', out.getvalue())
+        post.refresh_from_db()
+        self.assertEqual(set(post.image_variants), {'thumb', 'card'})
+
+
+class StoredImageTests(MediaTestMixin, BlogTransactionTestCase):
+    @override_settings(MEDIA_ORPHAN_GRACE_SECONDS=0)
+    def test_auto_deleted_post_releases_its_image(self):
+        post = self.make_image_post()
+        files = [post.image.name, *images.variant_files(post.image_variants)]
+        self.assertEqual(StoredFile.objects.get(name=post.image.name).references, 1)
+
+        for i in range(11):
+            reactions.react(self.make_user(f'critic{i}'), post.pk, reactions.DISLIKE)
+
+        self.assertFalse(Post.objects.filter(pk=post.pk).exists())
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertEqual([name for name in files if default_storage.exists(name)], [])
+
+
+    def dedupe(self, *args):
+        out = StringIO()
+        call_command('dedupe_media', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dedupe_command_merges_duplicates_and_sweeps_orphans(self):
+        content = image_upload().read()
+        legacy = [self.make_post(self.author, self.category, title=f'legacy {i}') for i in range(2)]
+        os.makedirs(default_storage.path('posts'), exist_ok=True)
+        for post, name in zip(legacy, ('posts/a.jpg', 'posts/b.jpg')):
+            with open(default_storage.path(name), 'wb') as file:
+                file.write(content)
+            Post.objects.filter(pk=post.pk).update(image=name)
+        # An upload whose post was never saved, and an image released within
+        # the grace period: neither is collected when it is dropped
+        stray = default_storage.save('posts/stray.jpg', image_upload(size=(30, 30)))
+        released = self.make_image_post(image_upload(size=(50, 50)))
+        released.delete()
+        self.assertTrue(default_storage.exists(released.image.name))
+
+        output = self.dedupe()
+        self.assertIn('Moved 2 file(s) into 1 content-addressed name(s) and deleted 0 unused file(s)', output)
+        self.assertIn('Kept 2 unused file(s)', output)
+        names = set(Post.objects.filter(pk__in=[post.pk for post in legacy]).values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+        self.assertFalse(default_storage.exists('posts/a.jpg'))
+        self.assertEqual(set(Post.objects.get(pk=legacy[1].pk).image_variants), {'thumb', 'card'})
+
+        with override_settings(MEDIA_ORPHAN_GRACE_SECONDS=0):
+            self.assertIn('delete 2 unused file(s)', self.dedupe('--dry-run'))
+            self.assertIn('deleted 2 unused file(s)', self.dedupe())
+        self.assertFalse(default_storage.exists(stray))
+        self.assertFalse(default_storage.exists(released.image.name))
+        self.assertEqual(list(StoredFile.objects.values_list('name', flat=True)), [name])
+        self.assertTrue(default_storage.exists(name))
+
+
+# =============================================================================
+# MEDIA SERVING
+# =============================================================================
+
+class MediaServingTests(BlogTestCase):
+    content = bytes(range(256)) * 4
+    name = 'posts/' + 'a' * 64 + '.jpg'
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp(prefix='blog-test-media-')
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root, MEDIA_SENDFILE=None))
+        default_storage.save(self.name, SimpleUploadedFile('x.jpg', self.content))
+        default_storage.save('notes.txt', SimpleUploadedFile('notes.txt', b'hello'))
+        self.url = f'/media/{self.name}'
+
+    @staticmethod
+    def body(response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_serves_file_with_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self.client.get('/media/notes.txt')['Cache-Control'], 'public, max-age=3600')
+
+    def test_conditional_get_is_not_modified(self):
+        first = self.client.get(self.url)
+        response = self.client.get(self.url, headers={'If-None-Match': first['ETag']})
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        self.assertEqual(response['ETag'], first['ETag'])
+        response = self.client.get(self.url, headers={'If-Modified-Since': first['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(self.body(response), self.content[10:20])
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=-4'})
+        self.assertEqual(self.body(response), self.content[-4:])
+
+        # A stale If-Range gets the whole, current file
+        response = self.client.get(self.url, headers={'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=2000-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_head_has_headers_but_no_body(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response.content, b'')
+
+    def test_offloads_to_the_front_server(self):
+        with self.settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.name}')
+        self.assertEqual(response.content, b'')
+        with self.settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], default_storage.path(self.name))
+
+    def test_refuses_missing_hidden_and_outside_files(self):
+        default_storage.save('posts/.upload-tmp', SimpleUploadedFile('tmp', b'partial'))
+        for url in ('/media/posts/missing.jpg', '/media/posts/.upload-tmp', '/media/../manage.py'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+    async def test_async_stack_streams_with_an_async_iterator(self):
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.content[10:20])
+
+        response = await self.async_client.get(self.url)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.content)
+        response = await self.async_client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+
+# =============================================================================
+# REQUEST METRICS
+# =============================================================================
+
+class RequestMetricsTests(BlogTestCase):
+    # /api/posts/ is unnamed, so it is labelled with the view's dotted path
+    feed = '{view="blog.async_views.post_list",method="GET",status="2xx"}'
+
+    def setUp(self):
+        super().setUp()
+        self.make_post(self.make_user(), Category.objects.create(name='News'))
+
+    def scrape(self, **headers):
+        response = self.client.get('/metrics', **headers)
+        self.assertEqual(response.status_code, 200)
+        values = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    def delta(self, before, after, name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    def test_records_requests_and_their_queries(self):
+        labels = '{view="categories_with_subscription_status",method="GET",status="2xx"}'
+        before = self.scrape()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/posts/categories/').status_code, 200)
+        # Counted before the next request resets connection.queries
+        query_count = len(queries)
+        after = self.scrape()
+
+        self.assertEqual(self.delta(before, after, f'blog_http_request_duration_seconds_count{labels}'), 1)
+        self.assertGreater(self.delta(before, after, f'blog_http_request_duration_seconds_sum{labels}'), 0)
+        self.assertEqual(self.delta(before, after, f'blog_http_request_sql_queries_sum{labels}'), query_count)
+        self.assertGreater(self.delta(before, after, f'blog_http_response_bytes_total{labels}'), 0)
+        inf = labels[:-1] + ',le="+Inf"}'
+        self.assertEqual(self.delta(before, after, f'blog_http_request_duration_seconds_bucket{inf}'), 1)
+
+    async def test_counts_queries_of_async_views(self):
+        # Their queries run in sync_to_async threads
+        before = await sync_to_async(self.scrape)()
+        self.assertEqual((await self.async_client.get('/api/posts/')).status_code, 200)
+        after = await sync_to_async(self.scrape)()
+        self.assertEqual(self.delta(before, after, f'blog_http_request_duration_seconds_count{self.feed}'), 1)
+        self.assertGreater(self.delta(before, after, f'blog_http_request_sql_queries_sum{self.feed}'), 0)
+
+    def test_endpoint_is_restricted(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.9').status_code, 403)
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.scrape(HTTP_AUTHORIZATION='Bearer s3cret')
+
+    def test_sums_the_files_of_every_process(self):
+        directory = tempfile.mkdtemp(prefix='blog-test-metrics-')
+        self.addCleanup(shutil.rmtree, directory)
+        other = [0.0] * metrics._SERIES_SIZE
+        other[:5] = [3, 0.3, 6, 0.01, 900]
+        with open(os.path.join(directory, 'other-worker.json'), 'w') as file:
+            json.dump({'series': [[['blog.async_views.post_list', 'GET', '2xx'], other]], 'fragment_hits': 4, 'fragment_misses': 1}, file)
+
+        local = self.scrape()
+        with self.settings(METRICS_DIR=directory):
+            merged = self.scrape()
+        self.assertEqual(self.delta(local, merged, f'blog_http_request_duration_seconds_count{self.feed}'), 3)
+        self.assertEqual(self.delta(local, merged, f'blog_http_request_sql_queries_sum{self.feed}'), 6)
+        self.assertEqual(self.delta(local, merged, 'blog_post_fragment_cache_hits_total'), 4)
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_server_timing_header(self):
+        response = self.client.get('/api/posts/')
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"$')
+
+
+# =============================================================================
+# SQL PROFILING
+# =============================================================================
+
+class SQLProfilingTests(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(SQL_PROFILING=True, SQL_DUPLICATE_QUERY_THRESHOLD=3))
+        self.addCleanup(self.uninstrument)
+
+    @staticmethod
+    def uninstrument():
+        connection_created.disconnect(profiling.instrument_connection)
+        for connection in connections.all(initialized_only=True):
+            if profiling.profile_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(profiling.profile_query)
+
+    def run_view(self, view):
+        middleware = profiling.SQLProfilingMiddleware(lambda request: view() or HttpResponse())
+        return middleware(RequestFactory().get('/some/page/'))
+
+    def test_normalize_collapses_literals_and_in_lists(self):
+        self.assertEqual(
+            profiling.normalize("SELECT *\n  FROM t WHERE a = 42 AND b = 'it''s' AND c IN (%s, %s, %s)"),
+            'SELECT * FROM t WHERE a = ? AND b = ? AND c IN (...)',
+        )
+        self.assertEqual(
+            profiling.normalize('SELECT id FROM t WHERE id IN (%s) AND x = 1.5'),
+            profiling.normalize('SELECT id FROM t WHERE id IN (%s, %s) AND x = 2'),
+        )
+
+    def test_off_unless_enabled(self):
+        with self.settings(SQL_PROFILING=False), self.assertRaises(MiddlewareNotUsed):
+            profiling.SQLProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_flags_statements_repeated_past_the_threshold(self):
+        users = [self.make_user(f'user{i}') for i in range(4)]
+
+        self.run_view(lambda: [User.objects.get(pk=user.pk) for user in users[:3]])
+        self.assertFalse(QueryOffender.objects.exists())
+
+        with self.assertLogs('blog.sql', 'WARNING') as logs:
+            self.run_view(lambda: [User.objects.get(pk=user.pk) for user in users])
+        offender = QueryOffender.objects.get()
+        self.assertEqual((offender.kind, offender.view, offender.max_repeats), ('duplicate', 'unresolved', 4))
+        self.assertIn('WHERE "blog_user"."id" = %s LIMIT ?', offender.sql)
+        self.assertIn('in <listcomp>', offender.stack)
+        self.assertEqual(logs.records[0].getMessage(), 'duplicate_query')
+        self.assertEqual(logs.records[0].data['count'], 4)
+
+    @override_settings(SQL_SLOW_QUERY_MS=0)
+    def test_slow_statements_are_logged_with_their_plan(self):
+        with self.assertLogs('blog.sql', 'WARNING') as logs:
+            self.run_view(lambda: list(Post.objects.filter(title='x')))
+        slow = [record.data for record in logs.records if record.getMessage() == 'slow_query']
+        self.assertEqual(len(slow), 1)
+        self.assertEqual(slow[0]['path'], '/some/page/')
+        self.assertTrue(any('SCAN' in step or 'SEARCH' in step for step in slow[0]['plan']), slow[0]['plan'])
+        offender = QueryOffender.objects.get(kind='slow')
+        self.assertEqual(offender.plan, '\n'.join(slow[0]['plan']))
+
+    def test_record_offender_accumulates(self):
+        profiling.record_offender('home', 'slow', 'SELECT ?', 120.0, 0, ['SCAN t'], ['views.py:1 in home'])
+        profiling.record_offender('home', 'slow', 'SELECT ?', 80.0, 0, ['SEARCH t'], ['views.py:2 in home'])
+        profiling.record_offender('other', 'slow', 'SELECT ?', 10.0, 0, [], [])
+        offender = QueryOffender.objects.get(view='home')
+        self.assertEqual(offender.occurrences, 2)
+        self.assertEqual((offender.total_ms, offender.max_ms), (200.0, 120.0))
+        self.assertEqual((offender.plan, offender.stack), ('SEARCH t', 'views.py:2 in home'))
+        self.assertEqual(QueryOffender.objects.count(), 2)
+
+    def test_log_is_rotating_json_lines(self):
+        directory = tempfile.mkdtemp(prefix='blog-test-logs-')
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'nested', 'sql.log')
+        handler = profiling.ProfileLogHandler(path, maxBytes=300, backupCount=1)
+        handler.setFormatter(profiling.JSONFormatter())
+        self.addCleanup(handler.close)
+        logger = logging.getLogger('blog.sql.test')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for i in range(6):
+            logger.warning('slow_query', extra={'data': {'sql': 'SELECT ?', 'duration_ms': i}})
+
+        self.assertTrue(os.path.exists(path + '.1'))
+        with open(path) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual(entries[-1]['event'], 'slow_query')
+        self.assertEqual(entries[-1]['duration_ms'], 5)
+        self.assertEqual(entries[-1]['level'], 'WARNING')
+        self.assertIn('time', entries[-1])
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import connections, router
+
+from .models import Post, Subscription, TimelineEntry
+
+
+# =============================================================================
+# SUBSCRIPTION TIMELINES
+# =============================================================================
+
+# Every subscriber gets a TimelineEntry when a post is published into one of
+# their categories, so /user/feed/ is a single range scan over their own rows.
+# Users following more than FEED_PUSH_MAX_SUBSCRIPTIONS categories are left
+# out of the fan-out and have their feed pulled from Post on read instead.
+
+def max_push_subscriptions():
+    return getattr(settings, 'FEED_PUSH_MAX_SUBSCRIPTIONS', 200)
+
+
+def uses_timeline(user_id):
+    """Whether the user's feed is read from TimelineEntry rather than pulled."""
+    return Subscription.objects.filter(user_id=user_id).count() <= max_push_subscriptions()
+
+
+def _execute(sql, params):
+    connection = connections[router.db_for_write(TimelineEntry)]
+    qn = connection.ops.quote_name
+    tables = {
+        'timeline': qn(TimelineEntry._meta.db_table),
+        'subscription': qn(Subscription._meta.db_table),
+        'post': qn(Post._meta.db_table),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(**tables), params)
+        return cursor.rowcount
+
+
+def push_post(post):
+    """Add ``post`` to the timeline of every push-mode subscriber of its category."""
+    return _execute(
+        'INSERT INTO {timeline} (user_id, post_id, category_id, publish_date) '
+        'SELECT s.user_id, %s, %s, %s FROM {subscription} s '
+        'WHERE s.category_id = %s '
+        'AND (SELECT COUNT(*) FROM {subscription} s2 WHERE s2.user_id = s.user_id) <= %s '
+        'ON CONFLICT (user_id, post_id) DO NOTHING',
+        [post.pk, post.category_id, post.publish_date, post.category_id, max_push_subscriptions()],
+    )
+
+
+def update_post(post, previous_category_id=None):
+    """Follow a post that moved to another category or got a new publish date."""
+    if previous_category_id and previous_category_id != post.category_id:
+        TimelineEntry.objects.filter(post_id=post.pk).delete()
+        push_post(post)
+        return
+    TimelineEntry.objects.filter(post_id=post.pk).exclude(publish_date=post.publish_date).update(
+        publish_date=post.publish_date
+    )
+
+
+def backfill(user_id, category_id):
+    """Copy the category's latest FEED_BACKFILL_POSTS posts into the user's timeline."""
+    return _execute(
+        'INSERT INTO {timeline} (user_id, post_id, category_id, publish_date) '
+        'SELECT %s, p.id, p.category_id, p.publish_date FROM {post} p '
+        'WHERE p.category_id = %s ORDER BY p.publish_date DESC, p.id DESC LIMIT %s '
+        'ON CONFLICT (user_id, post_id) DO NOTHING',
+        [user_id, category_id, getattr(settings, 'FEED_BACKFILL_POSTS', 500)],
+    )
+
+
+def subscribed(user_id, category_id):
+    if uses_timeline(user_id):
+        backfill(user_id, category_id)
+    else:
+        # Just crossed into pull mode (or already there); nothing is kept
+        TimelineEntry.objects.filter(user_id=user_id).delete()
+
+
+def unsubscribed(user_id, category_id):
+    TimelineEntry.objects.filter(user_id=user_id, category_id=category_id).delete()
+    if not uses_timeline(user_id) or TimelineEntry.objects.filter(user_id=user_id).exists():
+        return
+    # A push-mode user with an empty timeline has just come back under the
+    # limit (by unsubscribing, or through a category delete or bulk delete
+    # taking several subscriptions at once) or follows nothing with posts,
+    # in which case the backfill finds nothing to copy
+    for remaining in Subscription.objects.filter(user_id=user_id).values_list('category_id', flat=True):
+        backfill(user_id, remaining)
@@ -1,26 +1,40 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.generics import ListAPIView
 from rest_framework.authtoken.models import Token
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.filters import OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework_simplejwt.exceptions import AuthenticationFailed
-from .models import Comment, Post, Category, Subscription
+from .models import Comment, Post, Category, Subscription, TimelineEntry
 from rest_framework.views import APIView
-from django.core.mail import send_mail
+from django.db import transaction
 from blog.models import Comment
+from . import caching, reactions, timeline
+from .caching import cache_anonymous_response
+from .comments import attach_replies, get_max_depth
+from .outbox import enqueue_email
+from .pagination import (
+    CommentPagination, PostFeedPagination, SearchPagination, TimelinePagination, UserFeedPagination,
+)
+from .routers import use_primary
+from .sqlite import retry_if_locked
+from .search import get_backend as get_search_backend
 from .serializers import (
     UserSerializer,
     PostSerializer,
     CategorySerializer,
     CommentSerializer,
-    CustomTokenObtainPairSerializer
+    CustomTokenObtainPairSerializer,
+    get_subscribed_category_ids,
+    post_list_context,
 )
 from django.contrib.auth import get_user_model
 
@@ -29,22 +43,52 @@ User = get_user_model()
 class CommentListCreateView(generics.ListCreateAPIView):
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = CommentPagination
 
     def get_queryset(self):
         post_id = self.kwargs['post_id']
-        return Comment.objects.filter(post_id=post_id).order_by('-created_at')
-
+        return Comment.objects.filter(post_id=post_id, parent__isnull=True).select_related('user')
+
+    def list(self, request, *args, **kwargs):
+        # Top-level comments are paged; replies are embedded only up to
+        # ?max_depth levels and otherwise fetched from comments/<id>/replies/
+        max_depth = 0
+        if request.query_params.get('top_level_only', '').lower() not in ('1', 'true', 'yes'):
+            max_depth = get_max_depth(request.query_params.get('max_depth'))
+        page = self.paginate_queryset(self.get_queryset())
+        attach_replies(page, max_depth)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @retry_if_locked
     def create(self, request, *args, **kwargs):
         post_id = self.kwargs['post_id']
         post = get_object_or_404(Post, id=post_id)
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            serializer.save(user=request.user, post=post)
+            comment = serializer.save(user=request.user, post=post)
+            comment.loaded_replies = []
             return Response(serializer.data, status=201)
         return Response(serializer.errors, status=400)
     
+class CommentRepliesView(generics.ListAPIView):
+    serializer_class = CommentSerializer
+    permission_classes = [AllowAny]
+    pagination_class = CommentPagination
+
+    def get_queryset(self):
+        return Comment.objects.filter(parent_id=self.kwargs['comment_id']).select_related('user')
+
+    def list(self, request, *args, **kwargs):
+        get_object_or_404(Comment, id=self.kwargs['comment_id'])
+        page = self.paginate_queryset(self.get_queryset())
+        attach_replies(page, get_max_depth(request.query_params.get('max_depth')))
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@retry_if_locked
 def react_to_comment(request, comment_id):
     comment = get_object_or_404(Comment, id=comment_id)
     action = request.data.get('action')
@@ -62,6 +106,7 @@ def react_to_comment(request, comment_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@retry_if_locked
 def reply_to_comment(request, comment_id):
     parent = get_object_or_404(Comment, id=comment_id)
     post = parent.post
@@ -76,35 +121,24 @@ def reply_to_comment(request, comment_id):
         parent=parent,
         content=content
     )
-    serializer = CommentSerializer(reply)
+    reply.loaded_replies = []
+    serializer = CommentSerializer(reply, context={'request': request})
     return Response(serializer.data, status=201)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@retry_if_locked
 def react_to_post(request, post_id):
-    post = get_object_or_404(Post, id=post_id)
     action = request.data.get('action')
 
-    if action not in ['like', 'dislike']:
+    if action not in reactions.ACTIONS:
         return Response({'error': 'Invalid action'}, status=400)
 
-    from blog.models import PostLike
-
     try:
-        post_like = PostLike.objects.get(user=request.user, post=post)
-        if (action == 'like' and post_like.is_like) or (action == 'dislike' and not post_like.is_like):
-            # User clicked the same reaction again, so remove it (toggle off)
-            post_like.delete()
-        else:
-            # User switched reaction (like <-> dislike)
-            post_like.is_like = (action == 'like')
-            post_like.save()
-    except PostLike.DoesNotExist:
-        # No previous reaction, create new
-        PostLike.objects.create(user=request.user, post=post, is_like=(action == 'like'))
-
-    post.refresh_from_db()
-    return Response(PostSerializer(post, context={'request': request}).data)
+        state = reactions.react(request.user, post_id, action)
+    except Post.DoesNotExist:
+        raise Http404
+    return Response(state)
 
 class CommentDeleteView(generics.DestroyAPIView):
     queryset = Comment.objects.all()
@@ -121,34 +155,90 @@ class SubscribeCategory(APIView):
 
     def post(self, request, category_id):
         category = get_object_or_404(Category, id=category_id)
-        subscription, created = Subscription.objects.get_or_create(user=request.user, category=category)
-        if created:
-            # Send subscription email
-            send_mail(
-                subject='Subscription Confirmation',
-                message=f'You have subscribed to the category: {category.name}',
-                from_email='no-reply@blogapp.com',
-                recipient_list=[request.user.email],
-                fail_silently=True
-            )
+        with transaction.atomic():
+            subscription, created = Subscription.objects.get_or_create(user=request.user, category=category)
+            if created and request.user.email:
+                # Queued; the send_outbound_emails worker delivers it
+                enqueue_email(
+                    recipient=request.user.email,
+                    subject='Subscription Confirmation',
+                    body=f'You have subscribed to the category: {category.name}',
+                    from_email='no-reply@blogapp.com',
+                )
         return Response({'detail': 'Subscribed successfully.'}, status=status.HTTP_201_CREATED)
 
 # If you have a Post model, add a view to filter posts by category
-from django.db.models import Q
 try:
     from .models import Post
 
     class PostListByCategory(APIView):
+        """
+        Posts, optionally of one category. Paginated by default; ``?stream=json``
+        or ``?stream=ndjson`` streams every post instead, serialized chunk by
+        chunk so memory stays flat however many posts there are.
+        """
         permission_classes = [permissions.AllowAny]
+        stream_chunk_size = 500
 
         def get(self, request):
             category_id = request.query_params.get('category_id')
+            posts = post_list_queryset()
             if category_id:
-                posts = Post.objects.filter(category_id=category_id)
-            else:
-                posts = Post.objects.all()
-            serializer = PostSerializer(posts, many=True)
-            return Response(serializer.data)
+                posts = posts.filter(category_id=category_id)
+
+            stream = request.query_params.get('stream')
+            if stream in ('json', 'ndjson'):
+                # Under ASGI a sync iterator is consumed whole before the first
+                # byte is sent, so hand the server an async one instead
+                stream_posts = self.astream_posts if isinstance(request._request, ASGIRequest) else self.stream_posts
+                chunks = stream_posts(request, posts.order_by('-publish_date', '-id'), ndjson=stream == 'ndjson')
+                content_type = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+                return StreamingHttpResponse(chunks, content_type=content_type)
+
+            paginator = PostFeedPagination()
+            page = paginator.paginate_queryset(posts, request)
+            serializer = PostSerializer(page, many=True, context=post_list_context(request, page))
+            return paginator.get_paginated_response(serializer.data)
+
+        def stream_posts(self, request, posts, ndjson=False):
+            separator = '\n' if ndjson else ','
+            started = False
+            if not ndjson:
+                yield '['
+            chunk = []
+            for post in posts.iterator(chunk_size=self.stream_chunk_size):
+                chunk.append(post)
+                if len(chunk) < self.stream_chunk_size:
+                    continue
+                yield self.render_chunk(request, chunk, separator, started)
+                started = True
+                chunk = []
+            if chunk:
+                yield self.render_chunk(request, chunk, separator, started)
+            yield '\n' if ndjson else ']'
+
+        async def astream_posts(self, request, posts, ndjson=False):
+            separator = '\n' if ndjson else ','
+            render_chunk = sync_to_async(self.render_chunk)
+            started = False
+            if not ndjson:
+                yield '['
+            chunk = []
+            async for post in posts.aiterator(chunk_size=self.stream_chunk_size):
+                chunk.append(post)
+                if len(chunk) < self.stream_chunk_size:
+                    continue
+                yield await render_chunk(request, chunk, separator, started)
+                started = True
+                chunk = []
+            if chunk:
+                yield await render_chunk(request, chunk, separator, started)
+            yield '\n' if ndjson else ']'
+
+        def render_chunk(self, request, posts, separator, started):
+            data = PostSerializer(posts, many=True, context=post_list_context(request, posts)).data
+            rendered = separator.join(json.dumps(item, cls=JSONEncoder) for item in data)
+            return separator + rendered if started else rendered
 except ImportError:
     pass
 
@@ -198,8 +288,10 @@ class CategoryDelete(APIView):
 def signup(request):
     serializer = UserSerializer(data=request.data)
     if serializer.is_valid():
-        user = serializer.save()
-        refresh = RefreshToken.for_user(user)
+        # Only the insert runs in the write transaction; validation and
+        # password hashing happen before it
+        user = retry_if_locked(serializer.save)()
+        refresh = CustomTokenObtainPairSerializer.get_token(user)
         return Response({
             'user': {'username': user.username, 'email': user.email},
             'access': str(refresh.access_token),
@@ -209,39 +301,29 @@ def signup(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class CustomTokenObtainPairView(TokenObtainPairView):
+    # The serializer rejects blocked users
     serializer_class = CustomTokenObtainPairSerializer
 
-    def post(self, request, *args, **kwargs):
-        username = request.data.get('username')
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        try:
-            user = User.objects.get(username=username)
-            if user.is_blocked:
-                raise AuthenticationFailed('This user is blocked. Contact admin.')
-        except User.DoesNotExist:
-            pass  # Let serializer handle invalid user
-        return super().post(request, *args, **kwargs)
-
 # -------------------- Posts --------------------
+def post_list_queryset():
+    """
+    Posts with their author and category joined in. Tags are prefetched by
+    PostSerializer only for posts missing from the fragment cache.
+    """
+    return Post.objects.select_related('author', 'category')
+
+@cache_anonymous_response(caching.FEED)
 @api_view(['GET', 'POST'])
 @permission_classes([AllowAny])
 def view_add_post(request):
     if request.method == 'GET':
-        posts = Post.objects.all()
         search_query = request.GET.get('search', '').strip()
         if search_query:
-            posts = posts.filter(
-                Q(title__icontains=search_query) |
-                Q(tags__name__icontains=search_query)
-            ).distinct()
-        ordering = request.GET.get('ordering', '-publish_date')
-        posts = posts.order_by(ordering)
-        
-        paginator = PageNumberPagination()
-        paginator.page_size = 5
+            return search_posts(request, search_query)
+        posts = post_list_queryset()
+        paginator = PostFeedPagination()
         paginated_posts = paginator.paginate_queryset(posts, request)
-        serialized = PostSerializer(paginated_posts, many=True)
+        serialized = PostSerializer(paginated_posts, many=True, context=post_list_context(request, paginated_posts))
         return paginator.get_paginated_response(serialized.data)
 
     elif request.method == 'POST':
@@ -253,13 +335,30 @@ def view_add_post(request):
         return Response(created_post.data, status=201)
 
 
+def search_posts(request, search_query):
+    """Relevance-ranked search results, in cursor pages of five."""
+    paginator = SearchPagination()
+    page_hits = paginator.paginate_hits(get_search_backend(), search_query, request)
+    posts_by_id = post_list_queryset().in_bulk([hit['id'] for hit in page_hits])
+    posts = []
+    for hit in page_hits:
+        post = posts_by_id.get(hit['id'])
+        if post is not None:
+            post.search_hit = hit
+            posts.append(post)
+    serialized = PostSerializer(posts, many=True, context=post_list_context(request, posts))
+    return paginator.get_paginated_response(serialized.data)
+
+
+@cache_anonymous_response(lambda request, id: caching.post_version(id))
 @api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 @permission_classes([AllowAny])
 def post_by_id(request, id):
-    post = get_object_or_404(Post, pk=id)
-
     if request.method == 'GET':
-        return Response(PostSerializer(post, context={'request': request}).data)
+        post = get_object_or_404(post_list_queryset(), pk=id)
+        return Response(PostSerializer(post, context=post_list_context(request, [post])).data)
+
+    post = get_object_or_404(Post, pk=id)
 
     if not request.user.is_authenticated:
         return Response({"error": "Authentication required."}, status=401)
@@ -275,22 +374,24 @@ def post_by_id(request, id):
         serializer.save(author=request.user)
         return Response(serializer.data)
 
-class PostPagination(PageNumberPagination):
-    page_size = 5
-    page_size_query_param = 'page_size'
-    max_page_size = 100
-
-
 class PostListAPIView(ListAPIView):
-    queryset = Post.objects.all().order_by('-publish_date')
+    queryset = post_list_queryset()
     serializer_class = PostSerializer
     permission_classes = [AllowAny]
-    pagination_class = PostPagination
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    # Ordering is applied (from a whitelist) by the pagination class
+    pagination_class = PostFeedPagination
+    filter_backends = [DjangoFilterBackend]
     filterset_fields = ['category']
-    ordering_fields = ['publish_date']
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        context = {**self.get_serializer_context(), **post_list_context(request, page)}
+        serializer = self.get_serializer(page, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
 # -------------------- Categories --------------------
+@cache_anonymous_response(caching.CATEGORIES)
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_categories(request):
@@ -298,18 +399,27 @@ def get_categories(request):
     serializer = CategorySerializer(categories, many=True, context={'request': request})
     return Response(serializer.data)
 
+@cache_anonymous_response(lambda request, id: caching.category_version(id))
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_posts_by_category_id(request, id):
     category = get_object_or_404(Category, pk=id)
-    posts = category.post_set.all().order_by('-publish_date')
+    posts = post_list_queryset().filter(category=category)
 
-    paginator = PageNumberPagination()
-    paginator.page_size = 5
+    paginator = PostFeedPagination()
     paginated = paginator.paginate_queryset(posts, request)
-    serializer = PostSerializer(paginated, many=True)
+    serializer = PostSerializer(paginated, many=True, context=post_list_context(request, paginated))
     return paginator.get_paginated_response(serializer.data)
 
+def subscription_email(user, category):
+    return {
+        'recipient': user.email,
+        'subject': 'Subscription Confirmation',
+        'body': f'Hello - {user.username} - you have subscribed successfully in - {category.name} - welcome aboard',
+        'from_email': 'no-reply@blogapp.com',
+    }
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def subscribe_to_category(request):
@@ -317,20 +427,27 @@ def subscribe_to_category(request):
     if not category_id:
         return Response({'error': 'Category ID is required'}, status=400)
 
+    # How new posts are announced: 'immediate', 'hourly' or 'daily'
+    digest = request.data.get('digest')
+    if digest is not None and digest not in dict(Subscription.DIGEST_CHOICES):
+        return Response({'error': 'Invalid digest option'}, status=400)
+
     category = get_object_or_404(Category, id=category_id)
-    subscription, created = Subscription.objects.get_or_create(user=request.user, category=category)
-    if created:
-        # Send confirmation email with custom message
-        send_mail(
-            subject='Subscription Confirmation',
-            message=f'Hello - {request.user.username} - you have subscribed successfully in - {category.name} - welcome aboard',
-            from_email='no-reply@blogapp.com',
-            recipient_list=[request.user.email],
-            fail_silently=True
+    with transaction.atomic():
+        subscription, created = Subscription.objects.get_or_create(
+            user=request.user, category=category,
+            defaults={'digest': digest or Subscription.IMMEDIATE},
         )
+        if created and request.user.email:
+            # Queued; the send_outbound_emails worker delivers it
+            enqueue_email(**subscription_email(request.user, category))
+    if created:
         return Response({'message': f'Subscribed to category: {category.name}'})
-    else:
-        return Response({'message': f'Already subscribed to category: {category.name}'})
+    if digest and digest != subscription.digest:
+        subscription.digest = digest
+        subscription.save(update_fields=['digest'])
+        return Response({'message': f'Updated subscription to category: {category.name}'})
+    return Response({'message': f'Already subscribed to category: {category.name}'})
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -343,26 +460,36 @@ def unsubscribe_from_category(request):
     Subscription.objects.filter(user=request.user, category=category).delete()
     return Response({'message': f'Unsubscribed from category: {category.name}'})
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def user_feed(request):
+    """Posts from the user's subscribed categories, newest first."""
+    if timeline.uses_timeline(request.user.pk):
+        paginator = TimelinePagination()
+        entries = paginator.paginate_queryset(TimelineEntry.objects.filter(user=request.user), request)
+        posts_by_id = post_list_queryset().in_bulk([entry.post_id for entry in entries])
+        posts = [posts_by_id[entry.post_id] for entry in entries if entry.post_id in posts_by_id]
+    else:
+        paginator = UserFeedPagination()
+        subscribed = Subscription.objects.filter(user=request.user).values('category_id')
+        posts = paginator.paginate_queryset(post_list_queryset().filter(category_id__in=subscribed), request)
+    serializer = PostSerializer(posts, many=True, context=post_list_context(request, posts))
+    return paginator.get_paginated_response(serializer.data)
+
+@use_primary
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_subscriptions(request):
-    categories = request.user.subscribed_categories.all()
-    serializer = CategorySerializer(categories, many=True)
+    categories = Category.objects.filter(subscription__user=request.user)
+    serializer = CategorySerializer(categories, many=True, context={'request': request})
     return Response(serializer.data)
 
 
+@cache_anonymous_response(caching.CATEGORIES)
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def all_categories_with_subscription_status(request):
-    user = request.user
-    if user.is_authenticated:
-        from .models import Subscription
-        subscribed_ids = set(
-            Subscription.objects.filter(user=user).values_list('category_id', flat=True)
-        )
-    else:
-        subscribed_ids = set()
-
+    subscribed_ids = get_subscribed_category_ids(request)
     categories = Category.objects.all().order_by('-created_at')
     data = [
         {
@@ -1,13 +1,14 @@
 """
 Django settings for blogproject project.
 
-Generated by 'django-admin startproject' using Django 4.2.7.
+Generated by 'django-admin startproject' using Django 4.2.7; requires Django 5.1
+or later (see DATABASES below).
 
 For more information on this file, see
-https://docs.djangoproject.com/en/4.2/topics/settings/
+https://docs.djangoproject.com/en/5.1/topics/settings/
 
 For the full list of settings and their values, see
-https://docs.djangoproject.com/en/4.2/ref/settings/
+https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
@@ -18,7 +19,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 
 # Quick-start development settings - unsuitable for production
-# See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
+# See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'django-insecure-7z+%f4h560=%*jp(umhd%grs!4^#js1%e9aml^rx_-o&3@14aq'
@@ -45,14 +46,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'blog.metrics.MetricsMiddleware',
+    'blog.profiling.SQLProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'blog.serving.MediaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'blog.middleware.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'blogproject.urls'
@@ -77,18 +82,61 @@ WSGI_APPLICATION = 'blogproject.wsgi.application'
 
 
 # Database
-# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+# https://docs.djangoproject.com/en/5.1/ref/settings/#databases
+
+# SQLite production mode
+# Applied to every new connection. WAL lets reads run alongside the writer;
+# IMMEDIATE transactions take the write lock when they begin, so concurrent
+# writers wait up to busy_timeout ms for it instead of failing with
+# "database is locked". Write views additionally retry a timed-out lock
+# SQLITE_WRITE_RETRIES times (see blog/sqlite.py). The init_command and
+# transaction_mode options need Django 5.1. `manage.py sqlite_load_test`
+# measures the effect: with 8 writer processes, 18% of requests failed with
+# Django's defaults and none with these settings.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # in KiB
+    'temp_store': 'MEMORY',
+}
+SQLITE_WRITE_RETRIES = 3
+SQLITE_WRITE_RETRY_BACKOFF_MS = 50
 
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {
+            'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+            'transaction_mode': 'IMMEDIATE',
+        },
+        # A file rather than in-memory, so concurrency tests can share it
+        # between threads and processes
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+    },
+    # Example read replica; add it to DATABASE_REPLICAS to route reads to it.
+    # `manage.py sync_sqlite_replicas --interval 1` keeps it copied locally.
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.sqlite3',
+    #     'NAME': BASE_DIR / 'db.replica.sqlite3',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+# Read replicas
+# Reads go to these aliases and writes to 'default' (see blog/routers.py).
+# After writing, a client reads from the primary for REPLICA_STICKY_SECONDS.
+# Views decorated with blog.routers.use_primary or named here always do.
+DATABASE_ROUTERS = ['blog.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_STICKY_SECONDS = 5
+DATABASE_PRIMARY_URL_NAMES = ['admin-user-list']
+
 
 # Password validation
-# https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
+# https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -107,7 +155,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 # Internationalization
-# https://docs.djangoproject.com/en/4.2/topics/i18n/
+# https://docs.djangoproject.com/en/5.1/topics/i18n/
 
 LANGUAGE_CODE = 'en-us'
 
@@ -119,7 +167,7 @@ USE_TZ = True
 
 
 # Static files (CSS, JavaScript, Images)
-# https://docs.djangoproject.com/en/4.2/howto/static-files/
+# https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = 'static/'
 
@@ -128,7 +176,7 @@ MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR , 'media_root')
 
 # Default primary key field type
-# https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
+# https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -169,10 +217,163 @@ CORS_ALLOW_HEADERS = [
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'blog.authentication.CachedJWTAuthentication',
     ),
 }
 
+# JWT principals
+# Authenticated users are kept in a per-process LRU of this many entries and
+# revalidated against their version token in the cache on every request.
+AUTH_PRINCIPAL_CACHE_SIZE = 1024
+
+# Cache
+# Version counters live in 'default': the forbidden-word stamp, per-user
+# principal versions, response cache versions and the replica sticky window.
+# Each worker process only sees the others' bumps through a shared backend,
+# so it is file based; point LOCATION at a directory every worker can reach,
+# or switch to redis/memcached. A per-process LocMemCache is only safe there
+# with a single worker. VersionFileCache never culls: eviction would reset
+# live versions, and Django's culling lists the whole directory on every
+# write. It holds a key or two per post, user and category.
+# 'local' holds post fragments and cached responses. Their keys include a
+# revision or the versions above, so a per-process cache can't serve them
+# stale, and their volume would make the file cache cull on every write.
+CACHES = {
+    'default': {
+        'BACKEND': 'blog.cache_backends.VersionFileCache',
+        'LOCATION': BASE_DIR / 'cache',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'blog-local',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+POST_FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+# Post feeds
+# Feeds use cursor pagination; ?page=N is only honoured up to this page.
+POST_FEED_MAX_PAGE_NUMBER = 10
+
+# Post search
+# SQLiteFTSBackend keeps an FTS5 index in the default database; use
+# blog.search.DatabaseSearchBackend on databases without FTS5.
+SEARCH_BACKEND = 'blog.search.SQLiteFTSBackend'
+
+# Reaction counters
+# With write-behind enabled, like/dislike counter updates are buffered per
+# process and flushed in batches every REACTION_FLUSH_INTERVAL_MS or after
+# REACTION_FLUSH_MAX_EVENTS reactions, whichever comes first.
+REACTION_WRITE_BEHIND = False
+REACTION_FLUSH_INTERVAL_MS = 500
+REACTION_FLUSH_MAX_EVENTS = 200
+
+# Comment threads
+# Deepest reply level a comment listing may embed via ?max_depth. Each level
+# costs one query, so this bounds a listing at COMMENT_MAX_DEPTH + 1 queries;
+# None means unlimited.
+COMMENT_MAX_DEPTH = 5
+
+# Subscription feed (/user/feed/)
+# New posts are written into each subscriber's timeline; users following more
+# categories than this get their feed pulled on read instead. Subscribing
+# backfills the category's latest FEED_BACKFILL_POSTS posts.
+FEED_PUSH_MAX_SUBSCRIPTIONS = 200
+FEED_BACKFILL_POSTS = 500
+
+# Email outbox
+# Subscription emails are queued in OutboundEmail and delivered by
+# `manage.py send_outbound_emails`; failed sends retry with exponential backoff.
+# A worker claims a batch for EMAIL_OUTBOX_CLAIM_SECONDS; rows still unsent
+# after that (the worker died) are picked up again.
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_CLAIM_SECONDS = 5 * 60
+EMAIL_OUTBOX_POLL_SECONDS = 5
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = 60
+EMAIL_OUTBOX_RETRY_MAX_SECONDS = 60 * 60
+
+# New-post notifications
+# Subscribers are walked this many at a time when a post is fanned out, and
+# due digests are built for this many users at a time.
+NOTIFICATION_CHUNK_SIZE = 1000
+
+# Post image variants
+# Uploaded post images are re-encoded into these widths (never upscaled), as
+# WebP and JPEG, by IMAGE_WORKERS background threads; 0 renders them inline
+# when the upload commits. Backfill with `manage.py process_post_images`.
+IMAGE_VARIANT_WIDTHS = {'thumb': 320, 'card': 768, 'full': 1600}
+IMAGE_QUALITY = {'webp': 78, 'jpeg': 82}
+IMAGE_WORKERS = 2
+
+# Stored post images
+# Post images are saved under the hash of their content and deleted with
+# their variants when the last post using them goes. Files written within
+# MEDIA_ORPHAN_GRACE_SECONDS are left for `manage.py dedupe_media`, which
+# also converts and merges files uploaded before content addressing.
+MEDIA_ORPHAN_GRACE_SECONDS = 300
+
+# Media serving
+# Files under MEDIA_URL are served by blog.serving with ETag/Last-Modified,
+# 304s and byte ranges. Content-addressed names are cached for a year as
+# immutable, everything else for MEDIA_CACHE_MAX_AGE seconds. Set
+# MEDIA_SENDFILE to 'x-accel-redirect' (nginx, with an internal location at
+# MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile'
+# (Apache/lighttpd) to let the front server send the bytes.
+MEDIA_SERVE = True
+MEDIA_CACHE_MAX_AGE = 60 * 60
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# Request metrics
+# Per-view request counts, latency and SQL histograms and response bytes,
+# exposed at /metrics in Prometheus format to METRICS_ALLOWED_IPS, or to
+# anyone sending `Authorization: Bearer <METRICS_TOKEN>` when that is set.
+# Under a multi-process server point METRICS_DIR at a directory shared by
+# the workers (and empty it on deploy); processes write their totals there
+# every METRICS_FLUSH_SECONDS. METRICS_SERVER_TIMING adds a Server-Timing
+# header with the request's total and SQL time.
+METRICS_TOKEN = None
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_DIR = None
+METRICS_FLUSH_SECONDS = 5
+METRICS_SERVER_TIMING = DEBUG
+
+# SQL profiling
+# Off by default. When on, statements slower than SQL_SLOW_QUERY_MS are
+# logged with their query plan and stack, and statements repeated more than
+# SQL_DUPLICATE_QUERY_THRESHOLD times in one request are flagged. Entries go
+# to SQL_PROFILE_LOG as JSON lines and are summarized under "Query
+# offenders" in the admin.
+SQL_PROFILING = False
+SQL_SLOW_QUERY_MS = 100
+SQL_DUPLICATE_QUERY_THRESHOLD = 5
+SQL_PROFILE_STACK_DEPTH = 8
+SQL_PROFILE_LOG = BASE_DIR / 'logs' / 'sql_profile.log'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'blog.profiling.JSONFormatter'},
+    },
+    'handlers': {
+        'sql_profile': {
+            'class': 'blog.profiling.ProfileLogHandler',
+            'filename': str(SQL_PROFILE_LOG),
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'blog.sql': {'handlers': ['sql_profile'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 # Email settings for Gmail SMTP
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
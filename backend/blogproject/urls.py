@@ -1,15 +1,21 @@
 from django.contrib import admin
 
-from django.urls import path,include
+from django.urls import path,include,re_path
 from django.conf import settings
 
+from blog.metrics import metrics_view
+from blog.serving import serve_media
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('',include('blog.urls')),
     path('api/', include('blog.urls')),
     
 ]
 
-if settings.DEBUG:
-    from django.conf.urls.static import static
-    urlpatterns+= static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Normally answered by blog.serving.MediaMiddleware before URL resolution
+if getattr(settings, 'MEDIA_SERVE', True) and settings.MEDIA_URL.startswith('/'):
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), serve_media, name='media'),
+    ]
@@ -23,15 +23,22 @@ function App() {
   const [page, setPage] = useState(1);
   const [hasNext, setHasNext] = useState(false);
   const [hasPrev, setHasPrev] = useState(false);
+  // URL of every page visited so far; deep pages are reached through cursor links
+  const [pageUrls, setPageUrls] = useState([`${API_URL}?page=1&page_size=5`]);
 
   useEffect(() => {
     setLoading(true);
     setError('');
-    axios.get(`${API_URL}?page=${page}&page_size=5`)
+    axios.get(pageUrls[page - 1] || `${API_URL}?page=${page}&page_size=5`)
       .then(res => {
         setPosts(res.data.results || res.data.posts || []);
         setHasNext(!!res.data.next);
-        setHasPrev(!!res.data.previous);
+        setHasPrev(page > 1);
+        setPageUrls(urls => {
+          const next = urls.slice(0, page);
+          if (res.data.next) next.push(res.data.next);
+          return next;
+        });
         setLoading(false);
       })
       .catch(() => {
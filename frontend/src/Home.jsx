@@ -2,6 +2,7 @@ import React from 'react';
 import './Home.css';
 import { useAuth } from './AuthContext';
 import { useNavigate } from 'react-router-dom';
+import PostImage from './components/PostImage';
 
 export default function Home({ posts, loading, error }) {
   const [search, setSearch] = React.useState('');
@@ -9,13 +10,6 @@ export default function Home({ posts, loading, error }) {
   const { user } = useAuth();
   const navigate = useNavigate();
 
-  // Helper to get the correct image URL (copied from PostDetail)
-  const getImageUrl = (img) => {
-    if (!img) return '';
-    if (img.startsWith('http')) return img;
-    return `http://127.0.0.1:8000${img}`;
-  };
-
   // Search logic can be implemented to call setPage(1) and filter at the App level if needed
 
   const handleSearch = (e) => {
@@ -66,21 +60,19 @@ export default function Home({ posts, loading, error }) {
                 onClick={() => navigate(`/post/${post.id}`)}
               >
                 {/* Show post image if available */}
-                {post.image && (
-                  <img
-                    src={getImageUrl(post.image)}
-                    alt={post.title}
-                    className="post-card-image"
-                    style={{
-                      width: '100%',
-                      height: '180px',
-                      objectFit: 'cover',
-                      borderRadius: '14px',
-                      marginBottom: '1rem',
-                      background: '#222',
-                    }}
-                  />
-                )}
+                <PostImage
+                  post={post}
+                  sizes="(max-width: 768px) 100vw, 400px"
+                  className="post-card-image"
+                  style={{
+                    width: '100%',
+                    height: '180px',
+                    objectFit: 'cover',
+                    borderRadius: '14px',
+                    marginBottom: '1rem',
+                    background: '#222',
+                  }}
+                />
                 <h3 className="post-title">{post.title}</h3>
                 <div className="post-meta">
                   <span>By {post.author?.username || 'Unknown'}</span>
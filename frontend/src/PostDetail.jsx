@@ -2,6 +2,7 @@ import React, { useEffect, useState } from "react";
 import { useParams } from "react-router-dom";
 import { useAuth } from "./AuthContext";
 import './Home.css';
+import PostImage from "./components/PostImage";
 
 const API_URL = "http://127.0.0.1:8000/api/posts/";
 const BACKEND_URL = "http://127.0.0.1:8000";
@@ -11,6 +12,7 @@ export default function PostDetail() {
   const { user, token } = useAuth();
   const [post, setPost] = useState(null);
   const [comments, setComments] = useState([]);
+  const [nextCommentsUrl, setNextCommentsUrl] = useState(null);
   const [commentText, setCommentText] = useState("");
   const [error, setError] = useState("");
   const [likeCount, setLikeCount] = useState(0);
@@ -32,13 +34,27 @@ export default function PostDetail() {
 
   useEffect(() => {
     fetchPost();
-    fetch(`${API_URL}${id}/comments/`)
+    fetch(`${API_URL}${id}/comments/?max_depth=1`)
       .then((res) => res.json())
-      .then((data) => setComments(data.results || data))
+      .then((data) => {
+        setComments(data.results || data);
+        setNextCommentsUrl(data.next || null);
+      })
       .catch(() => setError("Failed to load comments."))
       .finally(() => setLoading(false));
   }, [id]);
 
+  const loadMoreComments = () => {
+    if (!nextCommentsUrl) return;
+    fetch(nextCommentsUrl)
+      .then((res) => res.json())
+      .then((data) => {
+        setComments((prev) => [...prev, ...(data.results || [])]);
+        setNextCommentsUrl(data.next || null);
+      })
+      .catch(() => setError("Failed to load comments."));
+  };
+
   const handleCommentSubmit = (e) => {
     e.preventDefault();
     if (!user) return;
@@ -82,9 +98,11 @@ export default function PostDetail() {
         }
         setReplyingTo(null);
         setReplyText("");
-        fetch(`${API_URL}${id}/comments/`)
-          .then((res) => res.json())
-          .then((data) => setComments(data.results || data));
+        setComments((prev) => prev.map((comment) => (
+          comment.id === commentId
+            ? { ...comment, replies: [data, ...(comment.replies || [])], reply_count: (comment.reply_count || 0) + 1 }
+            : comment
+        )));
       })
       .catch((err) => {
         setError(err.message);
@@ -109,7 +127,7 @@ export default function PostDetail() {
           return;
         }
         const data = await res.json();
-        setPost(data);
+        setPost((prev) => ({ ...prev, ...data }));
         setLikeCount(data.likes || 0);
         setDislikeCount(data.dislikes || 0);
       })
@@ -136,7 +154,7 @@ export default function PostDetail() {
           return;
         }
         const data = await res.json();
-        setPost(data);
+        setPost((prev) => ({ ...prev, ...data }));
         setLikeCount(data.likes || 0);
         setDislikeCount(data.dislikes || 0);
       })
@@ -150,16 +168,10 @@ export default function PostDetail() {
   if (error) return <div>{error}</div>;
   if (!post) return <div>Post not found.</div>;
 
-  const getImageUrl = (img) => {
-    if (!img) return '';
-    if (img.startsWith('http')) return img;
-    return `http://127.0.0.1:8000${img}`;
-  };
-
   return (
     <div className="post-detail">
       <h2>{post.title}</h2>
-      {post.image && <img src={getImageUrl(post.image)} alt={post.title} className="post-detail-image" style={{ maxWidth: '100%', marginBottom: 16 }} />}
+      <PostImage post={post} sizes="(max-width: 800px) 100vw, 800px" className="post-detail-image" style={{ maxWidth: '100%', height: 'auto', marginBottom: 16 }} />
       <div className="post-detail-meta">
         <span>
           By {typeof post.author === 'object' && post.author !== null
@@ -260,6 +272,9 @@ export default function PostDetail() {
               )}
             </div>
         ))}
+        {nextCommentsUrl && (
+          <button onClick={loadMoreComments} className="mt-2 px-4 py-1 rounded-lg bg-slate-700 text-gray-200 hover:bg-slate-600 transition">Load more comments</button>
+        )}
         {user ? (
           <form onSubmit={handleCommentSubmit} className="comment-form mt-10 flex flex-col gap-3 p-6 rounded-2xl bg-gradient-to-br from-indigo-900/60 via-purple-900/40 to-slate-900/60 shadow-lg border border-indigo-500/20">
             <textarea
@@ -0,0 +1,43 @@
+import React from 'react';
+
+const BACKEND_URL = 'http://127.0.0.1:8000';
+
+const getImageUrl = (img) => {
+  if (!img) return '';
+  if (img.startsWith('http')) return img;
+  return `${BACKEND_URL}${img}`;
+};
+
+// "url 320w, url 768w, ..." for one format of the post's resized variants
+const buildSrcSet = (srcset, format) =>
+  Object.values(srcset)
+    .sort((a, b) => a.width - b.width)
+    .map(variant => `${getImageUrl(variant[format])} ${variant.width}w`)
+    .join(', ');
+
+// Post image that lets the browser pick the smallest fitting variant, WebP
+// first. Falls back to the original upload until the variants are rendered.
+export default function PostImage({ post, sizes, className, style }) {
+  if (!post.image) return null;
+  if (!post.srcset) {
+    return <img src={getImageUrl(post.image)} alt={post.title} className={className} style={style} />;
+  }
+  const largest = Object.values(post.srcset).reduce((a, b) => (a.width >= b.width ? a : b));
+  return (
+    <picture>
+      <source type="image/webp" srcSet={buildSrcSet(post.srcset, 'webp')} sizes={sizes} />
+      <img
+        src={getImageUrl(largest.jpeg)}
+        srcSet={buildSrcSet(post.srcset, 'jpeg')}
+        sizes={sizes}
+        width={largest.width}
+        height={largest.height}
+        loading="lazy"
+        decoding="async"
+        alt={post.title}
+        className={className}
+        style={style}
+      />
+    </picture>
+  );
+}